@@ -1,17 +1,19 @@
-import logging, os, time
+import asyncio, logging, os, threading, time
 from typing import List, Union
 from fastapi import FastAPI, HTTPException, WebSocket
 from fastapi.responses import JSONResponse, FileResponse
 from app.args import Args
 from app.client import img_client_manager
 from app.models.common_api import GetModelResponse, ListModelsResponse, LoadModelRequest, LoadModelResponse, UnloadModelResponse
-from app.models.img.img_client import Txt2ImgOptions, Txt2ImgResponse
+from app.models.img.img_client import EmbeddingCacheStats, Txt2ImgOptions, Txt2ImgProgress, Txt2ImgResponse, Txt2ImgStreamRequest
+from app.utils.workers import get_worker
 
 EXTENSIONS = []
 logger = logging.getLogger(__name__)
 
 def img_api(app: FastAPI):
 	manager = img_client_manager.ImgManager.instance
+	worker = get_worker('img')
 
 	def modelName():
 		if manager.model_name is not None:
@@ -36,7 +38,7 @@ def img_api(app: FastAPI):
 					'time':
 					time.time() - start
 				})
-			manager.unload_model()
+		# the manager unloads least recently used models if this one doesn't fit
 		logger.debug(model_name)
 		try:
 			manager.load_model(model_name)
@@ -94,6 +96,13 @@ def img_api(app: FastAPI):
 		res = manager.txt2img(gen_options)
 		return Txt2ImgResponse.model_validate(res)
 
+	def txt2img_stream(
+		gen_options: Txt2ImgStreamRequest, cancelled: threading.Event
+	):
+		if manager.model_name is None:
+			raise Exception('No model loaded.')
+		return manager.txt2img_stream(gen_options, cancelled)
+
 	@app.websocket('/img/v1/ws')
 	async def img_ws(websocket: WebSocket):
 		await websocket.accept()
@@ -101,6 +110,31 @@ def img_api(app: FastAPI):
 		async def send_json(data):
 			return await websocket.send_json(data)
 
+		# the txt2img running for this client, one at a time
+		generation: Union[asyncio.Task, None] = None
+		cancelled = threading.Event()
+
+		async def stream_txt2img(
+			req: Txt2ImgStreamRequest, cancelled: threading.Event
+		):
+			"""Sends `txt2img_progress` after each step, then `txt2img` with the images."""
+			try:
+				async for res in worker.iterate(txt2img_stream, req, cancelled):
+					if isinstance(res, Txt2ImgProgress):
+						await send_json({
+							'type': 'txt2img_progress',
+							'data': res.model_dump()
+						})
+					else:
+						await send_json({'type': 'txt2img', 'data': res.model_dump()})
+			except Exception as e:
+				if not cancelled.is_set():
+					logger.error(e)
+				try:
+					await send_json({'type': 'txt2img', 'data': {'error': str(e)}})
+				except Exception:
+					pass  # the client went away
+
 		await send_json({
 			'type': 'list_models',
 			'data': list_models().model_dump_json()
@@ -115,19 +149,36 @@ def img_api(app: FastAPI):
 				data = await websocket.receive_json()
 			except Exception as e:
 				logger.error(e)
+				# don't keep generating for a client that's gone
+				cancelled.set()
 				await websocket.close()
 				break
-			if data['type'] == 'load_model':
+			if data['type'] == 'txt2img':
+				req = Txt2ImgStreamRequest.model_validate(data['data'])
+				if generation is not None and not generation.done():
+					await send_json({
+						'type': 'txt2img',
+						'data': {
+							'error': 'Already generating.'
+						}
+					})
+					continue
+				cancelled = threading.Event()
+				generation = asyncio.create_task(stream_txt2img(req, cancelled))
+			elif data['type'] == 'txt2img_cancel':
+				cancelled.set()
+			elif data['type'] == 'load_model':
 				req = data['data']
 				try:
-					res = load_model(req.model_name).model_dump_json()
+					res = (await worker.run(load_model,
+																	req.model_name)).model_dump_json()
 				except Exception as e:
 					res = {'error': str(e)}
 				await send_json({'type': 'load_model', 'data': res})
 			elif data['type'] == 'unload_model':
 				await send_json({
 					'type': 'unload_model',
-					'data': unload_model().model_dump_json()
+					'data': (await worker.run(unload_model)).model_dump_json()
 				})
 			elif data['type'] == 'get_model':
 				await send_json({
@@ -166,9 +217,8 @@ def img_api(app: FastAPI):
 	async def img_load_model(body: LoadModelRequest):
 		"""Load a model by filename from img_models_dir"""
 		model_name = body.model
-		return JSONResponse(
-			content=load_model(model_name).model_dump()
-		)
+		res = await worker.run(load_model, model_name)
+		return JSONResponse(content=res.model_dump())
 
 	@app.get(
 		'/img/v1/model/unload',
@@ -177,7 +227,8 @@ def img_api(app: FastAPI):
 	)
 	async def img_unload_model():
 		"""Unload currently-loaded model"""
-		return JSONResponse(content=unload_model().model_dump())
+		res = await worker.run(unload_model)
+		return JSONResponse(content=res.model_dump())
 
 	# POST /img/v1/txt2img
 	@app.post(
@@ -187,9 +238,20 @@ def img_api(app: FastAPI):
 	)
 	async def img_txt2img(gen_options: Txt2ImgOptions):
 		"""Generate an image from text"""
-		return JSONResponse(
-			content=txt2img(gen_options).model_dump()
+		res = await worker.run(txt2img, gen_options)
+		return JSONResponse(content=res.model_dump())
+
+	@app.get(
+		'/img/v1/cache',
+		response_model=EmbeddingCacheStats,
+		tags=['img']
+	)
+	async def img_cache_stats():
+		"""Prompt embedding cache hits, misses and size. Prompts and negative prompts seen before skip the text encoder(s)."""
+		stats = EmbeddingCacheStats.model_validate(
+			manager.embedding_cache_stats()
 		)
+		return JSONResponse(content=stats.model_dump())
 
 	@app.get('/img/v1/list-samplers', tags=['img'])
 	async def img_list_samplers():
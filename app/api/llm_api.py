@@ -1,13 +1,19 @@
-import logging, os, time
-from fastapi import FastAPI, HTTPException, Path, WebSocket
-from fastapi.responses import JSONResponse
+import json, logging, os, time
+from uuid import uuid4
+from fastapi import FastAPI, File, HTTPException, Path, Query, UploadFile, WebSocket
+from fastapi.responses import JSONResponse, StreamingResponse
 from huggingface_hub import snapshot_download
+from sse_starlette.sse import EventSourceResponse
+from starlette.concurrency import run_in_threadpool
 from app.args import Args
 from app.client import llm_client_manager
 from app.client.llm import LLMClient_OpenAI
-from app.models.llm.llm_api import CompletionRequest, CompletionResponse, DownloadModelRequest, DownloadModelResponse, ListModelsResponse, GetModelResponse, LoadModelResponse, UnloadModelRequest, LoadModelRequest
+from app.client.llm._utils import text_completion_chunk
+from app.models.llm.llm_api import BatchCompletionItem, BatchCompletionRequest, BatchCompletionResponse, BatchCompletionStats, CompletionRequest, CompletionResponse, DownloadModelRequest, DownloadModelResponse, ListModelsResponse, GetModelResponse, LoadModelResponse, UnloadModelRequest, LoadModelRequest
 from app.models.llm.client import CompletionOptions, MessageObject
+from app.settings import LLM_MAX_BATCH_SIZE
 from app.utils import prompt_format
+from app.utils.workers import get_worker
 
 # supported extensions
 EXTENSIONS = ['.gguf', '.ggml', '.safetensor']
@@ -16,6 +22,7 @@ logger = logging.getLogger(__name__)
 def llm_api(app: FastAPI):
 	manager = llm_client_manager.LLMManager.instance
 	openai = LLMClient_OpenAI.instance
+	worker = get_worker('llm')
 
 	def modelName():
 		if manager.model_name is not None:
@@ -28,10 +35,12 @@ def llm_api(app: FastAPI):
 			'model':
 			modelName(),
 			'loader_name':
-			manager.loader_name
+			manager.loader_name,
+			'loaded_models':
+			manager.list_loaded_models()
 		})
 
-	def load_model(model_name: str) -> LoadModelResponse:
+	def load_model(model_name: str, draft_model='') -> LoadModelResponse:
 		# TODO: instead of model name, accept 'features' dict:
 		#   grammar (bool): model supports grammar
 		#   model_type ('instruct' or 'chat'): the preferred model type
@@ -39,7 +48,7 @@ def llm_api(app: FastAPI):
 		#   ctx (int)? (maybe not): preferred n_ctx, probably not trivial (e.g. a bigger model at same ctx might not fit in vram/etc)
 		start = time.time()
 		if manager.model_name is not None:
-			if manager.model_name == model_name:  # already loaded
+			if manager.model_name == model_name and not draft_model:  # already loaded
 				return LoadModelResponse.model_validate({
 					'status':
 					'Loaded',
@@ -47,13 +56,17 @@ def llm_api(app: FastAPI):
 					modelName(),
 					'loader_name':
 					manager.loader_name,
+					'draft_model':
+					manager.get_draft_model(model_name),
 					'time':
 					time.time() - start
 				})
-			manager.unload_model()
+		# the manager unloads least recently used models if this one doesn't fit
 		logger.debug(model_name)
 		try:
 			manager.load_model(model_name)
+			if draft_model:
+				manager.load_draft_model(model_name, draft_model)
 		except Exception as e:
 			return LoadModelResponse.model_validate({
 				'status':
@@ -72,6 +85,8 @@ def llm_api(app: FastAPI):
 			modelName(),
 			'loader_name':
 			manager.loader_name,
+			'draft_model':
+			manager.get_draft_model(model_name),
 			'time':
 			time.time() - start
 		})
@@ -150,7 +165,10 @@ def llm_api(app: FastAPI):
 			time.time() - start
 		})
 
-	def complete(req: CompletionRequest):
+	def build_options(
+		req: CompletionRequest
+	) -> tuple[CompletionOptions, int]:
+		"""Returns the options for the manager and how many tokens of prior messages were dropped to fit the context."""
 		# TODO accept a "json_format" which can take some kind of specfor json
 		#   we'll use whatever json-constraints the current loader exposes if any
 		#   llamacpp has grammar (& LlamaGrammar has a from_json method)
@@ -164,6 +182,7 @@ def llm_api(app: FastAPI):
 		model = req.model
 		if model == '':
 			model = manager.model_name or ''
+		dropped_tokens = 0
 
 		# TODO create default stop strings for models/formats
 
@@ -180,9 +199,14 @@ def llm_api(app: FastAPI):
 					messages = []
 					for msg in m:
 						messages.append(MessageObject.model_validate(msg))
-				else:
+				elif 'openai:' in model:
 					prompt = prompt_format.parts_to_prompt(
-						parts, model, prefix_response
+						parts, model, prefix_response, req.conversation_id
+					)
+				else:
+					prompt, dropped_tokens = manager.pack_prompt(
+						parts, model, req.max_tokens, prefix_response,
+						req.conversation_id
 					)
 			except Exception as e:
 				# raise Exception(
@@ -193,15 +217,164 @@ def llm_api(app: FastAPI):
 			prompt = str(prompt)
 		req.prompt = prompt
 		req.messages = messages
-		options = CompletionOptions.model_validate(req.model_dump())
+		if dropped_tokens > 0:
+			logger.info(
+				f'Dropped {dropped_tokens} tokens of prior messages to fit the context.'
+			)
+		return CompletionOptions.model_validate(
+			req.model_dump()
+		), dropped_tokens
+
+	def complete(req: CompletionRequest):
+		options, dropped_tokens = build_options(req)
 		result = manager.complete(options)
 		assert result is not None
+		result.result.usage.dropped_tokens = dropped_tokens
 		res: dict = {
 			'result': result.result,
 			'params': result.params
 		}
 		return CompletionResponse(**res)
 
+	def stream(req: CompletionRequest):
+		"""Yields completion chunks, the last one carrying `finish_reason`."""
+		options, _ = build_options(req)
+		id = uuid4().hex
+		created = int(time.time())
+		model_name = options.model
+		# the generator returns its finish_reason
+		chunks = manager.generate(options)
+		while True:
+			try:
+				text = next(chunks)
+			except StopIteration as done:
+				finish_reason = done.value or 'stop'
+				break
+			yield text_completion_chunk(
+				text, id=id, created=created, model_name=model_name
+			)
+		yield text_completion_chunk(
+			'',
+			id=id,
+			created=created,
+			model_name=model_name,
+			finish_reason=finish_reason
+		)
+
+	def batch_stats(
+		size: int, prompt_tokens: int, completion_tokens: int, elapsed: float
+	) -> BatchCompletionStats:
+		return BatchCompletionStats.model_validate({
+			'size':
+			size,
+			'prompt_tokens':
+			prompt_tokens,
+			'completion_tokens':
+			completion_tokens,
+			'time':
+			elapsed,
+			'tokens_per_second':
+			completion_tokens / elapsed if elapsed > 0 else 0
+		})
+
+	def run_batch(reqs: list[CompletionRequest]):
+		"""Runs `reqs` in batches of up to LLM_MAX_BATCH_SIZE, yielding a BatchCompletionItem per request and BatchCompletionStats after each batch.
+
+		Requests are sorted by model and prompt first, so prompts that share a
+		prefix run in the same batch and reuse each other's prefix cache entries.
+		"""
+		options: dict[int, CompletionOptions] = {}
+		dropped_tokens: dict[int, int] = {}
+		for i, req in enumerate(reqs):
+			try:
+				options[i], dropped_tokens[i] = build_options(req)
+			except Exception as e:
+				yield BatchCompletionItem(index=i, error=str(e))
+		order = sorted(
+			options, key=lambda i: (options[i].model, options[i].prompt)
+		)
+		for b in range(0, len(order), LLM_MAX_BATCH_SIZE):
+			batch = order[b:b + LLM_MAX_BATCH_SIZE]
+			start = time.time()
+			results = manager.complete_batch([options[i] for i in batch])
+			elapsed = time.time() - start
+			prompt_tokens = 0
+			completion_tokens = 0
+			for i, result in zip(batch, results):
+				if isinstance(result, Exception):
+					yield BatchCompletionItem(index=i, error=str(result))
+					continue
+				result.result.usage.dropped_tokens = dropped_tokens[i]
+				prompt_tokens += result.result.usage.prompt_tokens
+				completion_tokens += result.result.usage.completion_tokens
+				yield BatchCompletionItem(
+					index=i, result=result.result, params=result.params
+				)
+			yield batch_stats(
+				len(batch), prompt_tokens, completion_tokens, elapsed
+			)
+
+	def complete_batch(
+		reqs: list[CompletionRequest]
+	) -> BatchCompletionResponse:
+		start = time.time()
+		results: list[BatchCompletionItem] = []
+		batches: list[BatchCompletionStats] = []
+		for item in run_batch(reqs):
+			if isinstance(item, BatchCompletionStats):
+				batches.append(item)
+			else:
+				results.append(item)
+		results.sort(key=lambda item: item.index)
+		return BatchCompletionResponse(
+			results=results,
+			batches=batches,
+			stats=batch_stats(
+				len(reqs), sum(b.prompt_tokens for b in batches),
+				sum(b.completion_tokens for b in batches),
+				time.time() - start
+			)
+		)
+
+	async def batch_lines(reqs: list[CompletionRequest]):
+		"""JSON lines of `run_batch`: a result per request as it finishes, `{"batch": stats}` after each batch and `{"stats": stats}` for the whole run."""
+		start = time.time()
+		prompt_tokens = 0
+		completion_tokens = 0
+		try:
+			async for item in worker.iterate(run_batch, reqs):
+				if isinstance(item, BatchCompletionStats):
+					prompt_tokens += item.prompt_tokens
+					completion_tokens += item.completion_tokens
+					yield json.dumps({'batch': item.model_dump()}) + '\n'
+				else:
+					yield item.model_dump_json() + '\n'
+		except Exception as e:
+			logger.error(e)
+			yield json.dumps({'error': str(e)}) + '\n'
+		stats = batch_stats(
+			len(reqs), prompt_tokens, completion_tokens,
+			time.time() - start
+		)
+		yield json.dumps({'stats': stats.model_dump()}) + '\n'
+
+	async def batch_response(reqs: list[CompletionRequest], stream: bool):
+		if stream:
+			return StreamingResponse(
+				batch_lines(reqs), media_type='application/x-ndjson'
+			)
+		res = await worker.run(complete_batch, reqs)
+		return JSONResponse(content=res.model_dump())
+
+	async def stream_events(req: CompletionRequest):
+		try:
+			async for chunk in worker.iterate(stream, req):
+				yield {'data': json.dumps(chunk)}
+		except Exception as e:
+			logger.error(e)
+			yield {'event': 'error', 'data': json.dumps({'error': str(e)})}
+		yield {'data': '[DONE]'}
+
 	@app.websocket('/llm/v1/ws')
 	async def llm_ws(websocket: WebSocket):
 		await websocket.accept()
@@ -209,8 +382,7 @@ def llm_api(app: FastAPI):
 		await websocket.send_json({
 			'type':
 			'list_models',
-			'data':
-			list_models().model_dump_json()
+			'data': (await run_in_threadpool(list_models)).model_dump_json()
 		})
 		await websocket.send_json({
 			'type':
@@ -228,15 +400,32 @@ def llm_api(app: FastAPI):
 			# handle error
 			if data['type'] == 'complete':
 				req = CompletionRequest(**data['data'])
+				if req.stream:
+					try:
+						async for chunk in worker.iterate(stream, req):
+							await websocket.send_json({
+								'type': 'complete_chunk',
+								'data': chunk
+							})
+					except Exception as e:
+						await websocket.send_json({
+							'type': 'complete_chunk',
+							'data': {
+								'error': str(e)
+							}
+						})
+					await websocket.send_json({'type': 'complete_end'})
+					continue
 				try:
-					res = complete(req).model_dump_json()
+					res = (await worker.run(complete, req)).model_dump_json()
 				except Exception as e:
 					res = {'error': str(e)}
 				await websocket.send_json(res)
 			elif data['type'] == 'load_model':
 				req = data['data']
 				try:
-					res = load_model(req.model_name).model_dump_json()
+					res = (await worker.run(load_model,
+																	req.model_name)).model_dump_json()
 				except Exception as e:
 					res = {'error': str(e)}
 				await websocket.send_json({
@@ -247,8 +436,7 @@ def llm_api(app: FastAPI):
 				await websocket.send_json({
 					'type':
 					'unload_model',
-					'data':
-					unload_model().model_dump_json()
+					'data': (await worker.run(unload_model)).model_dump_json()
 				})
 			elif data['type'] == 'get_model':
 				await websocket.send_json({
@@ -261,13 +449,13 @@ def llm_api(app: FastAPI):
 				await websocket.send_json({
 					'type':
 					'list_models',
-					'data':
-					list_models().model_dump_json()
+					'data': (await run_in_threadpool(list_models)).model_dump_json()
 				})
 			elif data['type'] == 'download_model':
 				req = DownloadModelRequest(**data['data'])
 				try:
-					res = download_model(req.model).model_dump_json()
+					res = (await run_in_threadpool(download_model,
+																				req.model)).model_dump_json()
 				except Exception as e:
 					res = {'error': str(e)}
 				await websocket.send_json({
@@ -281,7 +469,7 @@ def llm_api(app: FastAPI):
 		tags=['llm']
 	)
 	async def llm_complete(req: CompletionRequest):
-		"""Generate text from a prompt, or an array of PromptParts. Prompt should be in proper format (unless using `parts`), it's fed directly to the model. If both are provided then `prompt` is overwritten by constructing prompt from `parts`."""
+		"""Generate text from a prompt, or an array of PromptParts. Prompt should be in proper format (unless using `parts`), it's fed directly to the model. If both are provided then `prompt` is overwritten by constructing prompt from `parts`. With `stream`, chunks are sent as server-sent events as they're generated, ending with `[DONE]`."""
 		if manager.model_name is None and req.model is None:
 			raise HTTPException(
 				status_code=500, detail='Model not loaded.'
@@ -291,7 +479,37 @@ def llm_api(app: FastAPI):
 			raise HTTPException(
 				status_code=400, detail='Prompt or parts is required.'
 			)
-		return complete(req)
+		if req.stream:
+			return EventSourceResponse(stream_events(req))
+		return await worker.run(complete, req)
+
+	@app.post(
+		'/llm/v1/complete/batch',
+		response_model=BatchCompletionResponse,
+		tags=['llm']
+	)
+	async def llm_complete_batch(req: BatchCompletionRequest):
+		"""Run many completion requests (prompt/parts/messages as in `/llm/v1/complete`) in GPU batches. Results are returned in request order, or with `stream` sent as JSON lines as each batch finishes. Per-batch and overall throughput are reported."""
+		return await batch_response(req.requests, req.stream)
+
+	@app.post(
+		'/llm/v1/complete/batch/upload',
+		response_model=BatchCompletionResponse,
+		tags=['llm']
+	)
+	async def llm_complete_batch_upload(
+		file: UploadFile = File(...), stream: bool = Query(False)
+	):
+		"""Same as `/llm/v1/complete/batch`, with the requests uploaded as a JSONL file of CompletionRequests."""
+		content = (await file.read()).decode('utf-8')
+		try:
+			reqs = [
+				CompletionRequest.model_validate_json(line)
+				for line in content.splitlines() if line.strip() != ''
+			]
+		except Exception as e:
+			raise HTTPException(status_code=400, detail=str(e))
+		return await batch_response(reqs, stream)
 
 	@app.get(
 		'/llm/v1/model',
@@ -309,7 +527,8 @@ def llm_api(app: FastAPI):
 	)
 	async def llm_list_models():
 		"""Get list of models (using relative filenames) in llm_models_dir"""
-		return JSONResponse(content=list_models().model_dump())
+		res = await run_in_threadpool(list_models)
+		return JSONResponse(content=res.model_dump())
 
 	@app.post(
 		'/llm/v1/model/load',
@@ -317,11 +536,10 @@ def llm_api(app: FastAPI):
 		tags=['llm']
 	)
 	async def llm_load_model(body: LoadModelRequest):
-		"""Load a model by filename from llm_models_dir"""
+		"""Load a model by filename from llm_models_dir, optionally with a draft model for speculative decoding"""
 		model_name = body.model
-		return JSONResponse(
-			content=load_model(model_name).model_dump()
-		)
+		res = await worker.run(load_model, model_name, body.draft_model)
+		return JSONResponse(content=res.model_dump())
 
 	@app.get(
 		'/llm/v1/model/unload',
@@ -330,7 +548,8 @@ def llm_api(app: FastAPI):
 	)
 	async def llm_unload_model():
 		"""Unload currently-loaded model"""
-		return JSONResponse(content=unload_model().model_dump())
+		res = await worker.run(unload_model)
+		return JSONResponse(content=res.model_dump())
 
 	@app.post(
 		'/llm/v1/download-model',
@@ -339,6 +558,5 @@ def llm_api(app: FastAPI):
 	)
 	async def llm_download_model(body: DownloadModelRequest):
 		"""Download a model from the HuggingFace Hub"""
-		return JSONResponse(
-			content=download_model(body.model).model_dump()
-		)
+		res = await run_in_threadpool(download_model, body.model)
+		return JSONResponse(content=res.model_dump())
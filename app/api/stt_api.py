@@ -1,27 +1,36 @@
+import asyncio
+import io
+import json
 import logging
 import os
 import time
-from fastapi import FastAPI, HTTPException, UploadFile, File, Query
+from collections import deque
+from typing import Any, Union
+from fastapi import FastAPI, HTTPException, UploadFile, File, Query, WebSocket
+from fastapi.responses import JSONResponse, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
 from app.args import Args
+from app.client.stt.realtime import RealtimeSession, Utterance
 from app.client.stt_client_manager import STTManager
-from app.models.stt.stt_client import TranscribeResponse
-from app.utils import audio
+from app.models.stt.stt_client import BatchTranscribeItem, BatchTranscribeResponse, RealtimeTranscript, TranscribeResponse, TranscriptCacheStats
+from app.utils.workers import get_worker
 
 logger = logging.getLogger(__name__)
 
 # TODO add format option (text or json)
 def stt_api(app: FastAPI):
 	manager = STTManager.instance
+	worker = get_worker('stt')
 
 	def transcribe(
-		file_path: str,
+		file: Any,
 		diarize: bool = False,
 		result_format: str = 'json'
 	) -> TranscribeResponse:
 		start = time.time()
 		try:
 			response = manager.transcribe(
-				file_path, diarize, result_format
+				'', diarize, result_format, file=file
 			)
 		except Exception as e:
 			raise RuntimeError(f"Error in transcription: {e}")
@@ -29,29 +38,218 @@ def stt_api(app: FastAPI):
 		print(f"Time taken: {end - start}")
 		return response
 
+	async def stream_events(file: Any, diarize: bool):
+		try:
+			async for chunk in worker.iterate(
+				manager.transcribe_stream, '', diarize, None, file
+			):
+				yield {'data': chunk.model_dump_json()}
+		except Exception as e:
+			logger.error(f"Error in STT conversion: {e}")
+			yield {'event': 'error', 'data': json.dumps({'error': str(e)})}
+		finally:
+			file.close()
+		yield {'data': '[DONE]'}
+
+	def run_batch(
+		names: list[str], sources: list, diarize: bool, result_format: str
+	):
+		"""Yields a BatchTranscribeItem per file as it's transcribed."""
+		for i, res in manager.transcribe_batch(
+			sources, diarize, result_format
+		):
+			if isinstance(res, Exception):
+				yield BatchTranscribeItem(index=i, file=names[i], error=str(res))
+			else:
+				yield BatchTranscribeItem(
+					index=i, file=names[i], result=res.result
+				)
+
+	def transcribe_batch(
+		names: list[str], sources: list, diarize: bool, result_format: str
+	) -> BatchTranscribeResponse:
+		start = time.time()
+		results = sorted(
+			run_batch(names, sources, diarize, result_format),
+			key=lambda item: item.index
+		)
+		return BatchTranscribeResponse(
+			results=results, time=time.time() - start
+		)
+
+	async def batch_lines(
+		names: list[str], sources: list, diarize: bool, result_format: str
+	):
+		"""JSON lines of `run_batch`, a result per file as it finishes."""
+		try:
+			async for item in worker.iterate(
+				run_batch, names, sources, diarize, result_format
+			):
+				yield item.model_dump_json() + '\n'
+		except Exception as e:
+			logger.error(f"Error in STT conversion: {e}")
+			yield json.dumps({'error': str(e)}) + '\n'
+
+	def input_path(path: str) -> str:
+		"""Resolve a server-side path, which has to be in stt_input_dir."""
+		input_dir = os.path.realpath(Args['stt_input_dir'])
+		full_path = os.path.realpath(os.path.join(input_dir, path))
+		if os.path.commonpath([input_dir, full_path]) != input_dir:
+			raise HTTPException(
+				status_code=400, detail=f'Not in stt_input_dir: {path}'
+			)
+		if not os.path.isfile(full_path):
+			raise HTTPException(
+				status_code=400, detail=f'File does not exist: {path}'
+			)
+		return full_path
+
+	def transcribe_utterance(
+		utterance: Utterance
+	) -> RealtimeTranscript:
+		return RealtimeTranscript(
+			final=utterance.final,
+			start=utterance.start,
+			end=utterance.end,
+			speech=manager.transcribe_audio(utterance.audio)
+		)
+
+	@app.websocket('/stt/v1/ws')
+	async def stt_ws(websocket: WebSocket):
+		"""Realtime transcription: send 16 kHz mono 16-bit PCM as binary frames, and `{"type": "end"}` to flush the last utterance. Partial and final RealtimeTranscripts are sent back as speech comes in.
+
+		Audio keeps being received while utterances are transcribed. Every
+		final is transcribed, in order, but of the partials that came in
+		meanwhile only the latest, so a slow model doesn't fall further and
+		further behind.
+		"""
+		await websocket.accept()
+		session = RealtimeSession()
+		finals: deque[Utterance] = deque()
+		# the latest partial still to transcribe, None once it's stale
+		partial: Union[Utterance, None] = None
+		pending = asyncio.Event()
+
+		async def transcribe_pending():
+			nonlocal partial
+			while True:
+				await pending.wait()
+				pending.clear()
+				while len(finals) > 0 or partial is not None:
+					if len(finals) > 0:
+						utterance = finals.popleft()
+					else:
+						utterance, partial = partial, None
+					try:
+						res = await worker.run(transcribe_utterance, utterance)
+					except Exception as e:
+						await websocket.send_json({'type': 'error', 'data': str(e)})
+						continue
+					await websocket.send_json({
+						'type': 'final' if utterance.final else 'partial',
+						'data': res.model_dump()
+					})
+
+		transcriber = asyncio.create_task(transcribe_pending())
+		try:
+			while not transcriber.done():
+				try:
+					message = await websocket.receive()
+				except Exception as e:
+					logger.error(e)
+					break
+				if message['type'] == 'websocket.disconnect':
+					break
+				if message.get('bytes') is not None:
+					utterances = session.feed(message['bytes'])
+				elif json.loads(message.get('text') or '{}').get('type') == 'end':
+					utterances = [session.flush()] if session.in_speech else []
+				else:
+					continue
+				for utterance in utterances:
+					if utterance.final:
+						finals.append(utterance)
+						partial = None  # of the same utterance
+					else:
+						partial = utterance
+				if len(utterances) > 0:
+					pending.set()
+		finally:
+			transcriber.cancel()
+
 	@app.post('/stt/v1/transcribe', tags=['stt'])
 	async def stt_convert(
 		file: UploadFile = File(None),
 		diarize: bool = Query(False),
-		result_format: str = Query('json')
+		result_format: str = Query('json'),
+		stream: bool = Query(False)
 	) -> TranscribeResponse:
 		"""
 		Convert speech to text.
+		With `stream`, TranscribeChunks are sent as server-sent events as
+		they're transcribed, ending with `[DONE]`.
 		"""
 		if file.filename is None or file.filename == '':
 			raise HTTPException(
 				status_code=400, detail="No file provided"
 			)
-		file_path = os.path.join(
-			Args['stt_input_dir'], file.filename
-		)
-		with open(file_path, 'wb') as f:
-			f.write(file.file.read())
-
-		if not file.content_type == 'audio/wav':
-			file_path = audio.convert_to_wav(file_path)
+		# the upload is decoded a window at a time as it's transcribed
+		if stream:
+			# FastAPI closes the upload once this returns, before the
+			#   response is sent, so the stream takes its file over
+			source = file.file
+			file.file = io.BytesIO()
+			return EventSourceResponse(stream_events(source, diarize))
 		try:
-			return transcribe(file_path, diarize, result_format)
+			return await worker.run(
+				transcribe, file.file, diarize, result_format
+			)
 		except Exception as e:
 			logger.error(f"Error in STT conversion: {e}")
 			raise HTTPException(status_code=500, detail=str(e))
+
+	@app.post('/stt/v1/transcribe/batch', tags=['stt'])
+	async def stt_convert_batch(
+		files: list[UploadFile] = File([]),
+		paths: list[str] = Query([]),
+		diarize: bool = Query(False),
+		result_format: str = Query('json'),
+		stream: bool = Query(False)
+	) -> BatchTranscribeResponse:
+		"""
+		Convert speech to text for many files: uploads, and/or `paths`
+		relative to stt_input_dir on the server. Files are decoded in
+		parallel and their speech shares the model's batches. Results are
+		returned in order, or with `stream` sent as JSON lines as each file
+		is done.
+		"""
+		names: list[str] = []
+		sources: list = []
+		for file in files:
+			names.append(file.filename or '')
+			sources.append(await file.read())
+		for path in paths:
+			names.append(path)
+			sources.append(input_path(path))
+		if len(sources) == 0:
+			raise HTTPException(
+				status_code=400, detail="No file provided"
+			)
+		if stream:
+			return StreamingResponse(
+				batch_lines(names, sources, diarize, result_format),
+				media_type='application/x-ndjson'
+			)
+		res = await worker.run(
+			transcribe_batch, names, sources, diarize, result_format
+		)
+		return JSONResponse(content=res.model_dump())
+
+	@app.get(
+		'/stt/v1/cache',
+		response_model=TranscriptCacheStats,
+		tags=['stt']
+	)
+	async def stt_cache_stats():
+		"""Transcript cache hits, misses and size. Re-submitting audio (e.g. for another result_format, or with diarize) reuses its cached transcript."""
+		return TranscriptCacheStats.model_validate(manager.cache_stats())
@@ -1,17 +1,20 @@
-import logging, os, time
+import json, logging, os, time
 from fastapi import FastAPI, HTTPException, Path, WebSocket
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from app.args import Args
 from app.client import tts_client_manager
 from app.models.common_api import GetModelResponse, ListModelsResponse, LoadModelResponse, UnloadModelResponse
-from app.models.tts.tts_api import SpeakRequest, SpeakToFileRequest, ListVoicesResponse
+from app.models.tts.tts_api import BatchSpeakItem, BatchSpeakRequest, BatchSpeakResponse, BatchSpeakStats, SpeakRequest, SpeakStreamRequest, SpeakToFileRequest, ListVoicesResponse, SpeakBinaryResponse, SpeakStreamStart, SpeakStreamEnd
 from app.models.tts.tts_client import SpeakResponse, SpeakToFileResponse
+from app.utils.audio import AUDIO_MEDIA_TYPES
+from app.utils.workers import get_worker
 
 EXTENSIONS = []
 logger = logging.getLogger(__name__)
 
 def tts_api(app: FastAPI):
 	manager = tts_client_manager.TTSManager.instance
+	worker = get_worker('tts')
 
 	def modelName():
 		if manager.model_name is not None:
@@ -36,7 +39,7 @@ def tts_api(app: FastAPI):
 					'time':
 					time.time() - start
 				})
-			manager.unload_model()
+		# the manager unloads least recently used models if this one doesn't fit
 		logger.debug(model_name)
 		try:
 			manager.load_model(model_name)
@@ -94,6 +97,18 @@ def tts_api(app: FastAPI):
 			res = {'error': str(e)}
 		return SpeakResponse.model_validate(res)
 
+	def speak_audio(
+		req: SpeakRequest
+	) -> tuple[bytes, SpeakBinaryResponse]:
+		if req.format not in AUDIO_MEDIA_TYPES:
+			raise Exception(f'Unsupported audio format: {req.format}')
+		start = time.time()
+		audio = manager.speak_audio(req)
+		return audio, SpeakBinaryResponse.model_validate({
+			'format': req.format,
+			'time': time.time() - start
+		})
+
 	def speak_to_file(
 		req: SpeakToFileRequest
 	) -> SpeakToFileResponse:
@@ -103,6 +118,78 @@ def tts_api(app: FastAPI):
 			res = {'error': str(e)}
 		return SpeakToFileResponse.model_validate(res)
 
+	def stream_start(req: SpeakStreamRequest) -> SpeakStreamStart:
+		if req.format not in AUDIO_MEDIA_TYPES:
+			raise Exception(f'Unsupported audio format: {req.format}')
+		loader = manager.loader or manager.load_model(None)
+		if loader is None:
+			raise Exception('Model not loaded.')
+		return SpeakStreamStart.model_validate({
+			'format': req.format,
+			'sample_rate': loader.sample_rate()
+		})
+
+	def media_type(start: SpeakStreamStart) -> str:
+		if start.format == 'pcm':
+			return f'{AUDIO_MEDIA_TYPES["pcm"]};rate={start.sample_rate};channels=1'
+		return AUDIO_MEDIA_TYPES[start.format]
+
+	async def stream_chunks(req: SpeakStreamRequest):
+		try:
+			async for chunk in worker.iterate(manager.speak_stream, req):
+				yield chunk
+		except Exception as e:
+			logger.error(e)
+
+	def batch_stats(
+		size: int, audio_duration: float, elapsed: float
+	) -> BatchSpeakStats:
+		return BatchSpeakStats.model_validate({
+			'size':
+			size,
+			'audio_duration':
+			audio_duration,
+			'time':
+			elapsed,
+			'real_time_factor':
+			elapsed / audio_duration if audio_duration > 0 else 0
+		})
+
+	def run_batch(reqs: list[SpeakToFileRequest]):
+		"""Yields a BatchSpeakItem per request as it's saved."""
+		for i, res in manager.speak_batch(reqs):
+			if isinstance(res, Exception):
+				yield BatchSpeakItem(index=i, error=str(res))
+			else:
+				yield BatchSpeakItem(index=i, result=res)
+
+	def speak_batch(reqs: list[SpeakToFileRequest]) -> BatchSpeakResponse:
+		start = time.time()
+		results = sorted(run_batch(reqs), key=lambda item: item.index)
+		return BatchSpeakResponse(
+			results=results,
+			stats=batch_stats(
+				len(reqs),
+				sum(r.result.duration for r in results if r.result),
+				time.time() - start
+			)
+		)
+
+	async def batch_lines(reqs: list[SpeakToFileRequest]):
+		"""JSON lines of `run_batch`: a result per request as it finishes, then `{"stats": stats}` for the whole run."""
+		start = time.time()
+		audio_duration = 0.0
+		try:
+			async for item in worker.iterate(run_batch, reqs):
+				if item.result is not None:
+					audio_duration += item.result.duration
+				yield item.model_dump_json() + '\n'
+		except Exception as e:
+			logger.error(e)
+			yield json.dumps({'error': str(e)}) + '\n'
+		stats = batch_stats(len(reqs), audio_duration, time.time() - start)
+		yield json.dumps({'stats': stats.model_dump()}) + '\n'
+
 	def list_voices() -> ListVoicesResponse:
 		voices = []
 		voices_dir = Args['tts_voices_dir']
@@ -110,7 +197,10 @@ def tts_api(app: FastAPI):
 		for file in os.listdir(voices_dir):
 			if file.endswith('.wav'):
 				voices.append(file)
-		return ListVoicesResponse.model_validate({'voices': voices})
+		return ListVoicesResponse.model_validate({
+			'voices': voices,
+			'cached': manager.cached_voices()
+		})
 
 	@app.websocket('/tts/v1/ws')
 	async def tts_ws(websocket: WebSocket):
@@ -126,7 +216,7 @@ def tts_api(app: FastAPI):
 		})
 
 		async def send_json(data):
-			return websocket.send_json(data)
+			return await websocket.send_json(data)
 
 		while True:
 			try:
@@ -137,23 +227,62 @@ def tts_api(app: FastAPI):
 				break
 			if data['type'] == 'speak':
 				req = SpeakRequest.model_validate(data['data'])
-				res = speak(req).model_dump()
+				if req.binary:
+					# json `speak` with the format, then the audio as a binary frame
+					try:
+						audio, res = await worker.run(speak_audio, req)
+					except Exception as e:
+						await send_json({'type': 'speak', 'data': {'error': str(e)}})
+						continue
+					await send_json({'type': 'speak', 'data': res.model_dump()})
+					await websocket.send_bytes(audio)
+					continue
+				res = (await worker.run(speak, req)).model_dump()
 				await send_json({'type': 'speak', 'data': res})
+			elif data['type'] == 'speak_stream':
+				# json `speak_stream_start`, the audio as binary frames, then json `speak_stream_end`
+				req = SpeakStreamRequest.model_validate(data['data'])
+				start = time.time()
+				first_chunk_time = 0.0
+				chunks = 0
+				try:
+					res = (await worker.run(stream_start, req)).model_dump()
+					await send_json({'type': 'speak_stream_start', 'data': res})
+					async for chunk in worker.iterate(manager.speak_stream, req):
+						if chunks == 0:
+							first_chunk_time = time.time() - start
+						chunks += 1
+						await websocket.send_bytes(chunk)
+				except Exception as e:
+					await send_json({
+						'type': 'speak_stream_end',
+						'data': {
+							'error': str(e)
+						}
+					})
+					continue
+				res = SpeakStreamEnd.model_validate({
+					'chunks': chunks,
+					'first_chunk_time': first_chunk_time,
+					'time': time.time() - start
+				}).model_dump()
+				await send_json({'type': 'speak_stream_end', 'data': res})
 			elif data['type'] == 'speak_to_file':
 				req = SpeakToFileRequest.model_validate(data['data'])
-				res = speak_to_file(req).model_dump()
+				res = (await worker.run(speak_to_file, req)).model_dump()
 				await send_json({'type': 'speak_to_file', 'data': res})
 			elif data['type'] == 'load_model':
 				req = data['data']
 				try:
-					res = load_model(req.model_name).model_dump()
+					res = (await worker.run(load_model,
+																	req.model_name)).model_dump()
 				except Exception as e:
 					res = {'error': str(e)}
 				await send_json({'type': 'load_model', 'data': res})
 			elif data['type'] == 'unload_model':
 				await send_json({
 					'type': 'unload_model',
-					'data': unload_model().model_dump()
+					'data': (await worker.run(unload_model)).model_dump()
 				})
 			elif data['type'] == 'get_model':
 				await send_json({
@@ -178,12 +307,49 @@ def tts_api(app: FastAPI):
 		'/tts/v1/speak', response_model=SpeakResponse, tags=['tts']
 	)
 	async def tts_speak(req: SpeakRequest):
-		"""Generate TTS audio from text."""
+		"""Generate TTS audio from text. With `binary` the response body is the audio in `format`, otherwise it's base64 in JSON."""
 		if manager.model_name is None:
 			raise HTTPException(
 				status_code=500, detail='Model not loaded.'
 			)
-		return speak(req).model_dump()
+		if req.binary:
+			try:
+				audio, res = await worker.run(speak_audio, req)
+			except Exception as e:
+				raise HTTPException(status_code=500, detail=str(e))
+			return Response(
+				content=audio,
+				media_type=AUDIO_MEDIA_TYPES[res.format],
+				headers={'X-Time': str(res.time)}
+			)
+		return (await worker.run(speak, req)).model_dump()
+
+	@app.post('/tts/v1/speak/stream', tags=['tts'])
+	async def tts_speak_stream(req: SpeakStreamRequest):
+		"""Generate TTS audio sentence by sentence, sending it as a chunked response as it's synthesized. `pcm` is raw 16-bit mono at the rate given in the content type, `wav` a single header followed by that PCM, `opus` and `mp3` one continuous encoder stream."""
+		try:
+			start = await worker.run(stream_start, req)
+		except Exception as e:
+			raise HTTPException(status_code=400, detail=str(e))
+		return StreamingResponse(
+			stream_chunks(req),
+			media_type=media_type(start),
+			headers={'X-Sample-Rate': str(start.sample_rate)}
+		)
+
+	@app.post(
+		'/tts/v1/speak/batch',
+		response_model=BatchSpeakResponse,
+		tags=['tts']
+	)
+	async def tts_speak_batch(req: BatchSpeakRequest):
+		"""Generate and save many utterances to files on server. Requests are grouped by voice and language and pipelined through the model; results are returned in request order, or with `stream` sent as JSON lines as each finishes. The real-time factor of the run is reported."""
+		if req.stream:
+			return StreamingResponse(
+				batch_lines(req.requests), media_type='application/x-ndjson'
+			)
+		res = await worker.run(speak_batch, req.requests)
+		return JSONResponse(content=res.model_dump())
 
 	@app.post(
 		'/tts/v1/speak-to-file',
@@ -196,7 +362,7 @@ def tts_api(app: FastAPI):
 			raise HTTPException(
 				status_code=500, detail='Model not loaded.'
 			)
-		return speak_to_file(req).model_dump()
+		return (await worker.run(speak_to_file, req)).model_dump()
 
 	@app.get(
 		'/tts/v1/model',
@@ -232,9 +398,8 @@ def tts_api(app: FastAPI):
 	)
 	async def tts_load_model(model_name: str):
 		"""Load a model by filename from tts_models_dir"""
-		return JSONResponse(
-			content=load_model(model_name).model_dump()
-		)
+		res = await worker.run(load_model, model_name)
+		return JSONResponse(content=res.model_dump())
 
 	@app.get(
 		'/tts/v1/model/unload',
@@ -243,7 +408,8 @@ def tts_api(app: FastAPI):
 	)
 	async def tts_unload_model():
 		"""Unload currently-loaded model"""
-		return JSONResponse(content=unload_model().model_dump())
+		res = await worker.run(unload_model)
+		return JSONResponse(content=res.model_dump())
 
 	@app.get('/tts/v1/play', tags=['tts'])
 	async def tts_play(file: str):
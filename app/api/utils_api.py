@@ -10,6 +10,7 @@ import magic
 import subprocess as sp
 from fastapi import FastAPI, HTTPException, UploadFile, File, Query
 from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
 from app.args import Args
 from app.models.utils_api import GetVRAMResponse
 from app.utils import audio
@@ -24,9 +25,9 @@ def utils_api(app: FastAPI):
 		Get VRAM usage.
 		"""
 		command = "nvidia-smi --query-gpu=gpu_name,memory.free,memory.total --format=csv"
-		memory_info = sp.check_output(
-			command.split()
-		).decode('ascii').split('\n')[:-1][1:]
+		# don't hold up the event loop on nvidia-smi
+		output = await run_in_threadpool(sp.check_output, command.split())
+		memory_info = output.decode('ascii').split('\n')[:-1][1:]
 		memory_values = memory_info[0].split(', ')
 		gpu_name = memory_values[0]
 		mem_free = int(memory_values[1].split()[0])
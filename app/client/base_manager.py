@@ -1,4 +1,22 @@
-from typing import Union
+from collections import OrderedDict
+from typing import Any, Union
+import logging, os, threading
+
+logger = logging.getLogger(__name__)
+
+class ResidentModel:
+	"""A model held in a manager's pool, with the loader instance that holds it."""
+	def __init__(
+		self, model_name: str, loader_name: str, loader: Any, nbytes: int
+	):
+		self.model_name = model_name
+		self.loader_name = loader_name
+		self.loader = loader
+		self.nbytes = nbytes  # estimated memory use
+		# held while the model serves a request its loader can't batch
+		self.lock = threading.Lock()
+		# requests using the model, it isn't unloaded while any are left
+		self.pins = 0
 
 class BaseAIManager:
 	_instance = None
@@ -8,6 +26,17 @@ class BaseAIManager:
 	loader_name: Union[str, None] = None
 	default_model: Union[str, None] = None
 	models_dir: Union[str, None] = None
+	# resident models, least recently used first
+	models: 'OrderedDict[str, ResidentModel]' = OrderedDict()
+	# bytes the resident models may use together, 0 keeps a single model
+	memory_budget = 0
+
+	def __init__(self):
+		self.models = OrderedDict()
+		self.pool_lock = threading.RLock()
+		# models taken out of the pool that are still unloading
+		self.releasing: list[ResidentModel] = []
+		self.released = threading.Condition(self.pool_lock)
 
 	@classmethod
 	@property
@@ -25,7 +54,106 @@ class BaseAIManager:
 	def get_default_model(self) -> str:
 		raise NotImplementedError()
 
+	def model_file_bytes(self, model_name: str) -> int:
+		"""Size on disk of a model file or directory in the models dir, 0 if it isn't there."""
+		models_dir = self.get_models_dir()
+		if not models_dir:
+			return 0
+		path = os.path.join(models_dir, model_name)
+		if os.path.isfile(path):
+			return os.path.getsize(path)
+		total = 0
+		for root, _, filenames in os.walk(path):
+			for filename in filenames:
+				total += os.path.getsize(os.path.join(root, filename))
+		return total
+
+	def memory_used(self) -> int:
+		return sum(m.nbytes for m in self.residents())
+
+	def residents(self) -> list[ResidentModel]:
+		return list(self.models.values()) + self.releasing
+
+	def list_loaded_models(self) -> list[str]:
+		return list(self.models.keys())
+
+	def new_loader(self, client_key: str) -> Any:
+		# the registered client holds the first model, others get their own instance
+		client_instance = self.clients.get(client_key)
+		if client_instance is None:
+			return None
+		if any(m.loader is client_instance for m in self.residents()):
+			return type(client_instance)()
+		return client_instance
+
+	def make_room(self, nbytes: int) -> list[ResidentModel]:
+		"""Take least recently used models out of the pool until `nbytes` more fits in the budget. Returns them for `release`."""
+		evicted = []
+		while len(self.models) > 0 and (
+			self.memory_budget <= 0
+			or self.memory_used() + nbytes > self.memory_budget
+		):
+			evicted.append(self.detach(next(iter(self.models))))
+		if self.memory_budget > 0 and nbytes > self.memory_budget:
+			logger.warning(
+				f'Model needs ~{nbytes >> 20}MiB, over the {self.memory_budget >> 20}MiB budget.'
+			)
+		return evicted
+
+	def fits(self, nbytes: int) -> bool:
+		"""Whether `nbytes` more can load while earlier models are still unloading."""
+		if len(self.releasing) == 0:
+			return True
+		return self.memory_budget > 0 and self.memory_used(
+		) + nbytes <= self.memory_budget
+
+	def detach(self, model_name: str) -> Union[ResidentModel, None]:
+		"""Take `model_name` out of the pool, call with `pool_lock` held and `release` it after letting go."""
+		resident = self.models.pop(model_name, None)
+		if resident is None:
+			return None
+		self.releasing.append(resident)
+		if self.model_name == model_name:
+			self.loader = None
+			self.loader_name = None
+			self.model_name = None
+		return resident
+
+	def unpin(self, resident: ResidentModel):
+		with self.released:
+			resident.pins -= 1
+			self.released.notify_all()
+
+	def wait_unpinned(self, resident: ResidentModel):
+		with self.released:
+			while resident.pins > 0:
+				self.released.wait()
+
+	def release(self, resident: ResidentModel):
+		"""Unload a detached model once its requests are done, without `pool_lock` so other models stay usable meanwhile."""
+		try:
+			self.wait_unpinned(resident)
+			logger.info(f'Unloading model {resident.model_name}')
+			resident.loader.unload_model()
+		finally:
+			with self.released:
+				self.releasing.remove(resident)
+				self.released.notify_all()
+
+	def evict(self, model_name: str):
+		with self.pool_lock:
+			resident = self.detach(model_name)
+		if resident is not None:
+			self.release(resident)
+
+	def activate(self, resident: ResidentModel):
+		self.models.move_to_end(resident.model_name)
+		self.loader = resident.loader
+		self.loader_name = resident.loader_name
+		self.model_name = resident.model_name
+
 	def load_model(self, model_name: Union[str, None]):
+		"""Make `model_name` the active model, loading it into the pool if it isn't resident. Returns its loader."""
 		if model_name is None or model_name == '':
 			# if self.default_model is None:
 			# 	raise Exception('No default model set')
@@ -33,23 +161,60 @@ class BaseAIManager:
 			if d is None:
 				raise Exception('No default model set')
 			model_name = d
-		if model_name == self.model_name:
-			return
-		print('Loading model', model_name)
-		client_key = self.pick_client(model_name)
-		client_instance = self.clients.get(client_key)
-		if client_instance:
-			self.loader_name = client_key
-			self.loader = client_instance
-			self.loader.load_model(model_name)
-			self.model_name = model_name
-
-	def unload_model(self):
-		if self.loader:
-			self.loader.unload_model()
-		self.loader = None
-		self.loader_name = None
-		self.model_name = None
+		resident = self.load_resident(model_name)
+		if resident is None:
+			return None
+		with self.pool_lock:
+			if self.models.get(model_name) is resident:
+				self.activate(resident)
+		return resident.loader
+
+	def load_resident(
+		self, model_name: str, pin=False
+	) -> Union[ResidentModel, None]:
+		"""The resident holding `model_name`, loaded into the pool if needed. With `pin` it stays loaded until `unpin`."""
+		while True:
+			with self.pool_lock:
+				resident = self.models.get(model_name)
+				if resident is not None:
+					self.models.move_to_end(model_name)
+					resident.pins += pin
+					return resident
+				client_key = self.pick_client(model_name)
+				loader = self.new_loader(client_key)
+				if loader is None:
+					return None
+				nbytes = loader.estimate_memory(
+					self.model_file_bytes(model_name)
+				)
+				evicted = self.make_room(nbytes)
+				if len(evicted) == 0:
+					if not self.fits(nbytes):
+						# wait for the models being unloaded to free their memory
+						self.released.wait()
+						continue
+					print('Loading model', model_name)
+					loader.load_model(model_name)
+					resident = ResidentModel(model_name, client_key, loader, nbytes)
+					resident.pins += pin
+					self.models[model_name] = resident
+					self.activate(resident)
+					return resident
+			for resident in evicted:
+				self.release(resident)
+
+	def unload_model(self, model_name: Union[str, None] = None):
+		"""Unload `model_name`, or every resident model if it's None."""
+		with self.pool_lock:
+			names = [model_name] if model_name else list(self.models)
+			evicted = [self.detach(name) for name in names]
+			if model_name is None:
+				self.loader = None
+				self.loader_name = None
+				self.model_name = None
+		for resident in evicted:
+			if resident is not None:
+				self.release(resident)
 
 	def list_models(self):
 		raise NotImplementedError()
@@ -1,4 +1,4 @@
-from typing import Generator, List, Dict, Union, Any
+from typing import Callable, Generator, List, Dict, Union, Any
 from pydantic import BaseModel
 from app.models.img.img_client import Txt2ImgOptions, Txt2ImgResponse
 from app.settings import DEVICE_MAP
@@ -11,6 +11,9 @@ class ImgClient_Base:
 	model = None
 	model_name: Union[str, None] = None
 	model_abspath: Union[str, None] = None
+	# estimate_memory: weights times factor, plus activations
+	memory_factor = 1.0
+	memory_overhead = 1 << 30
 
 	# OPTIONS_MAP: dict[str, str] = {}
 
@@ -62,6 +65,38 @@ class ImgClient_Base:
 	def unload_model(self):
 		raise NotImplementedError()
 
+	def estimate_memory(self, model_bytes: int) -> int:
+		"""Rough memory use of a loaded model whose files take `model_bytes` on disk."""
+		return int(model_bytes * self.memory_factor) + self.memory_overhead
+
+	def batch_key(self, gen_options: Txt2ImgOptions) -> tuple:
+		raise NotImplementedError()
+
+	def prepare(
+		self, gen_options: Txt2ImgOptions
+	) -> tuple[str, list[int]]:
+		raise NotImplementedError()
+
+	def generate_images(
+		self,
+		gen_options: Txt2ImgOptions,
+		items: list[tuple[str, str, int]],
+		on_step: Union[Callable[[int, Any], None], None] = None
+	) -> list[Any]:
+		raise NotImplementedError()
+
+	def preview_images(self, latents: Any) -> list[str]:
+		raise NotImplementedError()
+
+	def embedding_cache_stats(self) -> dict:
+		return {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0}
+
+	def image_response(
+		self, gen_options: Txt2ImgOptions, prompt: str, images: list[Any],
+		seeds: list[int]
+	) -> Txt2ImgResponse:
+		raise NotImplementedError()
+
 	def txt2img(
 		self, gen_options: Txt2ImgOptions
 	) -> Txt2ImgResponse:
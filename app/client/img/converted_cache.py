@@ -0,0 +1,73 @@
+from typing import Any, Union
+from uuid import uuid4
+import hashlib, json, logging, os, shutil, threading
+from app.args import Args
+from app.settings import IMG_CONVERTED_CACHE_DIR
+
+logger = logging.getLogger('Img-converted-cache')
+_index_lock = threading.Lock()
+
+def cache_dir() -> str:
+	return IMG_CONVERTED_CACHE_DIR or os.path.join(
+		Args['img_models_dir'], '.diffusers'
+	)
+
+def read_index(index_path: str) -> dict:
+	if not os.path.exists(index_path):
+		return {}
+	try:
+		with open(index_path, 'r') as f:
+			return json.load(f)
+	except Exception as e:
+		logger.error(f'Failed to read {index_path}: {e}')
+		return {}
+
+def file_hash(path: str) -> str:
+	"""sha256 of a checkpoint file, remembered in the cache dir by path, size and mtime so it's only read once (if the cache dir is writable)."""
+	stat = os.stat(path)
+	index_path = os.path.join(cache_dir(), 'hashes.json')
+	entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+	with _index_lock:
+		known = read_index(index_path).get(path)
+	if known is not None and all(known[k] == v for k, v in entry.items()):
+		return known['sha256']
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 24), b''):
+			h.update(block)
+	entry['sha256'] = h.hexdigest()
+	with _index_lock:
+		index = read_index(index_path)
+		index[path] = entry
+		try:
+			os.makedirs(cache_dir(), exist_ok=True)
+			with open(index_path, 'w') as f:
+				json.dump(index, f)
+		except Exception as e:
+			logger.error(f'Failed to write {index_path}: {e}')
+	return entry['sha256']
+
+def converted_path(path: str) -> Union[str, None]:
+	"""Folder for the diffusers-format conversion of the checkpoint at `path`, or None (logging why) if it can't be hashed."""
+	try:
+		return os.path.join(cache_dir(), file_hash(path))
+	except Exception as e:
+		logger.error(f'Failed to hash {path}: {e}')
+		return None
+
+def is_converted(folder: str) -> bool:
+	return os.path.isfile(os.path.join(folder, 'model_index.json'))
+
+def save_converted(pipeline: Any, folder: str):
+	"""Save a pipeline in diffusers format (safetensors, in its dtype) to `folder`, or log why not."""
+	tmp = f'{folder}.{uuid4().hex}.tmp'
+	try:
+		pipeline.save_pretrained(tmp, safe_serialization=True)
+		# another loader may have converted the same file meanwhile
+		if is_converted(folder):
+			shutil.rmtree(tmp)
+			return
+		os.replace(tmp, folder)
+	except Exception as e:
+		logger.error(f'Failed to save converted model to {folder}: {e}')
+		shutil.rmtree(tmp, ignore_errors=True)
@@ -1,10 +1,13 @@
 from io import BytesIO
-import base64, os
+import base64, logging, os
 import torch
-from typing import Union, List, Any, Dict
+from typing import Callable, Union, List, Any, Dict
 from app.args import Args
 from app.client.img.base import ImgClient_Base
+from app.client.img.converted_cache import converted_path, is_converted, save_converted
+from app.client.img.embedding_cache import EmbeddingCache
 from app.models.img.img_client import Txt2ImgOptions, Txt2ImgResponse
+from app.settings import IMG_FREEU
 from PIL import Image
 from diffusers.pipelines.auto_pipeline import AutoPipelineForText2Image
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion import StableDiffusionPipeline
@@ -12,19 +15,28 @@ from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl import
 from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl_img2img import StableDiffusionXLImg2ImgPipeline
 from diffusers.pipelines.stable_diffusion.pipeline_output import StableDiffusionPipelineOutput
 from diffusers.pipelines.pipeline_utils import DiffusionPipeline
-from diffusers.models.autoencoders.autoencoder_kl import AutoencoderKL
 from diffusers.schedulers.scheduling_dpmsolver_multistep import DPMSolverMultistepScheduler
 from diffusers.schedulers.scheduling_euler_ancestral_discrete import EulerAncestralDiscreteScheduler
 
+logger = logging.getLogger('Img-diffusers')
+
 SamplersUnion = Union[DPMSolverMultistepScheduler,
 											EulerAncestralDiscreteScheduler]
-SamplersDict = Dict[str, Union[SamplersUnion, None]]
+SamplersDict = Dict[str, SamplersUnion]
 
-samplers: SamplersDict = {
-	'dpm++ 2m': None,
-	'dpm++ 2m karras': None,
-	'euler a': None
-}
+# latent channels to RGB, a cheap approximation of the VAE decoder for previews
+LATENT_RGB_FACTORS = [
+	[0.3512, 0.2297, 0.3227],
+	[0.3250, 0.4974, 0.2350],
+	[-0.2829, 0.1762, 0.2721],
+	[-0.2120, -0.2616, -0.7177],
+]
+SDXL_LATENT_RGB_FACTORS = [
+	[0.3651, 0.4232, 0.4341],
+	[-0.2533, -0.0042, 0.1068],
+	[0.1076, 0.1111, -0.0362],
+	[-0.3165, -0.2492, -0.2188],
+]
 
 class ImgClient_Diffusers(ImgClient_Base):
 	device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -32,7 +44,13 @@ class ImgClient_Diffusers(ImgClient_Base):
 								StableDiffusionXLPipeline, None] = None
 	pipeline: Union[DiffusionPipeline, None] = None
 	default_config: Any = {}
+	# schedulers made from the loaded model's config, by lowercase name
+	samplers: SamplersDict = {}
 	current_sampler: str = ''
+	# FreeU parameters currently applied to the UNet
+	freeu: Union[Dict[str, float], None] = None
+	xl = False
+	embeddings: Union[EmbeddingCache, None] = None
 
 	def load_model(self, model_name: str):
 		if model_name is None or model_name == '':
@@ -43,45 +61,62 @@ class ImgClient_Diffusers(ImgClient_Base):
 		self.abspath = os.path.join(
 			Args['img_models_dir'], model_name
 		)
-		if 'xl' in model_name:
-			self.pipeline = StableDiffusionXLPipeline.from_single_file(
-				self.abspath,
-				variant="fp16",
-				load_safety_checker=False,
-				torch_dtype=torch.float16
-			)
+		self.xl = 'xl' in model_name
+		if self.xl:
 			print('Using SDXL pipeline')
-		else:
-			self.pipeline = StableDiffusionPipeline.from_single_file(
-				self.abspath,
-				variant="fp16",
-				load_safety_checker=False,
-				torch_dtype=torch.float16,
-				# scheduler_type='dpm'
-			)
+		self.pipeline = self.load_pipeline()
 		self.pipeline.to(self.device)
 		# self.pipeline.unet.set_default_attn_processor()
 
-		# use vae from model
-		vae = AutoencoderKL.from_single_file(
-			self.abspath, variant="fp16", torch_dtype=torch.float16
-		).to(self.device)
-		self.pipeline.vae = vae
-
 		self.default_config = self.pipeline.scheduler.config
-		samplers['dpm++ 2m'] = DPMSolverMultistepScheduler.from_config( # type: ignore
-			self.default_config
-		)
-		self.pipeline.scheduler = samplers['dpm++ 2m']
-		self.current_sampler = 'DPM++ 2M'
-
+		self.samplers = {}
+		self.freeu = None
+		self.embeddings = EmbeddingCache()
 		self.model = AutoPipelineForText2Image.from_pipe(
 			self.pipeline
 		)
+		self.current_sampler = ''
+		self.set_sampler('DPM++ 2M')
 		self.loaded = True
 
+	def load_pipeline(
+		self
+	) -> Union[StableDiffusionPipeline, StableDiffusionXLPipeline]:
+		"""The checkpoint's pipeline (with its own VAE), from its diffusers-format conversion if it was loaded before."""
+		pipeline_class = StableDiffusionPipeline
+		extra_args = {'safety_checker': None}
+		if self.xl:
+			pipeline_class = StableDiffusionXLPipeline
+			extra_args = {}
+		folder = converted_path(self.abspath)
+		if folder is not None and is_converted(folder):
+			try:
+				return pipeline_class.from_pretrained(
+					folder,
+					torch_dtype=torch.float16,
+					use_safetensors=True,
+					**extra_args
+				)
+			except Exception as e:
+				logger.error(f'Failed to load converted model {folder}: {e}')
+		pipeline = pipeline_class.from_single_file(
+			self.abspath,
+			variant="fp16",
+			load_safety_checker=False,
+			torch_dtype=torch.float16,
+			# scheduler_type='dpm'
+		)
+		if folder is not None:
+			save_converted(pipeline, folder)
+		return pipeline
+
 	def unload_model(self):
 		self.model = None
+		self.pipeline = None
+		self.samplers = {}
+		self.current_sampler = ''
+		self.freeu = None
+		self.embeddings = None
 		self.model_name = None
 		self.model_abspath = None
 		self.loaded = False
@@ -92,8 +127,7 @@ class ImgClient_Diffusers(ImgClient_Base):
 
 	def get_sampler(self, sampler_name: str) -> Any:
 		sampler_name = sampler_name.lower()
-		if samplers[sampler_name] is None:
-			sampler = None
+		if sampler_name not in self.samplers:
 			if sampler_name == 'dpm++ 2m':
 				sampler = DPMSolverMultistepScheduler.from_config(
 					self.default_config
@@ -106,12 +140,49 @@ class ImgClient_Diffusers(ImgClient_Base):
 				sampler = EulerAncestralDiscreteScheduler.from_config(
 					self.default_config
 				)
-			samplers[sampler_name] = sampler  # type: ignore
-		return samplers[sampler_name]
+			else:
+				raise Exception(f'Unknown sampler: {sampler_name}')
+			self.samplers[sampler_name] = sampler  # type: ignore
+		return self.samplers[sampler_name]
 
-	def txt2img(
+	def set_sampler(self, sampler_name: str):
+		"""Swap the pipeline's scheduler, made once per model and sampler."""
+		assert self.model is not None
+		if sampler_name.lower() == self.current_sampler:
+			return
+		self.model.scheduler = self.get_sampler(sampler_name)
+		self.current_sampler = sampler_name.lower()
+
+	def set_freeu(self, enabled: bool):
+		"""Enable or disable FreeU on the UNet, only when that changes."""
+		assert self.pipeline is not None
+		freeu = IMG_FREEU if enabled else None
+		if freeu == self.freeu:
+			return
+		if freeu is None:
+			self.pipeline.disable_freeu()
+		else:
+			self.pipeline.enable_freeu(**freeu)
+		self.freeu = freeu
+
+	def sampler_name(self, gen_options: Txt2ImgOptions) -> str:
+		if gen_options.sampler_name is None or gen_options.sampler_name == '':
+			return 'Euler a'
+		return gen_options.sampler_name
+
+	def batch_key(self, gen_options: Txt2ImgOptions) -> tuple:
+		"""Requests with the same key can share a UNet batch."""
+		return (
+			self.model_name, gen_options.width, gen_options.height,
+			self.sampler_name(gen_options).lower(),
+			gen_options.num_inference_steps, gen_options.guidance_scale,
+			gen_options.clip_skip, gen_options.freeu
+		)
+
+	def prepare(
 		self, gen_options: Txt2ImgOptions
-	) -> Txt2ImgResponse:
+	) -> tuple[str, list[int]]:
+		"""Check a request, returning its cleaned up prompt and the seed of each image."""
 		if not self.loaded:
 			self.load_model('')
 			if not self.loaded:
@@ -120,8 +191,13 @@ class ImgClient_Diffusers(ImgClient_Base):
 			raise Exception('No prompt provided.')
 		if gen_options.prompt == '':
 			raise Exception('No prompt provided.')
-		assert self.model is not None
-		assert self.pipeline is not None
+		if gen_options.batch_size < 1 or gen_options.n_iter < 1:
+			raise Exception('batch_size and n_iter must be at least 1.')
+		sampler_name = self.sampler_name(gen_options)
+		if sampler_name.lower() not in [
+			name.lower() for name in self.list_samplers()
+		]:
+			raise Exception(f'Unknown sampler: {sampler_name}')
 		prompt = gen_options.prompt
 		prompt = prompt.replace('\n', ' ')
 		prompt = prompt.replace('\r', ' ')
@@ -129,44 +205,141 @@ class ImgClient_Diffusers(ImgClient_Base):
 		prompt = prompt.replace('  ', ' ')
 		prompt = prompt.strip()
 
-		sampler_name = gen_options.sampler_name
-		if sampler_name is None or sampler_name == '':
-			sampler_name = 'Euler a'
-		if sampler_name != self.current_sampler:
-			sampler = self.get_sampler(sampler_name)
-			self.pipeline.scheduler = sampler
-			self.model = AutoPipelineForText2Image.from_pipe(
-				self.pipeline
-			)
-			self.current_sampler = sampler_name
-
 		seed = -1
 		if gen_options.seed is not None:
 			seed = gen_options.seed
+		if seed < 0:
+			seed = int(torch.randint(0, 2**32, (1, )).item())
+		count = gen_options.batch_size * gen_options.n_iter
+		return prompt, [(seed + i) % 2**32 for i in range(count)]
 
-		generator = torch.Generator(device=self.device)
-		if seed >= 0:
-			generator = generator.manual_seed(seed)
-		else:
-			ran = int(torch.randint(0, 2**32, (1, )).item())
-			generator = generator.manual_seed((ran))
-			seed = ran
+	def generate_images(
+		self,
+		gen_options: Txt2ImgOptions,
+		items: list[tuple[str, str, int]],
+		on_step: Union[Callable[[int, Any], None], None] = None
+	) -> list[Image.Image]:
+		"""Run one UNet batch of `(prompt, negative_prompt, seed)` items sharing the `batch_key` of `gen_options`.
 
-		# TODO option to enable freeu
-		self.pipeline.enable_freeu(s1=0.9, s2=0.2, b1=1.2, b2=1.4)
+		`on_step(step, latents)` is called after each denoising step, an
+		exception raised from it stops the batch.
+		"""
+		assert self.model is not None
+		self.set_sampler(self.sampler_name(gen_options))
+		self.set_freeu(gen_options.freeu)
 
-		opt = gen_options.model_dump()
-		res = self.model(generator=generator, **opt)
+		generators = [
+			torch.Generator(device=self.device).manual_seed(seed)
+			for _, _, seed in items
+		]
+		callback_kwargs = {}
+		if on_step is not None:
 
-		self.pipeline.disable_freeu()
-		img = res.images[0]  # type: ignore
-		assert isinstance(img, Image.Image)
-		imgb64 = 'data:image/png;base64,'
-		with BytesIO() as buffer:
-			img.save(buffer, 'png')
-			imgb64 += base64.b64encode(buffer.getvalue()).decode()
+			def callback(pipe, step: int, timestep: Any, tensors: dict):
+				on_step(step + 1, tensors['latents'])
+				return tensors
 
-		torch.cuda.empty_cache()
+			callback_kwargs = {'callback_on_step_end': callback}
+		res = self.model(
+			**self.batch_embeddings(items, gen_options.clip_skip),
+			num_inference_steps=gen_options.num_inference_steps,
+			guidance_scale=gen_options.guidance_scale,
+			width=gen_options.width,
+			height=gen_options.height,
+			generator=generators,
+			**callback_kwargs
+		)
+		images = res.images  # type: ignore
+		assert all(isinstance(img, Image.Image) for img in images)
+		return images
+
+	def encode_text(
+		self, text: str, clip_skip: int
+	) -> tuple[torch.Tensor, Union[torch.Tensor, None]]:
+		"""Run the text encoder(s) on one prompt: `(prompt_embeds, pooled_prompt_embeds)`, the pooled ones for SDXL only."""
+		assert self.model is not None
+		with torch.no_grad():
+			out = self.model.encode_prompt(
+				prompt=text,
+				device=self.device,
+				num_images_per_prompt=1,
+				do_classifier_free_guidance=False,
+				clip_skip=clip_skip
+			)
+		if self.xl:
+			return out[0], out[2]
+		return out[0], None
+
+	def prompt_embeddings(
+		self, prompt: str, clip_skip: int
+	) -> tuple[torch.Tensor, Union[torch.Tensor, None]]:
+		"""`encode_text` of a prompt, from the cache when it was seen before."""
+		# the tokenizer collapses whitespace too
+		text = ' '.join(prompt.split())
+		if self.embeddings is None:
+			return self.encode_text(text, clip_skip)
+		return self.embeddings.get(
+			(self.model_name, text, clip_skip),
+			lambda: self.encode_text(text, clip_skip)
+		)
+
+	def batch_embeddings(
+		self, items: list[tuple[str, str, int]], clip_skip: int
+	) -> dict[str, torch.Tensor]:
+		"""Pipeline arguments with the embeddings of a batch's prompts and negative prompts, in place of their text."""
+		prompts = [self.prompt_embeddings(p, clip_skip) for p, _, _ in items]
+		negatives = [
+			self.prompt_embeddings(n, clip_skip) for _, n, _ in items
+		]
+		kwargs = {
+			'prompt_embeds': torch.cat([e for e, _ in prompts]),
+			'negative_prompt_embeds': torch.cat([e for e, _ in negatives]),
+		}
+		if self.xl:
+			kwargs['pooled_prompt_embeds'] = torch.cat([
+				pooled for _, pooled in prompts
+			])
+			kwargs['negative_pooled_prompt_embeds'] = torch.cat([
+				pooled for _, pooled in negatives
+			])
+		return kwargs
+
+	def embedding_cache_stats(self) -> dict:
+		if self.embeddings is None:
+			return {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0}
+		return self.embeddings.stats()
+
+	def preview_images(self, latents: torch.Tensor) -> list[str]:
+		"""JPEG previews of in-progress latents, each latent pixel projected to RGB."""
+		factors = LATENT_RGB_FACTORS
+		if self.xl:
+			factors = SDXL_LATENT_RGB_FACTORS
+		weights = torch.tensor(
+			factors, dtype=torch.float32, device=latents.device
+		)
+		rgb = torch.einsum('bchw,cr->bhwr', latents.float(), weights)
+		pixels = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8)
+		previews = []
+		for array in pixels.cpu().numpy():
+			with BytesIO() as buffer:
+				Image.fromarray(array).save(buffer, 'jpeg', quality=80)
+				previews.append(
+					'data:image/jpeg;base64,' +
+					base64.b64encode(buffer.getvalue()).decode()
+				)
+		return previews
+
+	def image_response(
+		self, gen_options: Txt2ImgOptions, prompt: str,
+		images: list[Image.Image], seeds: list[int]
+	) -> Txt2ImgResponse:
+		encoded = []
+		for img in images:
+			imgb64 = 'data:image/png;base64,'
+			with BytesIO() as buffer:
+				img.save(buffer, 'png')
+				imgb64 += base64.b64encode(buffer.getvalue()).decode()
+			encoded.append(imgb64)
 
 		options = {
 			'prompt': prompt,
@@ -176,16 +349,34 @@ class ImgClient_Diffusers(ImgClient_Base):
 			'width': gen_options.width,
 			'height': gen_options.height,
 			'clip_skip': gen_options.clip_skip,
-			'seed': seed,
-			'sampler_name': sampler_name
+			'seed': seeds[0],
+			'sampler_name': self.sampler_name(gen_options),
+			'batch_size': gen_options.batch_size,
+			'n_iter': gen_options.n_iter,
+			'freeu': gen_options.freeu
 		}
 		return Txt2ImgResponse.model_validate({
-			'images': [imgb64],
-			'nsfw_content_detected': [False],
+			'images': encoded,
+			'nsfw_content_detected': [False] * len(encoded),
 			'info':
 			Txt2ImgOptions.model_validate(options)
 		})
 
+	def txt2img(
+		self, gen_options: Txt2ImgOptions
+	) -> Txt2ImgResponse:
+		prompt, seeds = self.prepare(gen_options)
+		images = []
+		batch_size = gen_options.batch_size
+		for i in range(0, len(seeds), batch_size):
+			images += self.generate_images(
+				gen_options, [
+					(prompt, gen_options.negative_prompt, seed)
+					for seed in seeds[i:i + batch_size]
+				]
+			)
+		return self.image_response(gen_options, prompt, images, seeds)
+
 	# def img2img(
 	# 	self, gen_options: Img2ImgOptions
 	# ) -> Img2ImgResponse:
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from typing import Any, Callable
+import threading
+from app.settings import IMG_EMBEDDING_CACHE_BYTES
+
+def tensors_nbytes(value: Any) -> int:
+	return sum(t.element_size() * t.nelement() for t in value if t is not None)
+
+class EmbeddingCache:
+	"""LRU store of text encoder outputs (prompt embeddings, and pooled embeddings for SDXL), keyed by model, prompt and clip_skip.
+
+	Entries stay on the device they were computed on, the least recently
+	used ones are dropped once they take more than `max_bytes`.
+	"""
+	def __init__(self, max_bytes: int = IMG_EMBEDDING_CACHE_BYTES):
+		self.max_bytes = max_bytes
+		# key -> (tensors, bytes), least recently used first
+		self.entries: OrderedDict[tuple, tuple[Any, int]] = OrderedDict()
+		self.used = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def stats(self) -> dict:
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'entries': len(self.entries),
+			'bytes': self.used,
+		}
+
+	def get(self, key: tuple, compute: Callable[[], Any]) -> Any:
+		"""The cached value for `key`, or `compute()` stored under it."""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry[0]
+			self.misses += 1
+		value = compute()
+		nbytes = tensors_nbytes(value)
+		if nbytes > self.max_bytes:
+			return value
+		with self.lock:
+			if key not in self.entries:
+				self.entries[key] = (value, nbytes)
+				self.used += nbytes
+			while self.used > self.max_bytes:
+				_, (_, evicted) = self.entries.popitem(last=False)
+				self.used -= evicted
+		return value
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.used = 0
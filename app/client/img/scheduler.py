@@ -0,0 +1,264 @@
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Iterator, Union
+import logging, queue, threading, time
+from app.models.img.img_client import Txt2ImgOptions, Txt2ImgProgress, Txt2ImgResponse
+from app.settings import IMG_MAX_BATCH_SIZE
+from .base import ImgClient_Base
+
+logger = logging.getLogger('Img-scheduler')
+
+class GenerationCancelled(Exception):
+	"""Raised for a request whose client cancelled it or went away."""
+	pass
+
+class ImgJob:
+	"""One txt2img request, whose images may be spread over several batches."""
+	def __init__(
+		self,
+		options: Txt2ImgOptions,
+		prompt: str,
+		seeds: list[int],
+		preview_steps: int = 0,
+		cancelled: Union[threading.Event, None] = None
+	):
+		self.options = options
+		self.prompt = prompt
+		self.seeds = seeds
+		self.preview_steps = preview_steps
+		self.images: list[Any] = [None] * len(seeds)
+		self.remaining = len(seeds)
+		self.started = 0.0  # when its first batch started
+		# set by the client (or `cancel`) to stop the request
+		self.cancelled = cancelled or threading.Event()
+		self.future: Future = Future()
+		# Txt2ImgProgress of a streamed request, then None
+		self.events: Union[queue.Queue, None] = None
+
+class ImgScheduler:
+	"""Batching scheduler in front of one loaded image model.
+
+	Each request is split into its images, which queue in arrival order. A
+	background thread runs the first waiting image together with the next
+	ones that have the same `loader.batch_key` (up to `max_batch_size`) as a
+	single UNet batch, each with its own seeded generator, and hands the
+	images back to their requests. Requests that came in during a batch meet
+	in the next one. Without `coalesce`, a batch only holds images of one
+	request, `batch_size` of them.
+	"""
+	def __init__(
+		self,
+		loader: ImgClient_Base,
+		max_batch_size=IMG_MAX_BATCH_SIZE,
+		coalesce=True
+	):
+		self.loader = loader
+		self.max_batch_size = max_batch_size
+		self.coalesce = coalesce
+		# (job, index of one of its images) still to generate
+		self.waiting: deque[tuple[ImgJob, int]] = deque()
+		self.cond = threading.Condition()
+		self.stopped = False
+		self.thread = threading.Thread(
+			target=self._loop, name='img-scheduler', daemon=True
+		)
+		self.thread.start()
+
+	def submit(
+		self,
+		options: Txt2ImgOptions,
+		stream=False,
+		preview_steps=0,
+		cancelled: Union[threading.Event, None] = None
+	) -> ImgJob:
+		prompt, seeds = self.loader.prepare(options)
+		job = ImgJob(options, prompt, seeds, preview_steps, cancelled)
+		if stream:
+			job.events = queue.Queue()
+		with self.cond:
+			if self.stopped:
+				raise Exception('Model unloaded.')
+			self.waiting.extend((job, i) for i in range(len(seeds)))
+			self.cond.notify()
+		return job
+
+	def txt2img(self, options: Txt2ImgOptions) -> Txt2ImgResponse:
+		return self.submit(options).future.result()
+
+	def txt2img_stream(
+		self,
+		options: Txt2ImgOptions,
+		preview_steps=0,
+		cancelled: Union[threading.Event, None] = None
+	) -> Iterator[Union[Txt2ImgProgress, Txt2ImgResponse]]:
+		"""Progress of a request as it's generated, then its response.
+
+		Setting `cancelled` (or closing the generator early) cancels the
+		request: its waiting images are dropped, and its batch stops at the
+		next step unless other requests share it.
+		"""
+		job = self.submit(
+			options,
+			stream=True,
+			preview_steps=preview_steps,
+			cancelled=cancelled
+		)
+		assert job.events is not None
+		try:
+			while True:
+				event = job.events.get()
+				if event is None:
+					break
+				yield event
+			yield job.future.result()
+		finally:
+			if not job.future.done():
+				self.cancel(job)
+
+	def cancel(self, job: ImgJob):
+		job.cancelled.set()
+		self._fail(job, GenerationCancelled('Cancelled.'))
+
+	def stop(self):
+		with self.cond:
+			self.stopped = True
+			self.cond.notify()
+		self.thread.join()
+
+	def _take(self) -> list[tuple[ImgJob, int]]:
+		"""Remove the next batch from `waiting` (called with `cond` held)."""
+		for job in {id(job): job for job, _ in self.waiting}.values():
+			if job.cancelled.is_set():
+				self._fail(job, GenerationCancelled('Cancelled.'))
+		if len(self.waiting) == 0:
+			return []
+		first = self.waiting[0][0]
+		if not self.coalesce:
+			batch = [item for item in self.waiting if item[0] is first]
+			batch = batch[:first.options.batch_size]
+			for item in batch:
+				self.waiting.remove(item)
+			return batch
+		key = self.loader.batch_key(first.options)
+		batch = []
+		keys: dict[int, tuple] = {}
+		for item in self.waiting:
+			if len(batch) >= self.max_batch_size:
+				break
+			job = item[0]
+			if id(job) not in keys:
+				keys[id(job)] = self.loader.batch_key(job.options)
+			if keys[id(job)] == key:
+				batch.append(item)
+		for item in batch:
+			self.waiting.remove(item)
+		return batch
+
+	def _loop(self):
+		while True:
+			with self.cond:
+				while not self.stopped and len(self.waiting) == 0:
+					self.cond.wait()
+				if self.stopped:
+					break
+				batch = self._take()
+			if len(batch) == 0:
+				continue
+			jobs = list({id(job): job for job, _ in batch}.values())
+			for job in jobs:
+				if job.started == 0:
+					job.started = time.time()
+			try:
+				images = self.loader.generate_images(
+					batch[0][0].options, [
+						(job.prompt, job.options.negative_prompt, job.seeds[i])
+						for job, i in batch
+					], self._on_step(batch, jobs) if any(
+						job.events is not None for job in jobs
+					) else None
+				)
+			except Exception as e:
+				if not isinstance(e, GenerationCancelled):
+					logger.error(f'Image batch failed: {e}')
+				for job in jobs:
+					self._fail(job, e)
+				continue
+			for (job, i), image in zip(batch, images):
+				job.images[i] = image
+				job.remaining -= 1
+				if job.remaining == 0:
+					self._finish(job)
+		for job, _ in list(self.waiting):
+			self._fail(job, Exception('Model unloaded.'))
+		self.waiting.clear()
+
+	def _on_step(
+		self, batch: list[tuple[ImgJob, int]], jobs: list[ImgJob]
+	) -> Callable[[int, Any], None]:
+		"""Step callback of a batch: stops it once all its requests are cancelled, and sends progress and previews to streamed ones."""
+		steps = batch[0][0].options.num_inference_steps
+
+		def on_step(step: int, latents: Any):
+			if all(job.cancelled.is_set() for job in jobs):
+				raise GenerationCancelled('Cancelled.')
+			previews = None
+			for job in jobs:
+				if job.events is None or job.cancelled.is_set():
+					continue
+				positions = [n for n, item in enumerate(batch) if item[0] is job]
+				done = len(job.seeds) - job.remaining
+				progress = (done + len(positions) * step / steps) / len(job.seeds)
+				elapsed = time.time() - job.started
+				event = Txt2ImgProgress(
+					step=step,
+					steps=steps,
+					progress=progress,
+					eta=elapsed / progress * (1 - progress) if progress > 0 else 0
+				)
+				if job.preview_steps > 0 and step < steps and (
+					step % job.preview_steps == 0
+				):
+					if previews is None:
+						previews = self.loader.preview_images(latents)
+					event.images = [batch[n][1] for n in positions]
+					event.previews = [previews[n] for n in positions]
+				job.events.put(event)
+
+		return on_step
+
+	def _resolve(
+		self,
+		job: ImgJob,
+		result: Union[Txt2ImgResponse, None] = None,
+		error: Union[Exception, None] = None
+	):
+		with self.cond:
+			# a cancel and the end of its last batch can race
+			if job.future.done():
+				return
+			if error is not None:
+				job.future.set_exception(error)
+			else:
+				job.future.set_result(result)
+		if job.events is not None:
+			job.events.put(None)
+
+	def _fail(self, job: ImgJob, error: Exception):
+		with self.cond:
+			# its other images needn't run
+			for item in [item for item in self.waiting if item[0] is job]:
+				self.waiting.remove(item)
+		self._resolve(job, error=error)
+
+	def _finish(self, job: ImgJob):
+		if job.cancelled.is_set():
+			self._resolve(job, error=GenerationCancelled('Cancelled.'))
+			return
+		try:
+			res = self.loader.image_response(
+				job.options, job.prompt, job.images, job.seeds
+			)
+		except Exception as e:
+			self._resolve(job, error=e)
+			return
+		self._resolve(job, result=res)
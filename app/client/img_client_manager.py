@@ -1,8 +1,11 @@
 from typing import Union, Dict
-import os
+import os, threading
 from app.args import Args
-from app.client.base_manager import BaseAIManager
+from app.client.base_manager import BaseAIManager, ResidentModel
 from app.client.img import ImgClient_Diffusers
+from app.client.img.scheduler import ImgScheduler
+from app.models.img.img_client import Txt2ImgStreamRequest
+from app.settings import IMG_BATCHING, MODEL_MEMORY_BUDGET
 
 ClientUnion = ImgClient_Diffusers
 ClientDict = Dict[str, ClientUnion]
@@ -15,11 +18,17 @@ class ImgManager(BaseAIManager):
 		'diffusers': ImgClient_Diffusers.instance,
 	}
 	loader: Union[ClientUnion, None] = None
+	# one scheduler per loaded model
+	schedulers: Dict[str, ImgScheduler] = {}
 
 	def __init__(self):
+		super().__init__()
 		self.clients = {
 			'diffusers': ImgClient_Diffusers.instance,
 		}
+		self.schedulers = {}
+		self.lock = threading.Lock()
+		self.memory_budget = MODEL_MEMORY_BUDGET.get('img', 0)
 		# self.default_model = Args['img_model']
 		# self.models_dir = Args['img_models_dir']
 
@@ -50,9 +59,53 @@ class ImgManager(BaseAIManager):
 			return []
 		return self.loader.list_samplers()
 
+	def embedding_cache_stats(self) -> dict:
+		"""Prompt embedding cache stats summed over the resident models."""
+		stats = {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0}
+		for resident in list(self.models.values()):
+			for key, value in resident.loader.embedding_cache_stats().items():
+				stats[key] += value
+		lookups = stats['hits'] + stats['misses']
+		stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.0
+		return stats
+
+	def release(self, resident: ResidentModel):
+		with self.lock:
+			scheduler = self.schedulers.get(resident.model_name)
+			# the model may be back in the pool with a new scheduler
+			if scheduler is not None and scheduler.loader is resident.loader:
+				del self.schedulers[resident.model_name]
+			else:
+				scheduler = None
+		if scheduler is not None:
+			scheduler.stop()
+		super().release(resident)
+
+	def get_scheduler(self, loader: ClientUnion) -> ImgScheduler:
+		assert loader.model_name is not None
+		with self.lock:
+			scheduler = self.schedulers.get(loader.model_name)
+			if scheduler is None:
+				scheduler = ImgScheduler(loader, coalesce=IMG_BATCHING)
+				self.schedulers[loader.model_name] = scheduler
+		return scheduler
+
 	def txt2img(self, gen_options):
-		if self.loader is None:
+		loader = self.loader
+		if loader is None:
+			raise Exception('No model loaded.')
+		return self.get_scheduler(loader).txt2img(gen_options)
+
+	def txt2img_stream(
+		self,
+		gen_options: Txt2ImgStreamRequest,
+		cancelled: Union[threading.Event, None] = None
+	):
+		loader = self.loader
+		if loader is None:
 			raise Exception('No model loaded.')
-		return self.loader.txt2img(gen_options)
+		return self.get_scheduler(loader).txt2img_stream(
+			gen_options, gen_options.preview_steps, cancelled
+		)
 
 	# def img2img(self, gen_options):
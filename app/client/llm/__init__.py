@@ -1,5 +1,6 @@
 from .base import LLMClient_Base
 from .exllamav2 import LLMClient_Exllamav2
+from .fake import LLMClient_Fake
 from .llamacpppython import LLMClient_LlamaCppPython
 from .openai import LLMClient_OpenAI
 from .transformers import LLMClient_Transformers
@@ -32,6 +32,7 @@ def text_completion(
 		'total_tokens'
 	] if has_usage and 'total_tokens' in result['usage'] else 0
 
+	usage = result['usage'] if has_usage else {}
 	return {
 		'id':
 		id,
@@ -47,8 +48,29 @@ def text_completion(
 			'finish_reason': finish_reason,
 		}],
 		'usage': {
+			**usage,
 			'prompt_tokens': prompt_tokens,
 			'completion_tokens': completion_tokens,
 			'total_tokens': total_tokens,
 		}
 	}
+
+def text_completion_chunk(
+	text_result: str,
+	id='',
+	created=0,
+	model_name='',
+	finish_reason=None
+):
+	# streamed counterpart of `text_completion`, every chunk of a stream shares `id` and `created`
+	return {
+		'id': id or uuid4().hex,
+		'object': 'text_completion.chunk',
+		'created': created or int(time.time()),
+		'model': model_name,
+		'choices': [{
+			'text': text_result,
+			'index': 0,
+			'finish_reason': finish_reason,
+		}],
+	}
@@ -1,11 +1,15 @@
+from collections import OrderedDict
 from typing import Generator, List, Dict, Union, Any
+import threading
 from app.models.llm.llm_api import CompletionReturn
 from app.models.llm.client import CompletionOptions, CompletionOptions_LlamaCppPython, CompletionOptions_Exllamav2
-from app.settings import DEVICE_MAP
+from app.settings import DEVICE_MAP, LLM_MAX_SEQ_LEN
+from .prefix_cache import PrefixCache
 
 class LLMClient_Base:
 	_instance = None
 	cache = None
+	prefix_cache: Union[PrefixCache, None] = None
 	config = None
 	device = DEVICE_MAP['llm']
 	tokenizer = None
@@ -16,6 +20,20 @@ class LLMClient_Base:
 	model_abspath: Union[str, None] = None
 
 	OPTIONS_MAP: dict[str, str] = {}
+	# (model_name, text) -> token count, see count_tokens_cached
+	token_counts: Union[OrderedDict, None] = None
+	token_counts_lock = threading.Lock()
+	TOKEN_COUNTS_SIZE = 4096
+	# whether the loader implements `batch_step` (see LLMScheduler)
+	supports_batching = False
+	# whether the loader's `complete_batch` runs requests together
+	supports_batch_complete = False
+	# whether the loader implements `load_draft_model`
+	supports_speculative = False
+	draft_model_name: Union[str, None] = None
+	# estimate_memory: weights times factor, plus kv cache & buffers
+	memory_factor = 1.0
+	memory_overhead = 1 << 30
 
 	@classmethod
 	@property
@@ -73,6 +91,10 @@ class LLMClient_Base:
 	def load_model(self, model_name: str):
 		raise NotImplementedError()
 
+	def estimate_memory(self, model_bytes: int) -> int:
+		"""Rough memory use of a loaded model whose files take `model_bytes` on disk."""
+		return int(model_bytes * self.memory_factor) + self.memory_overhead
+
 	def unload_model(self):
 		raise NotImplementedError()
 
@@ -80,7 +102,7 @@ class LLMClient_Base:
 		self, options: Union[CompletionOptions_LlamaCppPython,
 													CompletionOptions_Exllamav2]
 	) -> Generator:
-		"""(TODO) Generate text from a prompt. Returns a Generator."""
+		"""Generate text from a prompt. Returns a Generator that yields text chunks as they're produced, and returns the finish_reason ('stop' or 'length')."""
 		raise NotImplementedError()
 
 	def complete(
@@ -90,6 +112,65 @@ class LLMClient_Base:
 		"""Generate text from a prompt. Returns a string."""
 		raise NotImplementedError()
 
+	def complete_batch(self, options: List[Any]) -> List[Any]:
+		"""Complete several requests, in order."""
+		return [self.complete(o) for o in options]
+
+	def load_draft_model(self, model_name: str):
+		"""Load a small model from llm_models_dir to draft tokens for the loaded model to verify (speculative decoding)."""
+		raise NotImplementedError()
+
+	def unload_draft_model(self):
+		pass
+
+	def context_length(self) -> int:
+		"""Tokens the loaded model's context holds, prompt and completion together."""
+		return LLM_MAX_SEQ_LEN
+
+	def count_tokens(self, text: str) -> int:
+		"""Number of tokens in `text`, without BOS."""
+		raise NotImplementedError()
+
+	def count_tokens_cached(self, text: str) -> int:
+		"""`count_tokens`, remembered for text that comes back request after request (like a conversation's prior messages)."""
+		key = (self.model_name, text)
+		with self.token_counts_lock:
+			if self.token_counts is None:
+				self.token_counts = OrderedDict()
+			n = self.token_counts.get(key)
+			if n is not None:
+				self.token_counts.move_to_end(key)
+				return n
+		n = self.count_tokens(text)
+		with self.token_counts_lock:
+			self.token_counts[key] = n
+			while len(self.token_counts) > self.TOKEN_COUNTS_SIZE:
+				self.token_counts.popitem(last=False)
+		return n
+
+	def prefix_cache_stats(self) -> dict:
+		if self.prefix_cache is None:
+			return {}
+		return self.prefix_cache.stats()
+
+	def get_max_tokens(self, options: Any) -> int:
+		return options.max_tokens
+
+	def get_stop(self, options: Any) -> list[str]:
+		return options.stop or []
+
+	def batch_key(self, options: Any) -> Any:
+		"""Requests with equal keys may share a decode batch."""
+		return None
+
+	def batch_step(self, seqs: List[Any]) -> List[tuple[str, bool]]:
+		"""Generate one more token for each sequence, prefilling any that haven't started yet. Returns `(text, eos)` per sequence."""
+		raise NotImplementedError()
+
+	def batch_release(self, seq: Any):
+		"""Free whatever `batch_step` stored in `seq.state`."""
+		pass
+
 	def chat(
 		self, messages: List[Dict],
 		options: Union[CompletionOptions_LlamaCppPython,
@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Union
 import logging, os, time
 from app.args import Args
 from app.models.llm.client import CompletionOptions, CompletionOptions_Exllamav2
+from app.settings import LLM_DRAFT_TOKENS
 from .base import LLMClient_Base
+from .prefix_cache import PrefixCache, longest_common_prefix
 from exllamav2 import ExLlamaV2, ExLlamaV2Cache, ExLlamaV2Config, ExLlamaV2Tokenizer
 from exllamav2.generator import ExLlamaV2StreamingGenerator, ExLlamaV2Sampler
 import torch
@@ -17,6 +21,16 @@ class LLMClient_Exllamav2(LLMClient_Base):
 		'temp': 'temperature',
 		'repeat_pen': 'token_repetition_penalty',
 	}
+	# ExLlamaV2Cache in 0.0.11 holds one sequence length for its whole batch,
+	#   so sequences can't join or leave a running batch; requests are
+	#   serialized by the manager instead of going through the scheduler
+	supports_batching = False
+	supports_speculative = True
+	draft_model: Union[ExLlamaV2, None] = None
+	draft_cache: Union[ExLlamaV2Cache, None] = None
+	# finishes prefix saves off the generation path, see `_save_prefix`
+	save_pool: Union[ThreadPoolExecutor, None] = None
+	copy_stream: Any = None
 
 	def convert_options(
 		self, options: CompletionOptions
@@ -37,12 +51,12 @@ class LLMClient_Exllamav2(LLMClient_Base):
 			raise Exception(
 				f'Model {model_name} not found in {models_dir}.'
 			)
-		self.model_abspath = os.path.join(models_dir, model_name)
-		self.model_name = model_name
-
 		if self.loaded or self.model is not None:
 			self.unload_model()
 
+		self.model_abspath = os.path.join(models_dir, model_name)
+		self.model_name = model_name
+
 		if self.config is None:
 			cfg = ExLlamaV2Config()
 			cfg.model_dir = self.model_abspath
@@ -60,6 +74,11 @@ class LLMClient_Exllamav2(LLMClient_Base):
 			self.model, self.cache, self.tokenizer
 		)
 		self.generator.warmup()
+		self.prefix_cache = PrefixCache()
+		self.save_pool = ThreadPoolExecutor(1)
+		if self.device.type == 'cuda':
+			self.copy_stream = torch.cuda.Stream()
+		self.last_usage = {}
 
 		end = time.time()
 		logger.debug(
@@ -67,9 +86,75 @@ class LLMClient_Exllamav2(LLMClient_Base):
 		)
 		self.loaded = True
 
+	def load_draft_model(self, model_name: str):
+		if not self.loaded or self.model is None or self.config is None:
+			raise Exception('Load a model before its draft model.')
+		models_dir = Args['llm_models_dir']
+		path = os.path.join(models_dir, model_name)
+		if not os.path.isdir(path):
+			raise Exception(
+				f'Model {model_name} not found in {models_dir}.'
+			)
+		self.unload_draft_model()
+
+		logger.debug(f'Loading draft model {model_name}...')
+		start = time.time()
+		cfg = ExLlamaV2Config()
+		cfg.model_dir = path
+		cfg.prepare()
+		# the draft cache has to hold the same sequences as the model's
+		cfg.max_seq_len = self.config.max_seq_len
+		self.draft_model = ExLlamaV2(cfg, lazy_load=True)
+		self.draft_cache = ExLlamaV2Cache(self.draft_model, lazy=True)
+		self.draft_model.load_autosplit(self.draft_cache)
+		self.draft_model_name = model_name
+		self.generator = ExLlamaV2StreamingGenerator(
+			self.model,
+			self.cache,
+			self.tokenizer,
+			draft_model=self.draft_model,
+			draft_cache=self.draft_cache,
+			num_speculative_tokens=LLM_DRAFT_TOKENS
+		)
+		self.generator.warmup()
+		logger.debug(
+			f'Loaded draft model {model_name} in {time.time() - start}s'
+		)
+
+	def unload_draft_model(self):
+		if self.draft_model is None:
+			return
+		self.draft_model.unload()
+		self.draft_model = None
+		self.draft_cache = None
+		self.draft_model_name = None
+		if self.model is not None and self.cache is not None:
+			self.cache.current_seq_len = 0
+			self.generator = ExLlamaV2StreamingGenerator(
+				self.model, self.cache, self.tokenizer
+			)
+		torch.cuda.empty_cache()
+
+	def context_length(self) -> int:
+		if self.config is None:
+			return super().context_length()
+		return self.config.max_seq_len
+
+	def count_tokens(self, text: str) -> int:
+		if self.tokenizer is None:
+			raise Exception('No model loaded.')
+		return self.tokenizer.encode(text).shape[-1]
+
+	def draft_stats(self) -> tuple[int, int]:
+		"""Draft tokens proposed and accepted by the generator so far."""
+		drafted = getattr(self.generator, 'total_draft_tokens', 0)
+		accepted = getattr(self.generator, 'accepted_draft_tokens', 0)
+		return drafted, accepted
+
 	def unload_model(self):
 		if self.model is None:
 			return
+		self.unload_draft_model()
 		self.model.unload()
 		logger.debug('Unloaded model.')
 		self.model = None
@@ -79,13 +164,17 @@ class LLMClient_Exllamav2(LLMClient_Base):
 		self.config = None
 		self.tokenizer = None
 		self.generator = None
+		if self.save_pool is not None:
+			self.save_pool.shutdown(wait=True)
+		self.save_pool = None
+		self.copy_stream = None
+		if self.prefix_cache is not None:
+			self.prefix_cache.clear()
+		self.prefix_cache = None
 		self.loaded = False
 		torch.cuda.empty_cache()
 
-	def generate(self, options: CompletionOptions_Exllamav2):
-		if not self.loaded or self.model is None or self.generator is None or self.tokenizer is None or self.cache is None:
-			raise Exception('Re-load model.')
-
+	def sampler_settings(self, options: CompletionOptions_Exllamav2):
 		settings = ExLlamaV2Sampler.Settings()
 		settings.temperature = options.temperature
 		settings.top_p = options.top_p
@@ -95,12 +184,107 @@ class LLMClient_Exllamav2(LLMClient_Base):
 		settings.disallow_tokens(
 			self.tokenizer, []
 		)  # would ban eos token here?
+		return settings
+
+	def _restore_prefix(
+		self, cache: ExLlamaV2Cache, ids: torch.Tensor, reused=0
+	) -> int:
+		"""Copy the longest cached prefix of `ids` into `cache`, if it's longer than the `reused` tokens already there. Returns how many tokens of `ids` the cache holds."""
+		# the draft model's cache would have to be restored alongside
+		if self.prefix_cache is None or self.draft_model is not None:
+			return reused
+		value, matched = self.prefix_cache.lookup(ids[0].tolist())
+		if value is None or matched <= reused:
+			return reused
+		for i in range(len(cache.key_states)):
+			cache.key_states[i][:, :matched].copy_(
+				value['keys'][i][:, :matched], non_blocking=True
+			)
+			cache.value_states[i][:, :matched].copy_(
+				value['values'][i][:, :matched], non_blocking=True
+			)
+		cache.current_seq_len = matched
+		return matched
+
+	def _save_prefix(self, cache: ExLlamaV2Cache, ids: torch.Tensor):
+		"""Save the block-aligned prefix of the sequence in `cache`, unless the prefix cache already holds it.
+
+		On CUDA the copy to pinned memory is queued on a side stream that the
+		next generation's kernels wait for, and the entry is only added once a
+		background thread sees it finish, so this doesn't block the caller.
+		"""
+		if self.prefix_cache is None or self.draft_model is not None or self.save_pool is None:
+			return
+		block_size = self.prefix_cache.block_size
+		n = cache.current_seq_len // block_size * block_size
+		if n == 0:
+			return
+		tokens = ids[0, :n].tolist()
+		if self.prefix_cache.cached_length(tokens) >= n:
+			return
+		if self.copy_stream is None:
+			value = {
+				'keys': [k[:, :n].to('cpu', copy=True) for k in cache.key_states],
+				'values':
+				[v[:, :n].to('cpu', copy=True) for v in cache.value_states],
+			}
+			self.save_pool.submit(self._put_prefix, tokens, value)
+			return
+		main_stream = torch.cuda.current_stream()
+		self.copy_stream.wait_stream(main_stream)
+		with torch.cuda.stream(self.copy_stream):
+			value = {
+				'keys': [self._pinned_copy(k[:, :n]) for k in cache.key_states],
+				'values':
+				[self._pinned_copy(v[:, :n]) for v in cache.value_states],
+			}
+			done = self.copy_stream.record_event()
+		# the next sequence overwrites the cache, so it waits for the copy
+		main_stream.wait_stream(self.copy_stream)
+		self.save_pool.submit(self._put_prefix, tokens, value, done)
+
+	def _pinned_copy(self, t: torch.Tensor) -> torch.Tensor:
+		out = torch.empty(t.shape, dtype=t.dtype, device='cpu', pin_memory=True)
+		out.copy_(t, non_blocking=True)
+		return out
+
+	def _put_prefix(self, tokens: list[int], value: dict, done: Any = None):
+		try:
+			if done is not None:
+				done.synchronize()
+			nbytes = sum(
+				t.numel() * t.element_size()
+				for t in value['keys'] + value['values']
+			)
+			if self.prefix_cache is not None:
+				self.prefix_cache.put(tokens, value, nbytes)
+		except Exception as e:
+			logger.error(f'Failed to save prefix: {e}')
+
+	def generate(self, options: CompletionOptions_Exllamav2):
+		if not self.loaded or self.model is None or self.generator is None or self.tokenizer is None or self.cache is None:
+			raise Exception('Re-load model.')
+
+		settings = self.sampler_settings(options)
 
 		start = time.time()
 
 		input_ids = self.tokenizer.encode(options.prompt)
 		input_ids.to(self.device)
 
+		# begin_stream reuses whatever prefix the generator's last sequence
+		#   shares with this one, so load a longer one into the cache if we have it
+		reused = 0
+		if self.generator.sequence_ids is not None and self.cache.current_seq_len > 0:
+			reused = longest_common_prefix(
+				self.generator.sequence_ids[0, :self.cache.current_seq_len].tolist(),
+				input_ids[0].tolist()
+			)
+		covered = self._restore_prefix(self.cache, input_ids, reused)
+		if covered > reused:
+			self.generator.sequence_ids = input_ids[:, :covered]
+		drafted, accepted = self.draft_stats()
+
 		if options.stop:
 			self.generator.set_stop_conditions(options.stop)
 		self.generator.begin_stream(input_ids, settings)
@@ -112,9 +296,19 @@ class LLMClient_Exllamav2(LLMClient_Base):
 			if eos or generated_tokens >= options.max_tokens:
 				break
 			yield chunk
+		finish_reason = 'stop' if eos else 'length'
 
+		self._save_prefix(self.cache, self.generator.sequence_ids)
+		total_drafted, total_accepted = self.draft_stats()
+		self.last_usage = {
+			'prompt_tokens': input_ids.shape[-1],
+			'cached_tokens': min(covered, input_ids.shape[-1] - 1),
+			'draft_tokens': total_drafted - drafted,
+			'accepted_draft_tokens': total_accepted - accepted,
+		}
 		end = time.time()
 		logger.debug(f'Generated text in {end - start}s')
+		return finish_reason
 
 	def complete(self, options: CompletionOptions_Exllamav2):
 		if not self.loaded or self.model is None:
@@ -128,6 +322,12 @@ class LLMClient_Exllamav2(LLMClient_Base):
 
 		r = text_completion(
 			result,
+			result={
+				'usage': {
+					**self.last_usage,
+					**self.prefix_cache_stats(),
+				}
+			},
 			model_name=self.model_name or '',
 			tokens=tokens,
 			max_tokens=options.max_tokens
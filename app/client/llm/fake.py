@@ -0,0 +1,82 @@
+import logging, time
+from app.models.llm.client import CompletionOptions, CompletionOptions_Fake
+from .base import LLMClient_Base
+from ._utils import text_completion
+
+logger = logging.getLogger('Fake-client')
+
+class LLMClient_Fake(LLMClient_Base):
+	"""CPU-only stand-in for a real loader, used to exercise the manager and scheduler without a model.
+
+	The "model" echoes the prompt back one character (token) per step, then
+	emits eos. Load it with a model name like `fake:echo`.
+	"""
+	device = 'cpu'
+	supports_batching = True
+	# seconds to sleep per batch_step, to simulate a forward pass
+	step_delay = 0.0
+	# size of each batch passed to batch_step, for inspecting the scheduler
+	batch_sizes: list[int] = []
+	# what estimate_memory reports for any fake model, for exercising the model pool
+	memory_overhead = 1 << 30
+
+	def convert_options(
+		self, options: CompletionOptions
+	) -> CompletionOptions_Fake:
+		new_options = self.map_options_from_model(
+			options, CompletionOptions_Fake
+		)
+		assert isinstance(new_options, CompletionOptions_Fake)
+		return new_options
+
+	def load_model(self, model_name: str):
+		self.model_name = model_name
+		self.batch_sizes = []
+		self.loaded = True
+
+	def unload_model(self):
+		self.model_name = None
+		self.loaded = False
+
+	def count_tokens(self, text: str) -> int:
+		# one token per character, same as generate
+		return len(text)
+
+	def generate(self, options: CompletionOptions_Fake):
+		if not self.loaded:
+			raise Exception('No model loaded.')
+		for c in options.prompt[:options.max_tokens]:
+			time.sleep(self.step_delay)
+			yield c
+		return 'length' if len(options.prompt) > options.max_tokens else 'stop'
+
+	def complete(self, options: CompletionOptions_Fake):
+		result = ''.join(self.generate(options))
+		r = text_completion(
+			result,
+			model_name=self.model_name or '',
+			tokens=len(result),
+			max_tokens=options.max_tokens
+		)
+		return {
+			'result': r,
+			'params': options.model_dump(),
+		}
+
+	def batch_step(self, seqs):
+		if not self.loaded:
+			raise Exception('No model loaded.')
+		self.batch_sizes.append(len(seqs))
+		time.sleep(self.step_delay)
+		out = []
+		for seq in seqs:
+			if seq.state is None:
+				seq.prompt_tokens = len(seq.options.prompt)
+				seq.state = {'pos': 0}
+			pos = seq.state['pos']
+			if pos >= len(seq.options.prompt):
+				out.append(('', True))
+				continue
+			seq.state['pos'] += 1
+			out.append((seq.options.prompt[pos], False))
+		return out
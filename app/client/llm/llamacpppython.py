@@ -2,10 +2,15 @@ from typing import Union
 import logging, os, time
 from app.args import Args
 from app.models.llm.client import CompletionOptions, CompletionOptions_LlamaCppPython
+from app.settings import LLM_DRAFT_TOKENS, LLM_MAX_SEQ_LEN
 from app.utils.llm_models import parse_size_and_quant
 from .base import LLMClient_Base
+from .prefix_cache import PrefixCache
 from ._utils import text_completion
-from llama_cpp import Llama, LlamaGrammar, LlamaCache
+from llama_cpp import Llama, LlamaGrammar
+from llama_cpp.llama_cache import BaseLlamaCache
+from llama_cpp.llama_speculative import LlamaDraftModel
+import numpy as np
 import torch
 
 logger = logging.getLogger('LlamaCpp-client')
@@ -21,10 +26,74 @@ def LlamaCppConfig(model_path):
 		'n_threads': 8,
 		'n_gpu_layers': 49,  # TODO calc from size and quant
 		'n_ctx':
-		4096,  # TODO: docs say 0 = from model -- does it work?
+		LLM_MAX_SEQ_LEN,  # TODO: docs say 0 = from model -- does it work?
 		'verbose': True,  # setting LLM_VERBOSE ?
 	}
 
+class LlamaPrefixCache(BaseLlamaCache):
+	"""Lets `Llama` save and restore its states through our PrefixCache."""
+	def __init__(self, prefix_cache: PrefixCache):
+		super().__init__(prefix_cache.ram_bytes)
+		self.prefix_cache = prefix_cache
+		# matched prefix length of the last lookup
+		self.last_match = 0
+
+	@property
+	def cache_size(self):
+		return self.prefix_cache.ram_used
+
+	def __getitem__(self, key):
+		value, matched = self.prefix_cache.lookup(list(key))
+		self.last_match = matched
+		if value is None:
+			raise KeyError('Key not found')
+		return value
+
+	def __contains__(self, key) -> bool:
+		return key in self.prefix_cache
+
+	def __setitem__(self, key, value):
+		self.prefix_cache.put(list(key), value, value.llama_state_size)
+
+class LlamaModelDraft(LlamaDraftModel):
+	"""Drafts tokens for `Llama(draft_model=...)` by greedy decoding with a smaller model."""
+	def __init__(self, model: Llama, num_pred_tokens=LLM_DRAFT_TOKENS):
+		self.model = model
+		self.num_pred_tokens = num_pred_tokens
+		# verification passes and tokens drafted for them, see `accepted`
+		self.calls = 0
+		self.drafted = 0
+
+	def reset_stats(self):
+		self.calls = 0
+		self.drafted = 0
+
+	def accepted(self, completion_tokens: int) -> int:
+		# every verification pass yields the accepted draft tokens plus one
+		#   token sampled by the model itself
+		return max(0, min(self.drafted, completion_tokens - self.calls))
+
+	def __call__(self, input_ids: np.ndarray, **kwargs) -> np.ndarray:
+		tokens = input_ids.tolist()
+		self.calls += 1
+		if len(tokens) + self.num_pred_tokens > self.model.n_ctx():
+			return np.array([], dtype=np.intc)
+		# keep whatever the draft context shares with the model's
+		n_past = Llama.longest_token_prefix(
+			self.model._input_ids.tolist(), tokens
+		)
+		self.model.n_tokens = min(n_past, len(tokens) - 1)
+		self.model.eval(tokens[self.model.n_tokens:])
+		draft = []
+		for _ in range(self.num_pred_tokens):
+			token = int(np.argmax(self.model.scores[self.model.n_tokens - 1]))
+			if token == self.model.token_eos():
+				break
+			draft.append(token)
+			self.model.eval([token])
+		self.drafted += len(draft)
+		return np.array(draft, dtype=np.intc)
+
 def LlamaCppCompletionConfig(
 	prompt: str, max_tokens: int, temperature: Union[int, float],
 	top_p: int, repetition_penalty: Union[int, float], seed: int,
@@ -52,6 +121,8 @@ class LLMClient_LlamaCppPython(LLMClient_Base):
 		'tfs': 'tfs_z',
 		'repeat_pen': 'repeat_penalty',
 	}
+	supports_speculative = True
+	draft: Union[LlamaModelDraft, None] = None
 
 	def convert_options(
 		self, options: CompletionOptions
@@ -83,14 +154,15 @@ class LLMClient_LlamaCppPython(LLMClient_Base):
 			raise Exception(
 				f'Model {model_name} not found in {models_dir}.'
 			)
+		if self.loaded or self.model is not None:
+			self.unload_model()
+
 		self.model_abspath = os.path.join(models_dir, model_name)
 		self.model_name = model_name
-		self.cache = LlamaCache()
+		self.prefix_cache = PrefixCache()
+		self.cache = LlamaPrefixCache(self.prefix_cache)
 		self.config = LlamaCppConfig(self.model_abspath)
 
-		if self.loaded or self.model is not None:
-			self.unload_model()
-
 		logger.debug(f'Loading model {self.model_name}...')
 		start = time.time()
 		self.model = Llama(**self.config)
@@ -101,7 +173,71 @@ class LLMClient_LlamaCppPython(LLMClient_Base):
 		)
 		self.loaded = True
 
+	def load_draft_model(self, model_name: str):
+		if not self.loaded or self.model is None or self.config is None:
+			raise Exception('Load a model before its draft model.')
+		models_dir = Args['llm_models_dir']
+		path = os.path.join(models_dir, model_name)
+		if not os.path.isfile(path):
+			raise Exception(
+				f'Model {model_name} not found in {models_dir}.'
+			)
+		self.unload_draft_model()
+
+		logger.debug(f'Loading draft model {model_name}...')
+		start = time.time()
+		config = LlamaCppConfig(path)
+		# the draft context has to hold the same sequences as the model's
+		config['n_ctx'] = self.config['n_ctx']
+		config['verbose'] = False
+		self.draft = LlamaModelDraft(Llama(**config))
+		# verifying a draft reads the logits of every drafted position, which
+		#   only a context built with a draft model (logits_all) keeps
+		self.reload_model(self.draft)
+		self.draft_model_name = model_name
+		logger.debug(
+			f'Loaded draft model {model_name} in {time.time() - start}s'
+		)
+
+	def context_length(self) -> int:
+		if self.model is None:
+			return super().context_length()
+		return self.model.n_ctx()
+
+	def count_tokens(self, text: str) -> int:
+		if self.model is None:
+			raise Exception('No model loaded.')
+		return len(
+			self.model.tokenize(
+				text.encode('utf-8'), add_bos=False, special=True
+			)
+		)
+
+	def reload_model(self, draft: Union[LlamaModelDraft, None]):
+		"""Rebuild the model's context with or without `draft`."""
+		assert self.config is not None and self.cache is not None
+		self.model = None
+		# saved states are tied to the context they came from
+		if self.prefix_cache is not None:
+			self.prefix_cache.clear()
+		self.model = Llama(**self.config, draft_model=draft)
+		self.model.set_cache(self.cache)
+
+	def unload_draft_model(self):
+		if self.draft is None:
+			return
+		self.draft = None
+		self.draft_model_name = None
+		if self.model is not None:
+			self.reload_model(None)
+
 	def unload_model(self):
+		self.draft = None
+		self.draft_model_name = None
+		if self.prefix_cache is not None:
+			self.prefix_cache.clear()
+		self.prefix_cache = None
+		self.cache = None
 		torch.cuda.empty_cache()
 		logger.debug('Unloaded model.')
 		self.model = None
@@ -127,6 +263,25 @@ class LLMClient_LlamaCppPython(LLMClient_Base):
 			'params': o,
 		}
 
+	def generate(self, options: CompletionOptions_LlamaCppPython):
+		if not self.loaded or self.model is None:
+			raise Exception('No model loaded.')
+		assert isinstance(options, CompletionOptions_LlamaCppPython)
+		start = time.time()
+		o = options.model_dump()
+		o = {k: v for k, v in o.items() if v is not None}
+		o['stream'] = True
+
+		finish_reason = 'stop'
+		for chunk in self.model.create_completion(**o):
+			choice = chunk['choices'][0]  # type: ignore
+			if choice.get('finish_reason'):
+				finish_reason = choice['finish_reason']
+			yield choice['text']
+		end = time.time()
+		logger.debug(f'Generated text in {end - start}s')
+		return finish_reason
+
 	def complete(self, options: CompletionOptions_LlamaCppPython):
 		if not self.loaded or self.model is None:
 			raise Exception('No model loaded.')
@@ -135,9 +290,31 @@ class LLMClient_LlamaCppPython(LLMClient_Base):
 		o = options.model_dump()
 		o = {k: v for k, v in o.items() if v is not None}
 
+		# prompt tokens that won't be evaluated: either still in the context
+		#   from the last request or restored from the prefix cache
+		tokens = self.model.tokenize(
+			options.prompt.encode('utf-8'), special=True
+		)
+		in_context = Llama.longest_token_prefix(
+			self.model._input_ids.tolist(), tokens
+		)
+		assert isinstance(self.cache, LlamaPrefixCache)
+		self.cache.last_match = 0
+		if self.draft is not None:
+			self.draft.reset_stats()
 		result = self.model.create_completion(**o)
 		end = time.time()
 		logger.debug(f'Generated text in {end - start}s')
+		assert isinstance(result, dict)
+		result['usage']['cached_tokens'] = min(
+			max(in_context, self.cache.last_match), len(tokens)
+		)
+		result['usage'].update(self.prefix_cache_stats())
+		if self.draft is not None:
+			result['usage']['draft_tokens'] = self.draft.drafted
+			result['usage']['accepted_draft_tokens'] = self.draft.accepted(
+				result['usage']['completion_tokens']
+			)
 		return {
 			'result': result,
 			'params': o,
@@ -1,4 +1,5 @@
 from typing import Generator, List, Dict, Union
+import json
 import requests
 from app.models.llm.llm_api import CompletionResult
 from app.models.llm.client import CompletionOptions, CompletionOptions_LlamaCppPython, CompletionOptions_Exllamav2, CompletionOptions_OpenAI
@@ -39,6 +40,26 @@ class LLMClient_OpenAI(LLMClient_Base):
 		# response.raise_for_status()
 		return response.json()
 
+	def _api_post_stream(self, url: str, body: dict) -> Generator:
+		headers = {
+			"Authorization": f"Bearer {self.key}",
+			"Content-Type": "application/json"
+		}
+		with requests.post(
+			url, json=body, headers=headers, stream=True
+		) as response:
+			if response.status_code != 200:
+				error = response.json().get('error', {})
+				raise Exception(error.get('message', response.text))
+			# each event is a line like `data: {...}`, ending with `data: [DONE]`
+			for line in response.iter_lines(decode_unicode=True):
+				if not line or not line.startswith('data: '):
+					continue
+				data = line[len('data: '):]
+				if data == '[DONE]':
+					break
+				yield json.loads(data)
+
 	def list_models(self) -> list[str]:
 		url = "https://api.openai.com/v1/models"
 		res = self._api_get(url)
@@ -74,23 +95,11 @@ class LLMClient_OpenAI(LLMClient_Base):
 	def unload_model(self):
 		raise NotImplementedError()
 
-	def generate(
-		self, options: Union[CompletionOptions_LlamaCppPython,
-													CompletionOptions_Exllamav2]
-	) -> Generator:
-		"""(TODO) Generate text from a prompt. Returns a Generator."""
-		raise NotImplementedError()
-
-	def complete(self, options: CompletionOptions_OpenAI):
-		"""Generate text from a prompt. Returns a string."""
-		if not self.hasKey():
-			raise Exception('OpenAI API key not set.')
-
-		url = "https://api.openai.com/v1/chat/completions"
+	def _chat_body(self, options: CompletionOptions_OpenAI) -> dict:
 		msgs = []
 		for msg in options.messages:
 			msgs.append(msg.model_dump())
-		body = {
+		return {
 			"model": options.model,
 			"messages": msgs,
 			"max_tokens": options.max_tokens,
@@ -98,6 +107,32 @@ class LLMClient_OpenAI(LLMClient_Base):
 			"top_p": options.top_p,
 			"stop": options.stop,
 		}
+
+	def generate(self, options: CompletionOptions_OpenAI) -> Generator:
+		"""Generate text from a prompt. Returns a Generator."""
+		if not self.hasKey():
+			raise Exception('OpenAI API key not set.')
+
+		url = "https://api.openai.com/v1/chat/completions"
+		body = self._chat_body(options)
+		body['stream'] = True
+		finish_reason = 'stop'
+		for event in self._api_post_stream(url, body):
+			choice = event['choices'][0]
+			if choice.get('finish_reason'):
+				finish_reason = choice['finish_reason']
+			text = choice.get('delta', {}).get('content')
+			if text:
+				yield text
+		return finish_reason
+
+	def complete(self, options: CompletionOptions_OpenAI):
+		"""Generate text from a prompt. Returns a string."""
+		if not self.hasKey():
+			raise Exception('OpenAI API key not set.')
+
+		url = "https://api.openai.com/v1/chat/completions"
+		body = self._chat_body(options)
 		res = self._api_post(url, body)
 		choice = res['choices'][0]
 		r = text_completion(
@@ -0,0 +1,199 @@
+from collections import OrderedDict
+from typing import Any, Union
+import logging, os, pickle, threading
+from uuid import uuid4
+from app.settings import LLM_PREFIX_CACHE
+
+logger = logging.getLogger('LLM-prefix-cache')
+
+def longest_common_prefix(a: list[int], b: list[int]) -> int:
+	n = 0
+	for x, y in zip(a, b):
+		if x != y:
+			break
+		n += 1
+	return n
+
+class PrefixCacheEntry:
+	def __init__(self, tokens: tuple[int, ...], value: Any, nbytes: int):
+		self.tokens = tokens
+		self.value = value  # None while the entry only lives on disk
+		self.nbytes = nbytes
+		self.path: Union[str, None] = None
+		self.block_hashes: list[int] = []
+
+class PrefixCache:
+	"""LRU store of saved model states (KV caches), keyed by the tokens they were computed from.
+
+	Token sequences are hashed in blocks of `block_size`, each block's hash
+	chained to the previous one, so finding the longest cached prefix of a
+	prompt is a walk over its block hashes rather than a scan of every entry.
+	Entries evicted from RAM spill to `disk_dir` (if set) until that budget is
+	used up too.
+	"""
+	def __init__(
+		self,
+		ram_bytes: int = LLM_PREFIX_CACHE['ram_bytes'],
+		disk_dir: str = LLM_PREFIX_CACHE['disk_dir'],
+		disk_bytes: int = LLM_PREFIX_CACHE['disk_bytes'],
+		block_size: int = LLM_PREFIX_CACHE['block_size'],
+	):
+		self.ram_bytes = ram_bytes
+		self.disk_dir = disk_dir
+		self.disk_bytes = disk_bytes if disk_dir else 0
+		self.block_size = block_size
+		self.ram: OrderedDict[tuple, PrefixCacheEntry] = OrderedDict()
+		self.disk: OrderedDict[tuple, PrefixCacheEntry] = OrderedDict()
+		self.ram_used = 0
+		self.disk_used = 0
+		# chained block hash -> keys of the entries containing that block
+		self.index: dict[int, dict[tuple, None]] = {}
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.hit_tokens = 0
+		if self.disk_dir:
+			os.makedirs(self.disk_dir, exist_ok=True)
+
+	def _block_hashes(self, tokens: list[int]) -> list[int]:
+		hashes = []
+		h = 0
+		for i in range(self.block_size, len(tokens) + 1, self.block_size):
+			h = hash((h, tuple(tokens[i - self.block_size:i])))
+			hashes.append(h)
+		return hashes
+
+	def stats(self) -> dict:
+		return {
+			'prefix_cache_hits': self.hits,
+			'prefix_cache_misses': self.misses,
+		}
+
+	def __contains__(self, tokens) -> bool:
+		key = tuple(tokens)
+		return key in self.ram or key in self.disk
+
+	def lookup(self, tokens: list[int]) -> tuple[Any, int]:
+		"""Find the entry sharing the longest prefix with `tokens`. Returns `(value, matched_tokens)`, or `(None, 0)` on a miss."""
+		with self.lock:
+			for h in reversed(self._block_hashes(tokens)):
+				best = None
+				matched = 0
+				for key in self.index.get(h, {}):
+					entry = self.ram.get(key) or self.disk.get(key)
+					if entry is None:
+						continue
+					n = longest_common_prefix(list(entry.tokens), tokens)
+					if n > matched:
+						best = entry
+						matched = n
+				if best is None or matched < self.block_size:
+					continue  # no entry, or a hash collision
+				value = self._touch(best)
+				if value is None:
+					continue
+				self.hits += 1
+				self.hit_tokens += matched
+				return value, matched
+			self.misses += 1
+			return None, 0
+
+	def cached_length(self, tokens: list[int]) -> int:
+		"""How many leading tokens of `tokens` some entry already holds. Unlike `lookup`, counts no hit or miss and leaves the LRU order alone."""
+		with self.lock:
+			for h in reversed(self._block_hashes(tokens)):
+				matched = 0
+				for key in self.index.get(h, {}):
+					matched = max(matched, longest_common_prefix(list(key), tokens))
+				if matched >= self.block_size:
+					return matched
+			return 0
+
+	def put(self, tokens: list[int], value: Any, nbytes: int):
+		if len(tokens) < self.block_size or nbytes > self.ram_bytes:
+			return
+		key = tuple(tokens)
+		with self.lock:
+			if key in self.ram or key in self.disk:
+				self._touch(self.ram.get(key) or self.disk[key])
+				return
+			entry = PrefixCacheEntry(key, value, nbytes)
+			entry.block_hashes = self._block_hashes(tokens)
+			for h in entry.block_hashes:
+				self.index.setdefault(h, {})[key] = None
+			self.ram[key] = entry
+			self.ram_used += nbytes
+			self._evict()
+
+	def clear(self):
+		with self.lock:
+			for entry in self.disk.values():
+				self._remove_file(entry)
+			self.ram.clear()
+			self.disk.clear()
+			self.index.clear()
+			self.ram_used = 0
+			self.disk_used = 0
+
+	def _touch(self, entry: PrefixCacheEntry) -> Any:
+		"""Mark `entry` most recently used, bringing it back into RAM if needed."""
+		if entry.tokens in self.ram:
+			self.ram.move_to_end(entry.tokens)
+			return entry.value
+		del self.disk[entry.tokens]
+		self.disk_used -= entry.nbytes
+		try:
+			with open(entry.path or '', 'rb') as f:
+				entry.value = pickle.load(f)
+		except Exception as e:
+			logger.error(f'Failed to read cached prefix: {e}')
+			self._forget(entry)
+			return None
+		finally:
+			self._remove_file(entry)
+		self.ram[entry.tokens] = entry
+		self.ram_used += entry.nbytes
+		self._evict()
+		return entry.value
+
+	def _evict(self):
+		while self.ram_used > self.ram_bytes and len(self.ram) > 0:
+			_, entry = self.ram.popitem(last=False)
+			self.ram_used -= entry.nbytes
+			if entry.nbytes <= self.disk_bytes:
+				self._spill(entry)
+			else:
+				self._forget(entry)
+		while self.disk_used > self.disk_bytes and len(self.disk) > 0:
+			_, entry = self.disk.popitem(last=False)
+			self.disk_used -= entry.nbytes
+			self._remove_file(entry)
+			self._forget(entry)
+
+	def _spill(self, entry: PrefixCacheEntry):
+		entry.path = os.path.join(self.disk_dir, f'{uuid4().hex}.pkl')
+		try:
+			with open(entry.path, 'wb') as f:
+				pickle.dump(entry.value, f)
+		except Exception as e:
+			logger.error(f'Failed to write cached prefix: {e}')
+			self._remove_file(entry)
+			self._forget(entry)
+			return
+		entry.value = None
+		self.disk[entry.tokens] = entry
+		self.disk_used += entry.nbytes
+
+	def _forget(self, entry: PrefixCacheEntry):
+		for h in entry.block_hashes:
+			keys = self.index.get(h)
+			if keys is None:
+				continue
+			keys.pop(entry.tokens, None)
+			if len(keys) == 0:
+				del self.index[h]
+
+	def _remove_file(self, entry: PrefixCacheEntry):
+		if entry.path is not None and os.path.exists(entry.path):
+			os.remove(entry.path)
+		entry.path = None
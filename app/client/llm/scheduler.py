@@ -0,0 +1,192 @@
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Union
+from uuid import uuid4
+import logging, queue, threading, time
+from app.settings import LLM_MAX_BATCH_SIZE
+from .base import LLMClient_Base
+from ._utils import text_completion
+
+logger = logging.getLogger('LLM-scheduler')
+
+class BatchSequence:
+	"""State of one request while it waits for, or runs in, a decode batch."""
+	def __init__(self, options: Any, max_tokens: int, stop: list[str]):
+		self.id = uuid4().hex
+		self.options = options
+		self.max_tokens = max_tokens
+		self.stop = [s for s in stop if s]
+		self.prompt_tokens = 0
+		self.cached_tokens = 0  # prompt tokens restored from the prefix cache
+		self.completion_tokens = 0
+		self.text = ''
+		self.emitted = 0  # length of `text` already handed to the stream
+		self.state: Any = None  # owned by the loader (kv cache, sampler, etc.)
+		self.finish_reason: Union[str, None] = None
+		self.future: Future = Future()
+		self.chunks: Union[queue.Queue, None] = None
+
+	@property
+	def finished(self):
+		return self.finish_reason is not None
+
+def _held_back(text: str, stop: list[str]) -> int:
+	"""Number of trailing chars of `text` that could be the start of a stop string."""
+	held = 0
+	for s in stop:
+		for n in range(min(len(s) - 1, len(text)), held, -1):
+			if text.endswith(s[:n]):
+				held = n
+				break
+	return held
+
+class LLMScheduler:
+	"""Continuous-batching scheduler in front of one loaded model.
+
+	Requests are queued and a background thread runs them in decode batches:
+	every step asks the loader for one more token of each running sequence,
+	finished sequences leave the batch and waiting ones are admitted in their
+	place. Only sequences with the same `loader.batch_key` share a batch.
+	"""
+	def __init__(
+		self, loader: LLMClient_Base, max_batch_size=LLM_MAX_BATCH_SIZE
+	):
+		assert loader.supports_batching
+		self.loader = loader
+		self.max_batch_size = max_batch_size
+		self.waiting: deque[BatchSequence] = deque()
+		self.running: list[BatchSequence] = []
+		self.cond = threading.Condition()
+		self.stopped = False
+		self.thread = threading.Thread(
+			target=self._loop, name='llm-scheduler', daemon=True
+		)
+		self.thread.start()
+
+	def submit(self, options: Any, stream=False) -> BatchSequence:
+		seq = BatchSequence(
+			options, self.loader.get_max_tokens(options),
+			self.loader.get_stop(options)
+		)
+		if stream:
+			seq.chunks = queue.Queue()
+		with self.cond:
+			if self.stopped:
+				raise Exception('Model unloaded.')
+			self.waiting.append(seq)
+			self.cond.notify()
+		return seq
+
+	def complete(self, options: Any) -> dict:
+		return self.submit(options).future.result()
+
+	def generate(self, options: Any):
+		seq = self.submit(options, stream=True)
+		assert seq.chunks is not None
+		while True:
+			chunk = seq.chunks.get()
+			if chunk is None:
+				break
+			yield chunk
+		seq.future.result()  # re-raise errors from the batch
+		return seq.finish_reason or 'stop'
+
+	def stop(self):
+		with self.cond:
+			self.stopped = True
+			self.cond.notify()
+		self.thread.join()
+
+	def _admit(self):
+		"""Move waiting sequences into the running batch (called with `cond` held)."""
+		if len(self.running) == 0 and len(self.waiting) > 0:
+			key = self.loader.batch_key(self.waiting[0].options)
+		elif len(self.running) > 0:
+			key = self.loader.batch_key(self.running[0].options)
+		else:
+			return
+		# skip over incompatible requests, they'll run when the batch drains
+		for seq in list(self.waiting):
+			if len(self.running) >= self.max_batch_size:
+				break
+			if self.loader.batch_key(seq.options) == key:
+				self.waiting.remove(seq)
+				self.running.append(seq)
+
+	def _loop(self):
+		while True:
+			with self.cond:
+				while not self.stopped and len(self.waiting) == 0 and len(
+					self.running
+				) == 0:
+					self.cond.wait()
+				if self.stopped:
+					break
+				self._admit()
+			batch = list(self.running)
+			try:
+				deltas = self.loader.batch_step(batch)
+			except Exception as e:
+				logger.error(f'Batch step failed: {e}')
+				for seq in batch:
+					self._finish(seq, error=e)
+				continue
+			for seq, (delta, eos) in zip(batch, deltas):
+				self._advance(seq, delta, eos)
+		for seq in self.running + list(self.waiting):
+			self._finish(seq, error=Exception('Model unloaded.'))
+		self.waiting.clear()
+
+	def _advance(self, seq: BatchSequence, delta: str, eos: bool):
+		if eos:
+			seq.finish_reason = 'stop'
+		else:
+			seq.completion_tokens += 1
+			seq.text += delta
+			for s in seq.stop:
+				i = seq.text.find(s)
+				if i != -1:
+					seq.text = seq.text[:i]
+					seq.finish_reason = 'stop'
+			if not seq.finished and seq.completion_tokens >= seq.max_tokens:
+				seq.finish_reason = 'length'
+		if seq.chunks is not None:
+			end = len(seq.text)
+			if not seq.finished:
+				end -= _held_back(seq.text, seq.stop)
+			if end > seq.emitted:
+				seq.chunks.put(seq.text[seq.emitted:end])
+				seq.emitted = end
+		if seq.finished:
+			self._finish(seq)
+
+	def _finish(self, seq: BatchSequence, error: Union[Exception, None] = None):
+		if seq in self.running:
+			self.running.remove(seq)
+		if seq.state is not None:
+			self.loader.batch_release(seq)
+			seq.state = None
+		if seq.chunks is not None:
+			seq.chunks.put(None)
+		if error is not None:
+			seq.future.set_exception(error)
+			return
+		r = text_completion(
+			seq.text,
+			result={
+				'created': int(time.time()),
+				'usage': {
+					'prompt_tokens': seq.prompt_tokens,
+					'completion_tokens': seq.completion_tokens,
+					'total_tokens': seq.prompt_tokens + seq.completion_tokens,
+					'cached_tokens': seq.cached_tokens,
+					**self.loader.prefix_cache_stats(),
+				}
+			},
+			model_name=self.loader.model_name or '',
+			finish_reason=seq.finish_reason or 'stop'
+		)
+		seq.future.set_result({
+			'result': r,
+			'params': seq.options.model_dump(),
+		})
@@ -1,13 +1,56 @@
-import logging, os, time
+from typing import Union
+import copy, logging, os, time
+from threading import Event, Thread
 from app.args import Args
 from app.models.llm.client import CompletionOptions, CompletionOptions_Transformers
+from app.settings import LLM_MAX_BATCH_SIZE
 from .base import LLMClient_Base
 from ._utils import text_completion
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
 import torch
 
+try:
+	from transformers.generation.configuration_utils import NEED_SETUP_CACHE_CLASSES_MAPPING
+except ImportError:  # transformers < 4.38 has no static cache
+	NEED_SETUP_CACHE_CLASSES_MAPPING = {}
+
 logger = logging.getLogger('Transformers-client')
 
+class StopOnEvent(StoppingCriteria):
+	"""Stops `model.generate` once `event` is set, e.g. when its stream was abandoned."""
+	def __init__(self, event: Event):
+		self.event = event
+
+	def __call__(self, input_ids, scores, **kwargs) -> bool:
+		return self.event.is_set()
+
+def sample_token(
+	logits: torch.Tensor, options: CompletionOptions_Transformers,
+	ids: list[int]
+) -> int:
+	"""Pick the next token id from the last position's `logits`."""
+	logits = logits.float().clone()
+	if options.repetition_penalty != 1.0 and len(ids) > 0:
+		prev = torch.tensor(ids, device=logits.device).unique()
+		scores = logits[prev]
+		logits[prev] = torch.where(
+			scores < 0, scores * options.repetition_penalty,
+			scores / options.repetition_penalty
+		)
+	if not options.do_sample or options.temperature <= 0:
+		return int(torch.argmax(logits).item())
+	logits = logits / options.temperature
+	if options.top_k > 0:
+		k = min(options.top_k, logits.shape[-1])
+		logits[logits < torch.topk(logits, k).values[-1]] = -float('inf')
+	probs = torch.softmax(logits, dim=-1)
+	if options.top_p < 1.0:
+		sorted_probs, sorted_idx = torch.sort(probs, descending=True)
+		cumulative = torch.cumsum(sorted_probs, dim=-1)
+		sorted_probs[cumulative - sorted_probs > options.top_p] = 0
+		probs = torch.zeros_like(probs).scatter(0, sorted_idx, sorted_probs)
+	return int(torch.multinomial(probs, 1).item())
+
 class LLMClient_Transformers(LLMClient_Base):
 	device = torch.device(
 		'cuda:0' if torch.cuda.is_available() else 'cpu'
@@ -18,6 +61,10 @@ class LLMClient_Transformers(LLMClient_Base):
 		'typical': 'typical_p',
 		'repeat_pen': 'repetition_penalty',
 	}
+	supports_batching = True
+	supports_batch_complete = True
+	# built at load time, copied and updated with each request's options
+	generation_config: Union[GenerationConfig, None] = None
 
 	def convert_options(
 		self, options: CompletionOptions
@@ -39,15 +86,19 @@ class LLMClient_Transformers(LLMClient_Base):
 			raise Exception(
 				f'Model {model_name} not found in {models_dir}.'
 			)
-		self.model_abspath = os.path.join(models_dir, model_name)
-		self.model_name = model_name
-
 		if self.loaded or self.model is not None:
 			self.unload_model()
 
+		self.model_abspath = os.path.join(models_dir, model_name)
+		self.model_name = model_name
+
 		self.tokenizer = AutoTokenizer.from_pretrained(
 			self.model_abspath
 		)
+		# batched prompts are padded on the left, so they all end where generation starts
+		self.tokenizer.padding_side = 'left'
+		if self.tokenizer.pad_token is None:
+			self.tokenizer.pad_token = self.tokenizer.eos_token
 		if self.config is None:
 			cfg = {
 				'model_name_or_path': self.model_abspath,
@@ -63,6 +114,16 @@ class LLMClient_Transformers(LLMClient_Base):
 			low_cpu_mem_usage=True,
 			device_map=self.device,
 		)
+		self.model.eval()
+		self.generation_config = copy.deepcopy(
+			self.model.generation_config
+		)
+		self.generation_config.pad_token_id = self.tokenizer.pad_token_id
+		if 'static' in NEED_SETUP_CACHE_CLASSES_MAPPING and getattr(
+			self.model, '_supports_static_cache', False
+		):
+			# preallocated kv cache instead of one grown every step
+			self.generation_config.cache_implementation = 'static'
 
 		end = time.time()
 		logger.debug(
@@ -80,34 +141,258 @@ class LLMClient_Transformers(LLMClient_Base):
 		self.config = None
 		self.tokenizer = None
 		self.generator = None
+		self.generation_config = None
 		self.loaded = False
 		torch.cuda.empty_cache()
 		logger.debug('Unloaded model.')
 
-	def complete(self, options: CompletionOptions_Transformers):
+	def get_generation_config(
+		self, options: CompletionOptions_Transformers
+	) -> GenerationConfig:
+		assert self.generation_config is not None
+		config = copy.deepcopy(self.generation_config)
+		opt = options.model_dump()
+		del opt['prompt']
+		config.update(**opt)
+		return config
+
+	def generate_batch(
+		self, options: list[CompletionOptions_Transformers]
+	) -> list[dict]:
+		"""Complete prompts that share generation settings (those of the first) in one `model.generate` call."""
+		assert self.model is not None and self.tokenizer is not None
+		config = self.get_generation_config(options[0])
+		inputs = self.tokenizer([o.prompt for o in options],
+														return_tensors='pt',
+														padding=True).to(self.model.device)
+		with torch.inference_mode():
+			output = self.model.generate(
+				**inputs, generation_config=config
+			)
+		eos = config.eos_token_id
+		eos_ids = set(eos if isinstance(eos, list) else [eos])
+		prompt_len = inputs.input_ids.shape[-1]
+		results = []
+		for i, opt in enumerate(options):
+			# decode only the new tokens, up to the first eos
+			tokens = output[i, prompt_len:].tolist()
+			finish_reason = 'length'
+			for j, token in enumerate(tokens):
+				if token in eos_ids:
+					tokens = tokens[:j]
+					finish_reason = 'stop'
+					break
+			prompt_tokens = int(inputs.attention_mask[i].sum().item())
+			r = text_completion(
+				self.tokenizer.decode(tokens, skip_special_tokens=True),
+				result={
+					'usage': {
+						'prompt_tokens': prompt_tokens,
+						'completion_tokens': len(tokens),
+						'total_tokens': prompt_tokens + len(tokens),
+					}
+				},
+				model_name=self.model_name or '',
+				finish_reason=finish_reason
+			)
+			results.append({
+				'result': r,
+				'params': opt.model_dump(),
+			})
+		return results
+
+	def complete_batch(
+		self, options: list[CompletionOptions_Transformers]
+	) -> list[dict]:
 		if not self.loaded or self.model is None:
 			self.load_model()
+		# group by generation settings, keeping each result's position
+		groups: dict[str, list[int]] = {}
+		for i, opt in enumerate(options):
+			key = opt.model_dump_json(exclude={'prompt'})
+			groups.setdefault(key, []).append(i)
+		results: list[dict] = [{}] * len(options)
+		for indices in groups.values():
+			for b in range(0, len(indices), LLM_MAX_BATCH_SIZE):
+				batch = indices[b:b + LLM_MAX_BATCH_SIZE]
+				for i, r in zip(
+					batch, self.generate_batch([options[i] for i in batch])
+				):
+					results[i] = r
+		return results
+
+	def generate(self, options: CompletionOptions_Transformers):
+		if not self.loaded or self.model is None:
+			self.load_model()
+		assert self.model is not None and self.tokenizer is not None
 		assert isinstance(options, CompletionOptions_Transformers)
-		opt = options.model_dump()
-		del opt['prompt']
-		pipe = pipeline(
-			'text-generation',
-			model=self.model,
-			tokenizer=self.tokenizer,
-			**opt
+		start = time.time()
+		inputs = self.tokenizer(
+			options.prompt, return_tensors='pt'
+		).to(self.model.device)
+		streamer = TextIteratorStreamer(
+			self.tokenizer, skip_prompt=True, skip_special_tokens=True
 		)
+		config = self.get_generation_config(options)
+		stopped = Event()
+		output = []
+		errors: list[Exception] = []
+
+		def run():
+			try:
+				output.append(
+					self.model.generate(  # type: ignore
+						**inputs,
+						streamer=streamer,
+						generation_config=config,
+						stopping_criteria=StoppingCriteriaList([
+							StopOnEvent(stopped)
+						])
+					)
+				)
+			except Exception as e:
+				errors.append(e)
+				# or the loop below would wait for text forever
+				streamer.end()
 
-		result = pipe(options.prompt)
-		result = result[0]['generated_text']  # type: ignore
-		# remove prompt from result
-		result = result[len(options.prompt):]
-		assert isinstance(result, str)
+		# model.generate blocks until done, so run it in a thread and
+		#   hand decoded text back through the streamer as it's produced
+		thread = Thread(target=run)
+		thread.start()
+		try:
+			for text in streamer:
+				if text != '':
+					yield text
+		finally:
+			# stops generating if the consumer closed the stream early
+			stopped.set()
+			thread.join()
+		if len(errors) > 0:
+			raise errors[0]
+		end = time.time()
+		logger.debug(f'Generated text in {end - start}s')
+		eos = config.eos_token_id
+		eos_ids = set(eos if isinstance(eos, list) else [eos])
+		tokens = output[0][0, inputs.input_ids.shape[-1]:].tolist()
+		if any(token in eos_ids for token in tokens):
+			return 'stop'
+		return 'length' if len(tokens) >= options.max_new_tokens else 'stop'
 
-		r = text_completion(
-			result,
-			model_name=self.model_name or '',
+	def complete(self, options: CompletionOptions_Transformers):
+		if not self.loaded or self.model is None:
+			self.load_model()
+		assert isinstance(options, CompletionOptions_Transformers)
+		start = time.time()
+		result = self.generate_batch([options])[0]
+		logger.debug(f'Generated text in {time.time() - start}s')
+		return result
+
+	def context_length(self) -> int:
+		if self.model is None:
+			return super().context_length()
+		return getattr(
+			self.model.config, 'max_position_embeddings',
+			super().context_length()
 		)
-		return {
-			'result': r,
-			'params': options.model_dump(),
+
+	def count_tokens(self, text: str) -> int:
+		if self.tokenizer is None:
+			raise Exception('No model loaded.')
+		return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+	def get_max_tokens(self, options: CompletionOptions_Transformers):
+		return options.max_new_tokens
+
+	def get_stop(self, options: CompletionOptions_Transformers):
+		return []
+
+	def batch_step(self, seqs):
+		assert self.model is not None and self.tokenizer is not None
+		with torch.inference_mode():
+			pending = []
+			for seq in seqs:
+				if seq.state is None:
+					self._batch_prefill(seq)
+				else:
+					pending.append(seq)
+			if len(pending) > 0:
+				self._batch_decode(pending)
+			return [self._batch_sample(seq) for seq in seqs]
+
+	def batch_release(self, seq):
+		seq.state = None
+
+	def _batch_prefill(self, seq):
+		assert self.model is not None and self.tokenizer is not None
+		input_ids = self.tokenizer(
+			seq.options.prompt, return_tensors='pt'
+		).input_ids.to(self.model.device)
+		res = self.model(input_ids, use_cache=True)
+		seq.prompt_tokens = input_ids.shape[-1]
+		seq.state = {
+			'ids': input_ids[0].tolist(),
+			'generated': [],
+			'text': '',
+			'past': res.past_key_values,
+			'logits': res.logits[0, -1],
 		}
+
+	def _batch_decode(self, seqs):
+		"""Feed each sequence's last sampled token through the model in one forward pass."""
+		assert self.model is not None
+		device = self.model.device
+		# the last sampled token isn't in the cache yet
+		past_lens = [len(seq.state['ids']) - 1 for seq in seqs]
+		longest = max(past_lens)
+		# left-pad every kv cache to the longest one and mask the padding out
+		past = []
+		for layer in range(len(seqs[0].state['past'])):
+			keys, values = [], []
+			for seq, n in zip(seqs, past_lens):
+				k, v = seq.state['past'][layer][:2]
+				pad = (0, 0, longest - n, 0)
+				keys.append(torch.nn.functional.pad(k, pad))
+				values.append(torch.nn.functional.pad(v, pad))
+			past.append((torch.cat(keys), torch.cat(values)))
+		mask = torch.zeros((len(seqs), longest + 1),
+												dtype=torch.long,
+												device=device)
+		for i, n in enumerate(past_lens):
+			mask[i, longest - n:] = 1
+		input_ids = torch.tensor([[seq.state['ids'][-1]] for seq in seqs],
+															device=device)
+		position_ids = torch.tensor([[n] for n in past_lens],
+																device=device)
+		res = self.model(
+			input_ids,
+			past_key_values=tuple(past),
+			attention_mask=mask,
+			position_ids=position_ids,
+			use_cache=True
+		)
+		# split the batch back up, dropping each sequence's padding
+		for i, (seq, n) in enumerate(zip(seqs, past_lens)):
+			start = longest - n
+			seq.state['past'] = tuple(
+				(layer[0][i:i + 1, :, start:], layer[1][i:i + 1, :, start:])
+				for layer in res.past_key_values
+			)
+			seq.state['logits'] = res.logits[i, -1]
+
+	def _batch_sample(self, seq) -> tuple[str, bool]:
+		assert self.tokenizer is not None
+		state = seq.state
+		token = sample_token(state['logits'], seq.options, state['ids'])
+		if token == self.tokenizer.eos_token_id:
+			return ('', True)
+		state['ids'].append(token)
+		state['generated'].append(token)
+		text = self.tokenizer.decode(
+			state['generated'], skip_special_tokens=True
+		)
+		if text.endswith('\ufffd'):
+			# incomplete multi-byte character, wait for the next token
+			return ('', False)
+		delta = text[len(state['text']):]
+		state['text'] = text
+		return (delta, False)
@@ -1,14 +1,19 @@
-from typing import Union, Dict, TypeVar
+from concurrent.futures import Future, wait
+from contextlib import contextmanager
+from typing import Any, Union, Dict, TypeVar
 import logging, os
 from app.args import Args
-from app.client.base_manager import BaseAIManager
-from app.client.llm import LLMClient_LlamaCppPython, LLMClient_Exllamav2, LLMClient_OpenAI, LLMClient_Transformers
-from app.models.llm.llm_api import CompletionReturn
-from app.models.llm.client import CompletionOptions, CompletionOptions_LlamaCppPython, CompletionOptions_Exllamav2, CompletionOptions_Transformers
+from app.client.base_manager import BaseAIManager, ResidentModel
+from app.client.llm import LLMClient_LlamaCppPython, LLMClient_Exllamav2, LLMClient_Fake, LLMClient_OpenAI, LLMClient_Transformers
+from app.client.llm.scheduler import LLMScheduler
+from app.models.llm.llm_api import CompletionReturn, PromptParts
+from app.models.llm.client import CompletionOptions, CompletionOptions_LlamaCppPython, CompletionOptions_Exllamav2, CompletionOptions_Fake, CompletionOptions_Transformers
+from app.settings import LLM_BATCHING, MODEL_MEMORY_BUDGET
+from app.utils import prompt_format
 
 ClientUnion = Union[LLMClient_LlamaCppPython,
 										LLMClient_Exllamav2, LLMClient_OpenAI,
-										LLMClient_Transformers]
+										LLMClient_Transformers, LLMClient_Fake]
 ClientDict = Dict[str, ClientUnion]
 
 EXTENSIONS = ['.gguf', '.ggml', '.safetensor']
@@ -20,26 +25,35 @@ class LLMManager(BaseAIManager):
 		'exllamav2': LLMClient_Exllamav2.instance,
 		'openai': LLMClient_OpenAI.instance,
 		'transformers': LLMClient_Transformers.instance,
+		'fake': LLMClient_Fake.instance,
 	}
 	loader: Union[ClientUnion, None] = None
+	# one scheduler per loaded model whose loader supports batching
+	schedulers: Dict[str, LLMScheduler] = {}
 
 	def __init__(self):
+		super().__init__()
 		self.clients = {
 			'llamacpp': LLMClient_LlamaCppPython.instance,
 			'exllamav2': LLMClient_Exllamav2.instance,
 			'openai': LLMClient_OpenAI.instance,
 			'transformers': LLMClient_Transformers.instance,
+			'fake': LLMClient_Fake.instance,
 		}
+		self.schedulers = {}
 		self.default_model = Args['llm_model']
 		self.models_dir = Args['llm_models_dir']
+		self.memory_budget = MODEL_MEMORY_BUDGET.get('llm', 0)
 
-	def get_loader_model(self):
-		if self.loader == LLMClient_LlamaCppPython.instance:
+	def get_loader_model(self, loader):
+		if isinstance(loader, LLMClient_LlamaCppPython):
 			return CompletionOptions_LlamaCppPython
-		if self.loader == LLMClient_Exllamav2.instance:
+		if isinstance(loader, LLMClient_Exllamav2):
 			return CompletionOptions_Exllamav2
-		if self.loader == LLMClient_Transformers.instance:
+		if isinstance(loader, LLMClient_Transformers):
 			return CompletionOptions_Transformers
+		if isinstance(loader, LLMClient_Fake):
+			return CompletionOptions_Fake
 
 	def list_local_models(self) -> list[str]:
 		models_dir = self.get_models_dir()
@@ -84,6 +98,8 @@ class LLMManager(BaseAIManager):
 		model_name = model_name.lower()
 		if 'openai:' in model_name:
 			return 'openai'
+		if model_name.startswith('fake:'):
+			return 'fake'
 		if os.path.isdir(p):
 			if 'gptq' in model_name or 'exl2' in model_name:
 				return 'exllamav2'
@@ -107,37 +123,150 @@ class LLMManager(BaseAIManager):
 
 		return super().load_model(model_name)
 
-	def generate(self, gen_options: CompletionOptions):
-		if not self.loader:
-			self.load_model(None)
-			if not self.loader:
-				raise Exception('Model not loaded.')
-		options = self.loader.convert_options(gen_options)
-		loader_model = self.get_loader_model()
-		assert loader_model is not None
-		assert isinstance(options, loader_model)
-		return self.loader.generate(options)  # type: ignore
+	def release(self, resident: ResidentModel):
+		# let the requests already using the model finish first
+		self.wait_unpinned(resident)
+		with self.pool_lock:
+			scheduler = self.schedulers.get(resident.model_name)
+			# the model may be back in the pool with a new scheduler
+			if scheduler is not None and scheduler.loader is resident.loader:
+				del self.schedulers[resident.model_name]
+			else:
+				scheduler = None
+		if scheduler is not None:
+			scheduler.stop()
+		super().release(resident)
 
-	def complete(self, gen_options: CompletionOptions):
+	def load_draft_model(self, model_name: str, draft_model: str):
+		"""Pair resident `model_name` with `draft_model` for speculative decoding, replacing any draft it had."""
+		with self.pool_lock:
+			resident = self.models.get(model_name)
+			if resident is None:
+				raise Exception(f'Model {model_name} not loaded.')
+			loader = resident.loader
+			if not loader.supports_speculative:
+				raise Exception(
+					f'{resident.loader_name} does not support draft models.'
+				)
+			if self.pick_client(draft_model) != resident.loader_name:
+				raise Exception(
+					'Draft model must use the same loader as the model.'
+				)
+			if loader.draft_model_name == draft_model:
+				return
+			# requests through the scheduler don't use the draft model
+			scheduler = self.schedulers.pop(model_name, None)
+		if scheduler is not None:
+			scheduler.stop()
+		with resident.lock:
+			loader.load_draft_model(draft_model)
+		with self.pool_lock:
+			evicted = []
+			if self.models.get(model_name) is resident:
+				resident.nbytes = loader.estimate_memory(
+					self.model_file_bytes(model_name) +
+					self.model_file_bytes(draft_model)
+				)
+				self.models.move_to_end(model_name)
+				while self.memory_budget > 0 and len(
+					self.models
+				) > 1 and self.memory_used() > self.memory_budget:
+					evicted.append(self.detach(next(iter(self.models))))
+		for other in evicted:
+			self.release(other)
+
+	def get_draft_model(self, model_name: str) -> Union[str, None]:
+		resident = self.models.get(model_name)
+		if resident is None:
+			return None
+		return resident.loader.draft_model_name
+
+	@contextmanager
+	def use_model(self, model: str):
+		"""The resident holding `model`, loading it (and evicting others) if it isn't resident. It stays loaded until the block exits."""
+		resident = self.load_resident(model or self.get_default_model(), pin=True)
+		if resident is None:
+			raise Exception('Model not loaded.')
+		try:
+			yield resident
+		finally:
+			self.unpin(resident)
+
+	def pack_prompt(
+		self,
+		parts: PromptParts,
+		model: str,
+		max_tokens: int,
+		prefix_response='',
+		conversation_id=''
+	) -> tuple[str, int]:
+		"""Build the prompt for `parts`, leaving out the oldest prior messages if the prompt and `max_tokens` don't fit `model`'s context. Returns the prompt and how many tokens were left out."""
+		with self.use_model(model) as resident:
+			loader = resident.loader
+			return prompt_format.pack_parts_to_prompt(
+				parts, model,
+				loader.context_length() - max_tokens, loader.count_tokens,
+				loader.count_tokens_cached, prefix_response, conversation_id
+			)
+
+	def use_scheduler(self, loader: ClientUnion) -> bool:
+		return LLM_BATCHING and loader.supports_batching
+
+	def get_scheduler(self, loader: ClientUnion) -> LLMScheduler:
+		assert loader.model_name is not None
+		with self.pool_lock:
+			scheduler = self.schedulers.get(loader.model_name)
+			if scheduler is None:
+				scheduler = LLMScheduler(loader)
+				self.schedulers[loader.model_name] = scheduler
+		return scheduler
+
+	def _resolve_model(self, gen_options: CompletionOptions) -> str:
 		model = gen_options.model
 		if model is None or model == '':
 			model = self.model_name or Args['llm_model']
 			gen_options.model = model
+		return model
+
+	def generate(self, gen_options: CompletionOptions):
+		model = self._resolve_model(gen_options)
 
 		if 'openai:' in model:
 			OpenAI = LLMClient_OpenAI.instance
 			opt = OpenAI.convert_options(gen_options)
-			result = LLMClient_OpenAI.instance.complete(opt)
-		else:
-			if not self.loader:
-				self.load_model(model or None)
-			if not self.loader:
-				raise Exception('Model not loaded.')
-			options = self.loader.convert_options(gen_options)
-			loader_model = self.get_loader_model()
+			return (yield from OpenAI.generate(opt))
+
+		# a generator, so the model is held only while the stream is consumed
+		with self.use_model(model) as resident:
+			loader = resident.loader
+			options = loader.convert_options(gen_options)
+			loader_model = self.get_loader_model(loader)
 			assert loader_model is not None
 			assert isinstance(options, loader_model)
-			result = self.loader.complete(options)  # type: ignore
+			if self.use_scheduler(loader):
+				return (yield from self.get_scheduler(loader).generate(options))
+			with resident.lock:
+				return (yield from loader.generate(options))  # type: ignore
+
+	def complete(self, gen_options: CompletionOptions):
+		model = self._resolve_model(gen_options)
+
+		if 'openai:' in model:
+			OpenAI = LLMClient_OpenAI.instance
+			opt = OpenAI.convert_options(gen_options)
+			result = LLMClient_OpenAI.instance.complete(opt)
+		else:
+			with self.use_model(model) as resident:
+				loader = resident.loader
+				options = loader.convert_options(gen_options)
+				loader_model = self.get_loader_model(loader)
+				assert loader_model is not None
+				assert isinstance(options, loader_model)
+				if self.use_scheduler(loader):
+					result = self.get_scheduler(loader).complete(options)
+				else:
+					with resident.lock:
+						result = loader.complete(options)  # type: ignore
 
 		try:
 			validated_result = CompletionReturn.model_validate(result)
@@ -149,3 +278,73 @@ class LLMManager(BaseAIManager):
 			return None
 
 		return validated_result
+
+	def complete_batch(
+		self, gen_options: list[CompletionOptions]
+	) -> list[Union[CompletionReturn, Exception]]:
+		"""Complete several requests at once, through the loader's own `complete_batch` or all queued in the scheduler together where the loader batches. Results are in request order, with an Exception in place of each request that failed."""
+		def failed(e: Exception) -> Future:
+			future = Future()
+			future.set_exception(e)
+			return future
+
+		futures: list[Union[Future, None]] = [None] * len(gen_options)
+		# model -> indices of its requests
+		groups: dict[str, list[int]] = {}
+		for i, opt in enumerate(gen_options):
+			model = self._resolve_model(opt)
+			if 'openai:' not in model:
+				groups.setdefault(model, []).append(i)
+		# a model at a time, loading the next one may evict the last
+		for model, indices in groups.items():
+			try:
+				with self.use_model(model) as resident:
+					loader = resident.loader
+					if not loader.supports_batch_complete and not self.use_scheduler(
+						loader
+					):
+						# completed one at a time below
+						continue
+					items: list[tuple[int, Any]] = []
+					for i in indices:
+						try:
+							items.append((i, loader.convert_options(gen_options[i])))
+						except Exception as e:
+							futures[i] = failed(e)
+					if loader.supports_batch_complete:
+						try:
+							with resident.lock:
+								batch_results = loader.complete_batch([
+									o for _, o in items
+								])
+							for (i, _), result in zip(items, batch_results):
+								futures[i] = Future()
+								futures[i].set_result(result)  # type: ignore
+						except Exception as e:
+							for i, _ in items:
+								futures[i] = failed(e)
+					else:
+						scheduler = self.get_scheduler(loader)
+						for i, options in items:
+							futures[i] = scheduler.submit(options).future
+						# keep the model loaded until its requests are done
+						wait([futures[i] for i, _ in items])  # type: ignore
+			except Exception as e:
+				for i in indices:
+					future = futures[i]
+					if future is None or not future.done():
+						futures[i] = failed(e)
+
+		results: list[Union[CompletionReturn, Exception]] = []
+		for opt, future in zip(gen_options, futures):
+			try:
+				if future is None:
+					result = self.complete(opt)
+				else:
+					result = CompletionReturn.model_validate(future.result())
+				if result is None:
+					raise Exception('Invalid completion result.')
+				results.append(result)
+			except Exception as e:
+				results.append(e)
+		return results
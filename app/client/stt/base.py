@@ -1,5 +1,16 @@
-from app.models.stt.stt_client import TranscribeOptions, TranscribeResponse
+from typing import Any, Iterable, Iterator
+import os
+from app.models.stt.stt_client import TranscribeChunk, TranscribeOptions, TranscribeResponse
 from app.settings import DEVICE_MAP
+from app.utils.audio import decode_audio
+
+def segment_chunk(segment: dict) -> TranscribeChunk:
+	return TranscribeChunk(
+		start=segment['start'],
+		end=segment['end'],
+		speech=segment['text'].strip(),
+		speaker=segment.get('speaker', '')
+	)
 
 class STTClient_Base:
 	_instance = None
@@ -19,3 +30,55 @@ class STTClient_Base:
 		self, options: TranscribeOptions
 	) -> TranscribeResponse:
 		raise NotImplementedError()
+
+	def transcribe_stream(
+		self, options: TranscribeOptions
+	) -> Iterator[TranscribeChunk]:
+		"""Transcribe, yielding chunks as they're ready. Clients that can't stream yield them all at the end."""
+		result = self.transcribe(options).result
+		if isinstance(result, str):
+			raise Exception('Streaming needs json results.')
+		yield from result
+
+	def decoded_audio(self, options: TranscribeOptions) -> Any:
+		"""All of the audio to transcribe, decoded to float32 16 kHz mono."""
+		if options.audio is not None:
+			return options.audio
+		if options.file is not None:
+			options.file.seek(0)
+			return decode_audio(options.file)
+		if not os.path.exists(options.file_path):
+			raise Exception('File does not exist')
+		return decode_audio(options.file_path)
+
+	def transcribe_audio(self, audio: Any) -> str:
+		"""Text of a short float32 16 kHz mono buffer, e.g. an utterance of a realtime stream."""
+		raise NotImplementedError()
+
+	def cache_key(self) -> str:
+		"""Identifies the model and settings results depend on, for caching transcripts."""
+		raise NotImplementedError()
+
+	def aligned_segments(
+		self, options: TranscribeOptions
+	) -> Iterator[dict]:
+		"""Transcript segments (`start`, `end`, `text`, and `words` if aligned) without speakers."""
+		raise NotImplementedError()
+
+	def batch_aligned_segments(
+		self, audios: Iterable[Any]
+	) -> Iterator[tuple[int, list[dict]]]:
+		"""`aligned_segments` of several decoded recordings, yielding `(index, segments)` as each is done. `audios` may still be decoding, it's read as more are needed. Clients that can share model batches between recordings override this."""
+		for i, audio in enumerate(audios):
+			options = TranscribeOptions.model_validate({'audio': audio})
+			yield i, list(self.aligned_segments(options))
+
+	def diarize(self, options: TranscribeOptions) -> Any:
+		"""Speaker turns of the audio, to label `aligned_segments` with."""
+		raise Exception('Diarization not supported.')
+
+	def transcript_response(
+		self, segments: list[dict], diarization: Any, result_format: str
+	) -> TranscribeResponse:
+		"""Build the `result_format` response from `aligned_segments` and `diarize` results."""
+		raise NotImplementedError()
@@ -0,0 +1,91 @@
+from collections import deque
+import numpy as np
+from app.settings import STT_REALTIME
+
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = 480  # 30ms
+PREROLL_FRAMES = 10  # audio kept from before speech starts
+
+class Utterance:
+	"""Audio of an utterance to transcribe, `final` once it has ended."""
+	def __init__(self, audio: np.ndarray, start: int, final: bool):
+		self.audio = audio
+		self.start = start / SAMPLE_RATE
+		self.end = (start + len(audio)) / SAMPLE_RATE
+		self.final = final
+
+class RealtimeSession:
+	"""Rolling buffer of one realtime transcription stream, segmented into utterances by frame energy.
+
+	`feed` takes 16 kHz mono 16-bit PCM as it arrives and returns the
+	utterances due for transcription: a partial one every `partial_seconds`
+	of speech, and the final one once it's followed by `silence_seconds` of
+	silence or reaches `max_seconds`.
+	"""
+	def __init__(
+		self,
+		partial_seconds: float = STT_REALTIME['partial_seconds'],
+		silence_seconds: float = STT_REALTIME['silence_seconds'],
+		max_seconds: float = STT_REALTIME['max_seconds'],
+		vad_threshold: float = STT_REALTIME['vad_threshold'],
+	):
+		self.partial_samples = int(partial_seconds * SAMPLE_RATE)
+		self.silence_samples = int(silence_seconds * SAMPLE_RATE)
+		self.max_samples = int(max_seconds * SAMPLE_RATE)
+		self.vad_threshold = vad_threshold
+		self.received = 0  # samples since the stream started
+		self.leftover = b''  # bytes of an incomplete frame
+		self.preroll: deque[np.ndarray] = deque(maxlen=PREROLL_FRAMES)
+		self.frames: list[np.ndarray] = []  # the current utterance
+		self.start = 0
+		self.silence = 0
+		self.since_partial = 0
+
+	@property
+	def in_speech(self) -> bool:
+		return len(self.frames) > 0
+
+	def feed(self, pcm: bytes) -> list[Utterance]:
+		data = self.leftover + pcm
+		usable = len(data) // (FRAME_SAMPLES * 2) * FRAME_SAMPLES * 2
+		self.leftover = data[usable:]
+		samples = np.frombuffer(data[:usable], '<i2').astype(np.float32) / 32768.0
+		utterances = []
+		for i in range(0, len(samples), FRAME_SAMPLES):
+			frame = samples[i:i + FRAME_SAMPLES]
+			self.received += FRAME_SAMPLES
+			speech = np.sqrt(np.mean(frame**2)) > self.vad_threshold
+			if not self.in_speech:
+				if not speech:
+					self.preroll.append(frame)
+					continue
+				self.frames = list(self.preroll)
+				self.preroll.clear()
+				self.start = self.received - FRAME_SAMPLES * (len(self.frames) + 1)
+				self.since_partial = 0
+			self.frames.append(frame)
+			self.silence = 0 if speech else self.silence + FRAME_SAMPLES
+			self.since_partial += FRAME_SAMPLES
+			if self.silence >= self.silence_samples or len(
+				self.frames
+			) * FRAME_SAMPLES >= self.max_samples:
+				utterances.append(self.flush())
+		if self.in_speech and self.since_partial >= self.partial_samples:
+			self.since_partial = 0
+			utterances.append(
+				Utterance(np.concatenate(self.frames), self.start, False)
+			)
+		return utterances
+
+	def flush(self) -> Utterance:
+		"""End the current utterance (e.g. the stream ended) and return it as final."""
+		# trailing silence isn't part of it
+		speech_frames = len(self.frames) - self.silence // FRAME_SAMPLES
+		frames = self.frames[:speech_frames]
+		audio = np.concatenate(frames) if len(frames) > 0 else np.zeros(
+			0, dtype=np.float32
+		)
+		utterance = Utterance(audio, self.start, True)
+		self.frames = []
+		self.silence = 0
+		return utterance
@@ -0,0 +1,122 @@
+from collections import OrderedDict
+from typing import Any
+import hashlib, logging, os, pickle, threading
+import numpy as np
+from app.settings import STT_TRANSCRIPT_CACHE
+
+logger = logging.getLogger('STT-transcript-cache')
+
+def transcript_key(
+	model_key: str, audio: Any = None, file_path: str = '', file: Any = None
+) -> str:
+	"""sha256 of the model key and the bytes of `file` (a binary file object) or of the file at `file_path`, or if there is neither the decoded samples.
+
+	Files are hashed before the samples, so a recording has the same key
+	however it was sent, decoded or not.
+	"""
+	h = hashlib.sha256(model_key.encode('utf-8'))
+	if file is not None:
+		file.seek(0)
+		for block in iter(lambda: file.read(1 << 20), b''):
+			h.update(block)
+		file.seek(0)
+		return h.hexdigest()
+	if file_path:
+		with open(file_path, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''):
+				h.update(block)
+		return h.hexdigest()
+	h.update(np.ascontiguousarray(audio, dtype=np.float32).tobytes())
+	return h.hexdigest()
+
+class TranscriptCache:
+	"""Disk store of transcription results (aligned segments, diarization), keyed by audio hash, model and stage.
+
+	Entries are pickled into `disk_dir`, the least recently used ones are
+	deleted once they take more than `max_bytes`. The index is rebuilt from
+	the directory on start, so entries survive restarts.
+	"""
+	def __init__(
+		self,
+		disk_dir: str,
+		max_bytes: int = STT_TRANSCRIPT_CACHE['max_bytes']
+	):
+		self.disk_dir = disk_dir
+		self.max_bytes = max_bytes
+		# key -> bytes on disk, least recently used first
+		self.entries: OrderedDict[str, int] = OrderedDict()
+		self.used = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		os.makedirs(self.disk_dir, exist_ok=True)
+		files = [
+			os.path.join(self.disk_dir, f) for f in os.listdir(self.disk_dir)
+			if f.endswith('.pkl')
+		]
+		for file in sorted(files, key=os.path.getmtime):
+			key = os.path.basename(file)[:-len('.pkl')]
+			self.entries[key] = os.path.getsize(file)
+			self.used += self.entries[key]
+
+	def _path(self, key: str) -> str:
+		return os.path.join(self.disk_dir, f'{key}.pkl')
+
+	def stats(self) -> dict:
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'entries': len(self.entries),
+			'bytes': self.used,
+		}
+
+	def __contains__(self, key: str) -> bool:
+		return key in self.entries
+
+	def get(self, key: str) -> Any:
+		"""The cached value, or None on a miss."""
+		with self.lock:
+			if key not in self.entries:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+		try:
+			with open(self._path(key), 'rb') as f:
+				value = pickle.load(f)
+			os.utime(self._path(key))
+		except Exception as e:
+			logger.error(f'Failed to read cached transcript: {e}')
+			with self.lock:
+				self.misses += 1
+				self.used -= self.entries.pop(key, 0)
+			return None
+		with self.lock:
+			self.hits += 1
+		return value
+
+	def put(self, key: str, value: Any):
+		data = pickle.dumps(value)
+		if len(data) > self.max_bytes:
+			return
+		try:
+			with open(self._path(key), 'wb') as f:
+				f.write(data)
+		except Exception as e:
+			logger.error(f'Failed to write cached transcript: {e}')
+			return
+		with self.lock:
+			self.used += len(data) - self.entries.pop(key, 0)
+			self.entries[key] = len(data)
+			while self.used > self.max_bytes and len(self.entries) > 0:
+				evicted, nbytes = self.entries.popitem(last=False)
+				self.used -= nbytes
+				if os.path.exists(self._path(evicted)):
+					os.remove(self._path(evicted))
+
+	def clear(self):
+		with self.lock:
+			for key in self.entries:
+				if os.path.exists(self._path(key)):
+					os.remove(self._path(key))
+			self.entries.clear()
+			self.used = 0
@@ -1,52 +1,190 @@
-import re, subprocess
-from .base import STTClient_Base
+import json, logging, queue, subprocess, time
+import urllib.error, urllib.request
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from typing import Any, Iterable, Iterator
+from uuid import uuid4
+from .base import STTClient_Base, segment_chunk
 from app.models.stt.stt_client import TranscribeOptions, TranscribeResponse
+from app.settings import STT_WHISPER_CPP
+from app.utils.audio import encode_audio
+
+logger = logging.getLogger('WhisperCpp-client')
+SAMPLE_RATE = 16000
+
+class WhisperCppWorker:
+	"""A long-lived whisper.cpp server process holding the model, answering on a local port."""
+	def __init__(self, model: str, port: int):
+		self.model = model
+		self.port = port
+		self.url = f'http://127.0.0.1:{port}'
+		command = [
+			*STT_WHISPER_CPP['command'], '-m', model, '--host', '127.0.0.1',
+			'--port',
+			str(port)
+		]
+		self.process = subprocess.Popen(
+			command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+		)
+		self.wait_ready(STT_WHISPER_CPP['start_timeout'])
+
+	def alive(self) -> bool:
+		return self.process.poll() is None
+
+	def wait_ready(self, timeout: float):
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			if not self.alive():
+				raise RuntimeError(
+					f'whisper.cpp server exited with {self.process.returncode}'
+				)
+			try:
+				urllib.request.urlopen(self.url, timeout=1).close()
+				return
+			except (urllib.error.URLError, ConnectionError):
+				time.sleep(0.1)
+		self.stop()
+		raise RuntimeError('whisper.cpp server did not start in time')
+
+	def transcribe(self, wav: bytes) -> dict:
+		"""Run the server's /inference on wav data, returning its verbose JSON."""
+		boundary = uuid4().hex
+		body = b''.join([
+			f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="audio.wav"\r\nContent-Type: audio/wav\r\n\r\n'
+			.encode('utf-8'), wav,
+			f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="response_format"\r\n\r\nverbose_json\r\n--{boundary}--\r\n'
+			.encode('utf-8')
+		])
+		req = urllib.request.Request(
+			f'{self.url}/inference',
+			data=body,
+			headers={
+				'Content-Type': f'multipart/form-data; boundary={boundary}'
+			}
+		)
+		with urllib.request.urlopen(req) as res:
+			return json.loads(res.read())
+
+	def stop(self):
+		if self.alive():
+			self.process.terminate()
+			try:
+				self.process.wait(timeout=5)
+			except subprocess.TimeoutExpired:
+				self.process.kill()
 
 class STTClient_WhisperCpp(STTClient_Base):
-	whisper_cpp_path = '/home/user/whisper.cpp'
+	"""Transcribes with a pool of whisper.cpp server processes that keep the model loaded between requests.
 
-	def transcribe(
-		self, options: TranscribeOptions
-	) -> TranscribeResponse:
+	Audio is decoded in memory and posted to an idle worker as wav; the
+	server answers with JSON segments. A worker that died is restarted the
+	next time it's picked. The recordings of a batch are posted to all the
+	workers at once.
+	"""
+	model_name = None
+	workers: list[WhisperCppWorker] = []
+	idle: queue.Queue = queue.Queue()
+
+	def load_model(self, model_name: str | None):
+		model = STT_WHISPER_CPP['model']
+		if self.model_name == model and len(self.workers) > 0:
+			return
+		self.unload_model()
+		self.idle = queue.Queue()
+		self.workers = []
 		try:
-			whisper_cmd = [
-				f"{self.whisper_cpp_path}/main", "-m",
-				f"{self.whisper_cpp_path}/models/ggml-base.bin", "-f",
-				options.file_path, "-ml", "16"
-			]
-
-			process = subprocess.Popen(
-				whisper_cmd,
-				stdout=subprocess.PIPE,
-				stderr=subprocess.PIPE,
-				text=True
-			)
+			for i in range(STT_WHISPER_CPP['workers']):
+				worker = WhisperCppWorker(model, STT_WHISPER_CPP['base_port'] + i)
+				self.workers.append(worker)
+				self.idle.put(worker)
+		except Exception:
+			self.unload_model()
+			raise
+		self.model_name = model
+
+	def unload_model(self):
+		for worker in self.workers:
+			worker.stop()
+		self.workers = []
+		self.model_name = None
 
-			stdout, stderr = process.communicate()
+	def transcribe_wav(self, wav: bytes) -> dict:
+		if len(self.workers) == 0:
+			self.load_model(None)
+		worker = self.idle.get()
+		try:
+			if not worker.alive():
+				logger.warning(f'Restarting whisper.cpp server on {worker.port}')
+				restarted = WhisperCppWorker(worker.model, worker.port)
+				self.workers[self.workers.index(worker)] = restarted
+				worker = restarted
+			return worker.transcribe(wav)
+		finally:
+			self.idle.put(worker)
 
-			if process.returncode != 0:
-				raise RuntimeError(f"Error in transcription: {stderr}")
+	def transcribe_audio(self, audio) -> str:
+		wav = encode_audio(audio, SAMPLE_RATE, 'wav')
+		return self.transcribe_wav(wav)['text'].strip()
 
-			parts = self.parse_transcription(stdout)
-			return TranscribeResponse.model_validate({'parts': parts})
+	def cache_key(self) -> str:
+		return f'whispercpp:{STT_WHISPER_CPP["model"]}'
 
+	def aligned_segments(
+		self, options: TranscribeOptions
+	) -> Iterator[dict]:
+		audio = self.decoded_audio(options)
+		try:
+			result = self.transcribe_wav(
+				encode_audio(audio, SAMPLE_RATE, 'wav')
+			)
 		except Exception as e:
 			raise RuntimeError(f"Error in transcription: {e}")
+		for segment in result['segments']:
+			yield {
+				'start': segment['start'],
+				'end': segment['end'],
+				'text': segment['text']
+			}
+
+	def batch_aligned_segments(
+		self, audios: Iterable[Any]
+	) -> Iterator[tuple[int, list[dict]]]:
+		if len(self.workers) == 0:
+			self.load_model(None)
+
+		def segments(audio: Any) -> list[dict]:
+			options = TranscribeOptions.model_validate({'audio': audio})
+			return list(self.aligned_segments(options))
 
-	def parse_transcription(self, transcription_output):
-		parts = []
-		lines = transcription_output.strip().split('\n')
-		for line in lines:
-			match = re.match(
-				r"\[([0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{3}) --> ([0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{3})\](.*)",
-				line
+		with ThreadPoolExecutor(len(self.workers)) as pool:
+			futures: dict[Future, int] = {}
+			try:
+				for i, audio in enumerate(audios):
+					futures[pool.submit(segments, audio)] = i
+					# a recording queued per worker at most, the rest aren't read yet
+					if len(futures) >= 2 * len(self.workers):
+						finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+						for future in finished:
+							yield futures.pop(future), future.result()
+				for future in as_completed(futures):
+					yield futures[future], future.result()
+			finally:
+				for future in futures:
+					future.cancel()
+
+	def transcript_response(
+		self, segments: list[dict], diarization: Any, result_format: str
+	) -> TranscribeResponse:
+		chunks = [segment_chunk(segment) for segment in segments]
+		if result_format == 'text':
+			return TranscribeResponse(
+				result='\n'.join(chunk.speech for chunk in chunks)
 			)
-			if match:
-				start, end, speech = match.groups()
-				speech = speech.strip()
-				parts.append({
-					'start': start,
-					'end': end,
-					'speech': speech
-				})
-		return parts
+		return TranscribeResponse(result=chunks)
+
+	def transcribe(
+		self, options: TranscribeOptions
+	) -> TranscribeResponse:
+		segments = list(self.aligned_segments(options))
+		return self.transcript_response(
+			segments, None, options.result_format
+		)
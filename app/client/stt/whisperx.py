@@ -1,8 +1,20 @@
 import datetime, os, re, subprocess
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, Union
+import numpy as np
+import torch
 import whisperx
-from .base import STTClient_Base
-from app.models.stt.stt_client import TranscribeOptions, TranscribeResponse
-from app.settings import HF_TOKEN
+from whisperx.vad import merge_chunks
+from .base import STTClient_Base, segment_chunk
+from app.models.stt.stt_client import TranscribeChunk, TranscribeOptions, TranscribeResponse
+from app.settings import HF_TOKEN, STT_BATCH_SIZE, STT_WINDOW_SECONDS
+from app.utils.audio import read_audio_windows
+
+SAMPLE_RATE = 16000
+# a window's last segment ending this close to the window's end may be cut
+#   off, it's transcribed again at the start of the next window
+WINDOW_EDGE = 1.0
 
 class STTClient_WhisperX(STTClient_Base):
 	raw_model = None
@@ -49,52 +61,237 @@ class STTClient_WhisperX(STTClient_Base):
 		gc.collect()
 		torch.cuda.empty_cache()
 
-	def transcribe(
-		self, options: TranscribeOptions
-	) -> TranscribeResponse:
-		file_path = options.file_path
-		exists = os.path.exists(file_path)
-		if not exists:
-			raise Exception('File does not exist')
-		assert self.raw_model
-		assert self.align_model
-		assert self.metadata
+	def cache_key(self) -> str:
+		return 'whisperx:large-v2:en'
 
-		audio = whisperx.load_audio(options.file_path)
-		raw_transcript = self.raw_model.transcribe(
-			audio,
-			batch_size=16,
-			language='en'  # adjust batch_size to fit VRAM
-		)
-		align_transcript = whisperx.align(
-			raw_transcript["segments"],
+	def align(
+		self, segments: list, audio: np.ndarray, offset: float
+	) -> list[dict]:
+		transcript = whisperx.align(
+			segments,
 			self.align_model,
 			self.metadata,
 			audio,
 			device=self.device,
 			return_char_alignments=False
 		)
+		aligned = []
+		for segment in transcript['segments']:
+			if 'start' not in segment:
+				continue
+			for item in [segment, *segment.get('words', [])]:
+				if 'start' in item:
+					item['start'] += offset
+					item['end'] += offset
+			aligned.append(segment)
+		return aligned
+
+	def audio_windows(
+		self, options: TranscribeOptions
+	) -> Iterator[np.ndarray]:
+		window_samples = STT_WINDOW_SECONDS * SAMPLE_RATE
+		if options.audio is not None:
+			for i in range(0, len(options.audio), window_samples):
+				yield options.audio[i:i + window_samples]
+			return
+		if options.file is not None:
+			yield from read_audio_windows(
+				options.file, window_samples, SAMPLE_RATE
+			)
+			return
+		if not os.path.exists(options.file_path):
+			raise Exception('File does not exist')
+		yield from read_audio_windows(
+			options.file_path, window_samples, SAMPLE_RATE
+		)
+
+	def aligned_segments(
+		self, options: TranscribeOptions
+	) -> Iterator[dict]:
+		"""Transcribe STT_WINDOW_SECONDS of audio at a time, yielding word-aligned segments as each window is done.
+
+		A window whose last VAD segment runs up to its end is cut at the start of
+		that segment, which is transcribed again at the head of the next window.
+		Each window is aligned on another thread while the next one is
+		transcribed, so at most a couple of windows of audio are held at once.
+		"""
+		assert self.raw_model
+		assert self.align_model
+		assert self.metadata
+		windows = self.audio_windows(options)
+		carry = np.zeros(0, dtype=np.float32)
+		offset = 0.0
+		aligning: Union[Future, None] = None
+		with ThreadPoolExecutor(1) as align_pool:
+			window = next(windows, None)
+			while window is not None:
+				next_window = next(windows, None)
+				audio = np.concatenate([carry, window])
+				segments = self.raw_model.transcribe(
+					audio, batch_size=STT_BATCH_SIZE, language='en'
+				)['segments']
+				cut = len(audio)
+				if next_window is not None and len(segments) > 1 and segments[
+					-1]['end'] >= cut / SAMPLE_RATE - WINDOW_EDGE:
+					cut = int(segments[-1]['start'] * SAMPLE_RATE)
+					segments = segments[:-1]
+				carry = audio[cut:]
+				if aligning is not None:
+					yield from aligning.result()
+				aligning = align_pool.submit(
+					self.align, segments, audio[:cut], offset
+				)
+				offset += cut / SAMPLE_RATE
+				window = next_window
+			if aligning is not None:
+				yield from aligning.result()
+
+	def vad_segments(self, audio: np.ndarray) -> list[dict]:
+		"""Speech of `audio` in pieces of up to 30 seconds, as FasterWhisperPipeline.transcribe cuts it."""
+		assert self.raw_model
+		vad_params = self.raw_model._vad_params
+		vad = self.raw_model.vad_model({
+			'waveform': torch.from_numpy(audio).unsqueeze(0),
+			'sample_rate': SAMPLE_RATE
+		})
+		return merge_chunks(
+			vad,
+			30,
+			onset=vad_params['vad_onset'],
+			offset=vad_params['vad_offset']
+		)
+
+	def batch_aligned_segments(
+		self, audios: Iterable[np.ndarray]
+	) -> Iterator[tuple[int, list[dict]]]:
+		"""Aligned segments of several recordings, their VAD segments sharing the model's batches of STT_BATCH_SIZE.
 
-		# choose transcript to return
-		# if diarize, then diarize and return
-		# else return align_transcript
-		transcript = align_transcript if not options.diarize else None
-		if not transcript:
-			if not HF_TOKEN:
-				raise Exception('HF_TOKEN not set')
-			assert self.diarize_model
-			diarize_segments = self.diarize_model(audio)
-			diarize_transcript = whisperx.assign_word_speakers(
-				diarize_segments, align_transcript
+		`audios` is read as the model needs more speech, so recordings still
+		being decoded join later batches and each is dropped once aligned.
+		Each recording is aligned (on another thread) as soon as its last
+		segment is transcribed. Recordings longer than a window go through the
+		windowed `aligned_segments` after the rest.
+		"""
+		assert self.raw_model
+		window_samples = STT_WINDOW_SECONDS * SAMPLE_RATE
+		# VAD segments handed to the model, not transcribed yet
+		inputs: deque[tuple[int, dict]] = deque()
+		pending: dict[int, np.ndarray] = {}
+		remaining: dict[int, int] = {}
+		segments: dict[int, list[dict]] = {}
+		silent: deque[int] = deque()
+		long: list[tuple[int, np.ndarray]] = []
+
+		def data():
+			for i, audio in enumerate(audios):
+				if len(audio) > window_samples:
+					long.append((i, audio))
+					continue
+				vad_segments = self.vad_segments(audio)
+				if len(vad_segments) == 0:
+					silent.append(i)
+					continue
+				pending[i] = audio
+				segments[i] = []
+				remaining[i] = len(vad_segments)
+				for vad_segment in vad_segments:
+					inputs.append((i, vad_segment))
+					start = int(vad_segment['start'] * SAMPLE_RATE)
+					end = int(vad_segment['end'] * SAMPLE_RATE)
+					yield {'inputs': audio[start:end]}
+
+		aligning: deque[tuple[int, Future]] = deque()
+		with ThreadPoolExecutor(1) as align_pool:
+			outputs = self.raw_model(
+				data(), batch_size=STT_BATCH_SIZE, num_workers=0
 			)
-			transcript = diarize_transcript
+			for out in outputs:
+				while len(silent) > 0:
+					yield silent.popleft(), []
+				i, vad_segment = inputs.popleft()
+				text = out['text']
+				if STT_BATCH_SIZE in [0, 1, None]:
+					text = text[0]
+				segments[i].append({
+					'text': text,
+					'start': round(vad_segment['start'], 3),
+					'end': round(vad_segment['end'], 3)
+				})
+				remaining[i] -= 1
+				if remaining[i] == 0:
+					aligning.append((
+						i,
+						align_pool.submit(
+							self.align, segments.pop(i), pending.pop(i), 0.0
+						)
+					))
+				while len(aligning) > 0 and aligning[0][1].done():
+					i, future = aligning.popleft()
+					yield i, future.result()
+			while len(aligning) > 0:
+				i, future = aligning.popleft()
+				yield i, future.result()
+		while len(silent) > 0:
+			yield silent.popleft(), []
+		for i, audio in long:
+			options = TranscribeOptions.model_validate({'audio': audio})
+			yield i, list(self.aligned_segments(options))
 
-		if options.result_format == 'text':
-			transcript = self.format_str(transcript['segments'])
-			return TranscribeResponse(result=transcript)
+	def transcribe_stream(
+		self, options: TranscribeOptions
+	) -> Iterator[TranscribeChunk]:
+		if options.diarize:
+			# speaker labels need the whole recording
+			result = self.transcribe(options).result
+			assert isinstance(result, list)
+			yield from result
+			return
+		for segment in self.aligned_segments(options):
+			yield segment_chunk(segment)
+
+	def transcribe_audio(self, audio: np.ndarray) -> str:
+		assert self.raw_model
+		if len(audio) == 0:
+			return ''
+		segments = self.raw_model.transcribe(
+			audio, batch_size=STT_BATCH_SIZE, language='en'
+		)['segments']
+		return ' '.join(segment['text'].strip() for segment in segments)
 
-		parts = self.parse(transcript)
-		return TranscribeResponse(result=parts)
+	def diarize(self, options: TranscribeOptions) -> Any:
+		"""Speaker turns of the whole recording."""
+		if not HF_TOKEN:
+			raise Exception('HF_TOKEN not set')
+		assert self.diarize_model
+		return self.diarize_model(self.decoded_audio(options))
+
+	def transcript_response(
+		self, segments: list[dict], diarization: Any, result_format: str
+	) -> TranscribeResponse:
+		transcript = {'segments': segments}
+		if diarization is not None:
+			transcript = whisperx.assign_word_speakers(
+				diarization, transcript
+			)
+		if result_format == 'text':
+			return TranscribeResponse(
+				result=self.format_str(transcript['segments'])
+			)
+		return TranscribeResponse(result=self.parse(transcript))
+
+	def transcribe(
+		self, options: TranscribeOptions
+	) -> TranscribeResponse:
+		if options.diarize and options.audio is None:
+			# diarization needs the whole recording, decode it once for both
+			options = options.model_copy(
+				update={'audio': self.decoded_audio(options)}
+			)
+		segments = list(self.aligned_segments(options))
+		diarization = self.diarize(options) if options.diarize else None
+		return self.transcript_response(
+			segments, diarization, options.result_format
+		)
 
 	def format_str(self, segments):
 		s = ''
@@ -107,6 +304,8 @@ class STTClient_WhisperX(STTClient_Base):
 			i += 1
 
 		hours = False
+		if len(merged_segments) == 0:
+			return s
 		last = merged_segments[-1]
 		_start = datetime.timedelta(seconds=last['start'])
 		_end = datetime.timedelta(seconds=last['end'])
@@ -124,7 +323,7 @@ class STTClient_WhisperX(STTClient_Base):
 				_start = ':'.join(_start)
 				_end = str(_end).split(':')[1:]
 				_end = ':'.join(_end)
-			speaker = segment['speaker']
+			speaker = segment.get('speaker', '')
 			speech = segment['text']
 			s += f"[{_start}-{_end}] {speaker}: {speech}\n"
 		return s
@@ -1,7 +1,23 @@
-from typing import Union
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Any, Iterator, Union
+import io, os
+from app.args import Args
 from app.client.base_manager import BaseAIManager
 from app.client.stt import STTClient_WhisperCpp, STTClient_WhisperX
-from app.models.stt.stt_client import TranscribeOptions, TranscribeResponse
+from app.client.stt.base import segment_chunk
+from app.client.stt.transcript_cache import TranscriptCache, transcript_key
+from app.models.stt.stt_client import TranscribeChunk, TranscribeOptions, TranscribeResponse
+from app.settings import STT_DECODE_THREADS, STT_TRANSCRIPT_CACHE
+from app.utils.audio import decode_audio
+
+def source_fields(source: Any) -> dict:
+	"""TranscribeOptions fields for a path, bytes or binary file object."""
+	if isinstance(source, str):
+		return {'file_path': source}
+	if isinstance(source, bytes):
+		source = io.BytesIO(source)
+	return {'file': source}
 
 class STTManager(BaseAIManager):
 	clients = {
@@ -9,6 +25,7 @@ class STTManager(BaseAIManager):
 		'whisperx': STTClient_WhisperX.instance
 	}
 	model = None  # either whispercpp or whisperx
+	cache: Union[TranscriptCache, None] = None
 
 	def load_model(self, model_name: str | None):
 		if self.model:
@@ -16,6 +33,7 @@ class STTManager(BaseAIManager):
 		try:
 			if model_name == 'whispercpp':
 				self.model = 'whispercpp'
+				self.clients['whispercpp'].load_model(model_name)
 			elif model_name == 'whisperx':
 				self.model = 'whisperx'
 				self.clients['whisperx'].load_model(model_name)
@@ -26,17 +44,12 @@ class STTManager(BaseAIManager):
 
 	def unload_model(self):
 		if self.model == 'whispercpp':
-			pass
+			self.clients['whispercpp'].unload_model()
 		elif self.model == 'whisperx':
 			self.clients['whisperx'].unload_model()
 		self.model = None
 
-	def transcribe(
-		self,
-		file_path: str,
-		diarize: bool = False,
-		result_format: str = 'json'
-	) -> TranscribeResponse:
+	def get_client(self) -> Union[STTClient_WhisperCpp, STTClient_WhisperX]:
 		if not self.model:
 			self.load_model('whisperx')
 			if not self.model:
@@ -45,13 +58,246 @@ class STTManager(BaseAIManager):
 		assert isinstance(
 			client, STTClient_WhisperCpp
 		) or isinstance(client, STTClient_WhisperX)
-		return client.transcribe(
-			TranscribeOptions.model_validate({
-				'file_path':
-				file_path,
-				'diarize':
-				diarize,
-				'result_format':
-				result_format
-			})
+		return client
+
+	def get_cache(self) -> Union[TranscriptCache, None]:
+		if self.cache is None and STT_TRANSCRIPT_CACHE['max_bytes'] > 0:
+			self.cache = TranscriptCache(
+				STT_TRANSCRIPT_CACHE['disk_dir']
+				or os.path.join(Args['stt_input_dir'], '.transcripts')
+			)
+		return self.cache
+
+	def cache_stats(self) -> dict:
+		cache = self.get_cache()
+		if cache is None:
+			return {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0}
+		return cache.stats()
+
+	def options_key(
+		self, client: Union[STTClient_WhisperCpp, STTClient_WhisperX],
+		options: TranscribeOptions
+	) -> str:
+		if options.audio is None and options.file is None and not os.path.exists(
+			options.file_path
+		):
+			raise Exception('File does not exist')
+		return transcript_key(
+			client.cache_key(), options.audio, options.file_path,
+			options.file
 		)
+
+	def transcript(
+		self,
+		client: Union[STTClient_WhisperCpp, STTClient_WhisperX],
+		options: TranscribeOptions,
+		segments: Union[list[dict], None] = None
+	) -> tuple[list[dict], Any]:
+		"""Aligned segments and (if `options.diarize`) diarization of the audio, from the cache where possible.
+
+		Both are cached separately, so diarizing a recording that was
+		transcribed before only runs the diarization model. `segments` already
+		transcribed (e.g. in a batch) are stored rather than looked up.
+		"""
+		cache = self.get_cache()
+		if cache is None:
+			if options.diarize:
+				options = self.decode_once(client, options)
+			if segments is None:
+				segments = list(client.aligned_segments(options))
+			diarization = client.diarize(options) if options.diarize else None
+			return segments, diarization
+		key = self.options_key(client, options)
+		if segments is None:
+			segments = cache.get(f'{key}-segments')
+		else:
+			cache.put(f'{key}-segments', segments)
+		diarization = None
+		if options.diarize:
+			diarization = cache.get(f'{key}-diarization')
+			if diarization is None:
+				options = self.decode_once(client, options)
+		if segments is None:
+			segments = list(client.aligned_segments(options))
+			cache.put(f'{key}-segments', segments)
+		if options.diarize and diarization is None:
+			diarization = client.diarize(options)
+			cache.put(f'{key}-diarization', diarization)
+		return segments, diarization
+
+	def decode_once(
+		self, client: Union[STTClient_WhisperCpp, STTClient_WhisperX],
+		options: TranscribeOptions
+	) -> TranscribeOptions:
+		"""`options` with the whole recording decoded, for diarization, so transcribing it doesn't decode it a second time."""
+		if options.audio is not None:
+			return options
+		return options.model_copy(
+			update={'audio': client.decoded_audio(options)}
+		)
+
+	def transcribe(
+		self,
+		file_path: str,
+		diarize: bool = False,
+		result_format: str = 'json',
+		audio: Any = None,
+		file: Any = None
+	) -> TranscribeResponse:
+		"""Transcribe the file at `file_path`, or decoded `audio` or the binary file object `file` if one is given."""
+		client = self.get_client()
+		options = TranscribeOptions.model_validate({
+			'file_path': file_path,
+			'diarize': diarize,
+			'result_format': result_format,
+			'audio': audio,
+			'file': file
+		})
+		segments, diarization = self.transcript(client, options)
+		return client.transcript_response(
+			segments, diarization, result_format
+		)
+
+	def transcribe_stream(
+		self,
+		file_path: str,
+		diarize: bool = False,
+		audio: Any = None,
+		file: Any = None
+	) -> Iterator[TranscribeChunk]:
+		client = self.get_client()
+		options = TranscribeOptions.model_validate({
+			'file_path': file_path,
+			'diarize': diarize,
+			'audio': audio,
+			'file': file
+		})
+		if diarize:
+			# speakers are only known once the whole recording is diarized
+			result = self.transcribe(
+				file_path, diarize, 'json', audio, file
+			).result
+			assert isinstance(result, list)
+			yield from result
+			return
+		cache = self.get_cache()
+		if cache is None:
+			yield from client.transcribe_stream(options)
+			return
+		key = self.options_key(client, options)
+		segments = cache.get(f'{key}-segments')
+		if segments is not None:
+			for segment in segments:
+				yield segment_chunk(segment)
+			return
+		segments = []
+		for segment in client.aligned_segments(options):
+			segments.append(segment)
+			yield segment_chunk(segment)
+		cache.put(f'{key}-segments', segments)
+
+	def transcribe_batch(
+		self,
+		sources: list[Any],
+		diarize: bool = False,
+		result_format: str = 'json'
+	) -> Iterator[tuple[int, Union[TranscribeResponse, Exception]]]:
+		"""Transcribe many recordings (paths, bytes or file objects), yielding `(index, response or error)` as each is done.
+
+		Sources are looked up in the cache by their file bytes. The rest are
+		decoded on STT_DECODE_THREADS threads, a few at a time, and go to the
+		client as each is decoded, so that (with WhisperX) speech from several
+		recordings fills each of the model's batches without the whole batch
+		held decoded in memory.
+		"""
+		client = self.get_client()
+		cache = self.get_cache()
+		options: dict[int, TranscribeOptions] = {}
+		misses: list[int] = []
+		for i, source in enumerate(sources):
+			# keyed by the file bytes like /stt/v1/transcribe, so the two share
+			#   cached transcripts and a hit isn't decoded at all
+			options[i] = TranscribeOptions.model_validate({
+				**source_fields(source), 'diarize': diarize,
+				'result_format': result_format
+			})
+			if cache is not None:
+				try:
+					key = self.options_key(client, options[i])
+				except Exception as e:
+					yield i, e
+					continue
+				if f'{key}-segments' in cache:
+					yield i, self.respond(client, options[i])
+					continue
+			misses.append(i)
+		# misses in the order they went to the client
+		fed: list[int] = []
+		failed: list[tuple[int, Exception]] = []
+		# decoded audio kept for diarization, until the recording is done
+		kept: dict[int, Any] = {}
+
+		def decoded() -> Iterator[Any]:
+			with ThreadPoolExecutor(STT_DECODE_THREADS) as decode_pool:
+				queued = iter(misses)
+				running: dict[Future, int] = {}
+				while True:
+					for i in islice(queued, STT_DECODE_THREADS - len(running)):
+						running[decode_pool.submit(decode_audio, sources[i])] = i
+					if len(running) == 0:
+						return
+					finished, _ = wait(running, return_when=FIRST_COMPLETED)
+					for future in finished:
+						i = running.pop(future)
+						try:
+							audio = future.result()
+						except Exception as e:
+							failed.append((i, e))
+							continue
+						fed.append(i)
+						if diarize:
+							kept[i] = audio
+						yield audio
+
+		def respond(i: int, segments: list[dict]):
+			opt = options[i]
+			if i in kept:
+				opt = opt.model_copy(update={'audio': kept.pop(i)})
+			return self.respond(client, opt, segments)
+
+		done: set[int] = set()
+		try:
+			for j, segments in client.batch_aligned_segments(decoded()):
+				while len(failed) > 0:
+					i, e = failed.pop(0)
+					done.add(i)
+					yield i, e
+				i = fed[j]
+				done.add(i)
+				yield i, respond(i, segments)
+			for i, e in failed:
+				done.add(i)
+				yield i, e
+		except Exception as e:
+			for i in misses:
+				if i not in done:
+					yield i, e
+
+	def respond(
+		self,
+		client: Union[STTClient_WhisperCpp, STTClient_WhisperX],
+		options: TranscribeOptions,
+		segments: Union[list[dict], None] = None
+	) -> Union[TranscribeResponse, Exception]:
+		try:
+			segments, diarization = self.transcript(
+				client, options, segments
+			)
+			return client.transcript_response(
+				segments, diarization, options.result_format
+			)
+		except Exception as e:
+			return e
+
+	def transcribe_audio(self, audio: Any) -> str:
+		return self.get_client().transcribe_audio(audio)
@@ -1,5 +1,5 @@
-from typing import Union
-from app.models.tts.tts_client import SpeakOptions, SpeakToFileOptions, SpeakResponse, SpeakToFileResponse
+from typing import Iterator, Union
+from app.models.tts.tts_client import SpeakOptions, SpeakStreamOptions, SpeakToFileOptions, SpeakResponse, SpeakToFileResponse
 from app.settings import DEVICE_MAP
 
 # TODO i guess do we need a Base class for these Base classes?
@@ -19,6 +19,9 @@ class TTSClient_Base:
 	loaded = False
 	model = None
 	model_name: Union[str, None] = None
+	# estimate_memory: weights times factor, plus buffers
+	memory_factor = 1.0
+	memory_overhead = 0
 	# model_abspath: Union[str, None] = None
 
 	# OPTIONS_MAP: dict[str, str] = {}
@@ -65,16 +68,46 @@ class TTSClient_Base:
 	def unload_model(self):
 		raise NotImplementedError()
 
+	def estimate_memory(self, model_bytes: int) -> int:
+		"""Rough memory use of a loaded model whose files take `model_bytes` on disk."""
+		return int(model_bytes * self.memory_factor) + self.memory_overhead
+
 	def speak(self, options: SpeakOptions) -> SpeakResponse:
 		"""Generate audio from a prompt. Returns wav file data."""
 		raise NotImplementedError()
 
+	def speak_audio(self, options: SpeakOptions) -> bytes:
+		"""Generate audio from a prompt, encoded in `options.format`."""
+		raise NotImplementedError()
+
 	def speak_to_file(
 		self, options: SpeakToFileOptions
 	) -> SpeakToFileResponse:
 		"""Generate audio from a prompt and save to file on server."""
 		raise NotImplementedError()
 
+	def cached_voices(self) -> list[str]:
+		"""Voices whose conditioning is cached, for clients that clone voices."""
+		return []
+
+	def speak_batch(
+		self, options: list[SpeakToFileOptions]
+	) -> Iterator[tuple[int, Union[SpeakToFileResponse, Exception]]]:
+		"""Speak to file for each of `options`, yielding `(index, response or error)` as each finishes."""
+		for i, o in enumerate(options):
+			try:
+				yield i, self.speak_to_file(o)
+			except Exception as e:
+				yield i, e
+
+	def sample_rate(self) -> int:
+		"""Sample rate of the audio the loaded model generates."""
+		raise NotImplementedError()
+
+	def speak_stream(self, options: SpeakStreamOptions) -> Iterator[bytes]:
+		"""Generate audio from a prompt, yielding chunks in `options.format` as they're ready."""
+		raise NotImplementedError()
+
 	# def add_voice(self, voice: str, voice_path: str):
 	# voice_path should be speaker file already saved to disk
 	# (api should handle saving the upload)
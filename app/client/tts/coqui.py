@@ -1,7 +1,14 @@
 import base64, logging, os, time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterator, Union
+from uuid import uuid4
 from app.args import Args
-from app.models.tts.tts_client import SpeakOptions, SpeakToFileOptions, SpeakResponse, SpeakToFileResponse
+from app.models.tts.tts_client import SpeakOptions, SpeakStreamOptions, SpeakToFileOptions, SpeakResponse, SpeakToFileResponse
+from app.settings import TTS_STREAM_CHUNK_SIZE, TTS_VOICE_CACHE
+from app.utils.audio import encode_audio, encode_stream, to_pcm16
 from .base import TTSClient_Base
+from .voice_cache import VoiceCache
 from TTS.api import TTS
 import torch
 
@@ -13,6 +20,7 @@ DEFAULT_VOICE = 'jaiden-10s.wav'
 
 class TTSClient_Coqui(TTSClient_Base):
 	device = 'cuda' if torch.cuda.is_available() else 'cpu'
+	voice_cache: Union[VoiceCache, None] = None
 
 	def get_voice_path(self, voice: str) -> str:
 		if voice is None or voice == '':
@@ -21,6 +29,15 @@ class TTSClient_Coqui(TTSClient_Base):
 			voice += '.wav'
 		return os.path.join(Args['tts_voices_dir'], voice)
 
+	def pick_voice(self, options: SpeakOptions) -> str:
+		voice = options.voice if options.voice != '' else 'default'
+		if voice is not None and voice != 'default':
+			return self.get_voice_path(voice)
+		return self.get_voice_path(DEFAULT_VOICE)
+
+	# xtts_v2 comes from the TTS model cache, not the models dir
+	memory_overhead = 2 << 30
+
 	def load_model(self, model_name: str):
 		if self.model_name == model_name:
 			return
@@ -36,6 +53,14 @@ class TTSClient_Coqui(TTSClient_Base):
 												).to(self.device, non_blocking=True)
 			self.model_name = model_name
 			self.loaded = True
+			if self.xtts() is not None:
+				self.voice_cache = VoiceCache(
+					model_name,
+					self.device,
+					disk_dir=TTS_VOICE_CACHE['disk_dir']
+					or os.path.join(voices_dir, '.latents')
+				)
+				self.warm_voice_cache()
 		except Exception as e:
 			self.model = None
 			self.model_name = None
@@ -52,45 +77,113 @@ class TTSClient_Coqui(TTSClient_Base):
 		self.model = None
 		self.model_name = None
 		self.loaded = False
+		self.voice_cache = None
 		torch.cuda.empty_cache()
 		logger.debug(
 			f'Unloaded model in {time.time() - start} seconds.'
 		)
 
-	def speak(self, gen_options: SpeakOptions) -> SpeakResponse:
+	def xtts(self) -> Any:
+		"""The loaded model if it's XTTS, which is conditioned on cached voice latents and can stream."""
+		tts_model = self.model.synthesizer.tts_model
+		if hasattr(tts_model, 'get_conditioning_latents'):
+			return tts_model
+		return None
+
+	def xtts_settings(self, xtts: Any) -> dict:
+		# the sampling settings tts_to_file would use
+		config = xtts.config
+		return {
+			'temperature': config.temperature,
+			'length_penalty': config.length_penalty,
+			'repetition_penalty': config.repetition_penalty,
+			'top_k': config.top_k,
+			'top_p': config.top_p,
+		}
+
+	def voice_latents(self, voice: str) -> tuple[Any, Any]:
+		"""XTTS `(gpt_cond_latent, speaker_embedding)` for the voice wav at `voice`."""
+		xtts = self.xtts()
+		assert self.voice_cache is not None
+		return self.voice_cache.get(
+			voice,
+			lambda path: xtts.get_conditioning_latents(audio_path=[path])
+		)
+
+	def warm_voice_cache(self):
+		assert self.voice_cache is not None
+		start = time.time()
+		voices_dir = Args['tts_voices_dir']
+		files = sorted(f for f in os.listdir(voices_dir) if f.endswith('.wav'))
+		for file in files[:self.voice_cache.max_voices]:
+			try:
+				self.voice_latents(os.path.join(voices_dir, file))
+			except Exception as e:
+				logger.error(f'Failed to compute latents for {file}: {e}')
+		logger.debug(
+			f'Warmed voice cache in {time.time() - start} seconds.'
+		)
+
+	def cached_voices(self) -> list[str]:
+		if self.voice_cache is None:
+			return []
+		return [os.path.basename(p) for p in self.voice_cache.voices()]
+
+	def synthesize(self, options: SpeakOptions) -> Any:
+		"""Generate audio samples for `options`."""
+		voice = self.pick_voice(options)
+		xtts = self.xtts()
+		if xtts is None:
+			return self.model.tts(
+				text=options.text,
+				language=options.language,
+				speaker_wav=voice,
+				split_sentences=options.split_sentences
+			)
+		gpt_cond_latent, speaker_embedding = self.voice_latents(voice)
+		out = xtts.inference(
+			options.text,
+			options.language,
+			gpt_cond_latent,
+			speaker_embedding,
+			enable_text_splitting=options.split_sentences,
+			**self.xtts_settings(xtts)
+		)
+		return out['wav']
+
+	def speak_audio(self, gen_options: SpeakOptions) -> bytes:
 		if not self.loaded or self.model is None:
 			raise Exception('Model not loaded.')
 		if gen_options.text is None:
 			raise Exception('No text provided.')
+		wav = self.synthesize(gen_options)
+		return encode_audio(wav, self.sample_rate(), gen_options.format)
+
+	def speak(self, gen_options: SpeakOptions) -> SpeakResponse:
 		start = time.time()
-		tmp_name = f'tmp-{time.time()}.wav'
-		tmp_name = os.path.join(Args['tts_output_dir'], tmp_name)
-		voice = gen_options.voice if gen_options.voice != '' else 'default'
-		if voice is not None and voice != 'default':
-			voice = self.get_voice_path(voice)
-		else:
-			voice = self.get_voice_path(DEFAULT_VOICE)
-		try:
-			audio = self.model.tts_to_file(
-				text=gen_options.text,
-				language=gen_options.language,
-				file_path=tmp_name,
-				speaker_wav=voice
-			)
-		except Exception as e:
-			msg = str(e)
-			print(msg)
+		audio = self.speak_audio(gen_options)
 		end = time.time()
-		# read and return file content
-		with open(tmp_name, 'rb') as f:
-			audio = f.read()
-		os.remove(tmp_name)
 		b64 = base64.b64encode(audio).decode('utf-8')
 		return SpeakResponse.model_validate({
 			'audio': b64,
 			'time': end - start
 		})
 
+	def save_audio(
+		self, gen_options: SpeakToFileOptions, wav: Any, start: float
+	) -> SpeakToFileResponse:
+		sample_rate = self.sample_rate()
+		audio = encode_audio(wav, sample_rate, gen_options.format)
+		file = gen_options.file if gen_options.file != '' else f'tts-{uuid4().hex}.{gen_options.format}'
+		file_path = os.path.join(Args['tts_output_dir'], file)
+		with open(file_path, 'wb') as f:
+			f.write(audio)
+		return SpeakToFileResponse.model_validate({
+			'file_name': file,
+			'time': time.time() - start,
+			'duration': len(wav) / sample_rate
+		})
+
 	def speak_to_file(
 		self, gen_options: SpeakToFileOptions
 	) -> SpeakToFileResponse:
@@ -99,23 +192,115 @@ class TTSClient_Coqui(TTSClient_Base):
 		if gen_options.text is None:
 			raise Exception('No text provided.')
 		start = time.time()
-		file = gen_options.file if gen_options.file != '' else f'tts-{time.time()}.wav'
-		file_path = os.path.join(Args['tts_output_dir'], file)
-		voice = gen_options.voice if gen_options.voice != '' else 'default'
-		if voice is not None and voice != 'default':
-			voice = self.get_voice_path(voice)
-		else:
-			voice = self.get_voice_path(DEFAULT_VOICE)
-		self.model.tts_to_file(
-			text=gen_options.text,
-			language=gen_options.language,
-			file_path=file_path,
-			speaker_wav=voice
+		wav = self.synthesize(gen_options)
+		return self.save_audio(gen_options, wav, start)
+
+	def prepare(self, gen_options: SpeakOptions):
+		"""Check `gen_options` and have its voice conditioning cached."""
+		if gen_options.text is None or gen_options.text.strip() == '':
+			raise Exception('No text provided.')
+		voice = self.pick_voice(gen_options)
+		if self.xtts() is not None:
+			self.voice_latents(voice)
+
+	def speak_batch(
+		self, options: list[SpeakToFileOptions]
+	) -> Iterator[tuple[int, Union[SpeakToFileResponse, Exception]]]:
+		"""Speak to file for each of `options`, yielding `(index, response or error)` as each finishes.
+
+		XTTS synthesizes one utterance at a time, so rather than batching, the
+		items are grouped by voice and language and pipelined: while one is
+		synthesized the next one's voice conditioning is looked up and the
+		previous one is encoded and written.
+		"""
+		if not self.loaded or self.model is None:
+			raise Exception('Model not loaded.')
+		order = sorted(
+			range(len(options)),
+			key=lambda i: (options[i].voice, options[i].language)
 		)
-		end = time.time()
-		return SpeakToFileResponse.model_validate({
-			'file_name':
-			gen_options.file,
-			'time':
-			end - start
-		})
+		if len(order) == 0:
+			return
+		with ThreadPoolExecutor(1) as prepare_pool, ThreadPoolExecutor(
+			1
+		) as encode_pool:
+			prepared = prepare_pool.submit(self.prepare, options[order[0]])
+			encoding: deque[tuple[int, Future]] = deque()
+			for k, i in enumerate(order):
+				current = prepared
+				if k + 1 < len(order):
+					prepared = prepare_pool.submit(
+						self.prepare, options[order[k + 1]]
+					)
+				start = time.time()
+				try:
+					current.result()
+					wav = self.synthesize(options[i])
+				except Exception as e:
+					yield i, e
+					continue
+				encoding.append((
+					i,
+					encode_pool.submit(self.save_audio, options[i], wav, start)
+				))
+				while len(encoding) > 0 and encoding[0][1].done():
+					yield self._saved(*encoding.popleft())
+			while len(encoding) > 0:
+				yield self._saved(*encoding.popleft())
+
+	def _saved(
+		self, i: int, future: Future
+	) -> tuple[int, Union[SpeakToFileResponse, Exception]]:
+		try:
+			return i, future.result()
+		except Exception as e:
+			return i, e
+
+	def sample_rate(self) -> int:
+		return self.model.synthesizer.output_sample_rate
+
+	def split_text(self, options: SpeakOptions) -> list[str]:
+		if not options.split_sentences:
+			return [options.text]
+		sentences = self.model.synthesizer.split_into_sentences(options.text)
+		return [s for s in sentences if s.strip() != '']
+
+	def speak_stream(
+		self, gen_options: SpeakStreamOptions
+	) -> Iterator[bytes]:
+		"""Synthesize sentence by sentence into one stream in `format`. With XTTS, audio is sent as the model decodes it, mid-sentence."""
+		if not self.loaded or self.model is None:
+			raise Exception('Model not loaded.')
+		if gen_options.text is None:
+			raise Exception('No text provided.')
+		yield from encode_stream(
+			self.pcm_stream(gen_options), self.sample_rate(),
+			gen_options.format
+		)
+
+	def pcm_stream(self, gen_options: SpeakStreamOptions) -> Iterator[bytes]:
+		assert self.model is not None
+		voice = self.pick_voice(gen_options)
+		xtts = self.xtts()
+		if xtts is not None:
+			gpt_cond_latent, speaker_embedding = self.voice_latents(voice)
+		for sentence in self.split_text(gen_options):
+			if xtts is None:
+				wav = self.model.tts(
+					text=sentence,
+					language=gen_options.language,
+					speaker_wav=voice,
+					split_sentences=False
+				)
+				yield to_pcm16(wav)
+				continue
+			chunks = xtts.inference_stream(
+				sentence,
+				gen_options.language,
+				gpt_cond_latent,
+				speaker_embedding,
+				stream_chunk_size=TTS_STREAM_CHUNK_SIZE,
+				**self.xtts_settings(xtts)
+			)
+			for chunk in chunks:
+				yield to_pcm16(chunk.squeeze().cpu().numpy())
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from typing import Any, Union
+import hashlib, logging, os, threading
+import torch
+from app.settings import TTS_VOICE_CACHE
+
+logger = logging.getLogger('TTS-voice-cache')
+
+def tensors_nbytes(value: Any) -> int:
+	return sum(t.element_size() * t.nelement() for t in value)
+
+class VoiceCache:
+	"""LRU store of voice conditioning (e.g. XTTS GPT latents and speaker embedding), keyed by reference wav path and mtime.
+
+	Entries are bounded by count and bytes in memory, and saved with
+	`torch.save` under `disk_dir` so they survive a restart. A voice file
+	that changes on disk gets a new mtime, so its stale entry is never hit.
+	"""
+	def __init__(
+		self,
+		model_name: str,
+		device: str,
+		max_voices: int = TTS_VOICE_CACHE['max_voices'],
+		max_bytes: int = TTS_VOICE_CACHE['max_bytes'],
+		disk_dir: str = TTS_VOICE_CACHE['disk_dir'],
+	):
+		self.model_name = model_name
+		self.device = device
+		self.max_voices = max_voices
+		self.max_bytes = max_bytes
+		self.disk_dir = disk_dir
+		# (path, mtime) -> (conditioning tensors, bytes)
+		self.entries: OrderedDict[tuple, tuple[Any, int]] = OrderedDict()
+		self.used = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		if self.disk_dir:
+			os.makedirs(self.disk_dir, exist_ok=True)
+
+	def _disk_path(self, key: tuple[str, float]) -> str:
+		name = f'{self.model_name}:{key[0]}:{key[1]}'
+		digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+		return os.path.join(self.disk_dir, f'{digest}.pt')
+
+	def voices(self) -> list[str]:
+		"""Paths of the cached voices whose files haven't changed since."""
+		with self.lock:
+			keys = list(self.entries.keys())
+		return [
+			path for path, mtime in keys
+			if os.path.exists(path) and os.path.getmtime(path) == mtime
+		]
+
+	def get(self, path: str, compute: Any) -> Any:
+		"""Conditioning for the voice at `path`, from memory, disk, or `compute(path)`."""
+		key = (path, os.path.getmtime(path))
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry[0]
+			self.misses += 1
+		value = self._read(key)
+		if value is None:
+			value = compute(path)
+			self._write(key, value)
+		self._put(key, value)
+		return value
+
+	def _put(self, key: tuple[str, float], value: Any):
+		nbytes = tensors_nbytes(value)
+		with self.lock:
+			# an older version of the same file
+			for old in [k for k in self.entries if k[0] == key[0]]:
+				self.used -= self.entries.pop(old)[1]
+				self._remove_file(old)
+			self.entries[key] = (value, nbytes)
+			self.used += nbytes
+			while len(self.entries) > 1 and (
+				len(self.entries) > self.max_voices or self.used > self.max_bytes
+			):
+				_, (_, evicted) = self.entries.popitem(last=False)
+				self.used -= evicted
+
+	def _read(self, key: tuple[str, float]) -> Union[Any, None]:
+		if not self.disk_dir:
+			return None
+		file = self._disk_path(key)
+		if not os.path.exists(file):
+			return None
+		try:
+			return tuple(torch.load(file, map_location=self.device))
+		except Exception as e:
+			logger.error(f'Failed to read cached voice {key[0]}: {e}')
+			return None
+
+	def _write(self, key: tuple[str, float], value: Any):
+		if not self.disk_dir:
+			return
+		try:
+			torch.save([t.cpu() for t in value], self._disk_path(key))
+		except Exception as e:
+			logger.error(f'Failed to write cached voice {key[0]}: {e}')
+
+	def _remove_file(self, key: tuple[str, float]):
+		if self.disk_dir and os.path.exists(self._disk_path(key)):
+			os.remove(self._disk_path(key))
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.used = 0
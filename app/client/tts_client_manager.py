@@ -1,8 +1,9 @@
-from typing import Union
+from typing import Iterator, Union
 from app.args import Args
 from app.client.base_manager import BaseAIManager
 from app.client.tts import TTSClient_Coqui
-from app.models.tts.tts_client import SpeakOptions, SpeakToFileOptions, SpeakResponse, SpeakToFileResponse
+from app.models.tts.tts_client import SpeakOptions, SpeakStreamOptions, SpeakToFileOptions, SpeakResponse, SpeakToFileResponse
+from app.settings import MODEL_MEMORY_BUDGET
 
 class TTSManager(BaseAIManager):
 	clients: dict[str, TTSClient_Coqui] = {
@@ -12,10 +13,12 @@ class TTSManager(BaseAIManager):
 	loader: Union[TTSClient_Coqui, None] = None
 
 	def __init__(self):
+		super().__init__()
 		self.clients = {
 			'coqui': TTSClient_Coqui.instance,
 		}
 		self.default_model = Args['tts_model']
+		self.memory_budget = MODEL_MEMORY_BUDGET.get('tts', 0)
 		# self.models_dir = Args['tts_models_dir']
 
 	def pick_client(self, model_name: str):
@@ -34,6 +37,11 @@ class TTSManager(BaseAIManager):
 	# def list_voices(self):
 	# includes local and external voices
 
+	def cached_voices(self) -> list[str]:
+		if not self.loader:
+			return []
+		return self.loader.cached_voices()
+
 	def speak(self, gen_options: SpeakOptions) -> SpeakResponse:
 		if not self.loader:
 			self.load_model(None)
@@ -41,6 +49,13 @@ class TTSManager(BaseAIManager):
 				raise Exception('Model not loaded.')
 		return self.loader.speak(gen_options)
 
+	def speak_audio(self, gen_options: SpeakOptions) -> bytes:
+		if not self.loader:
+			self.load_model(None)
+			if not self.loader:
+				raise Exception('Model not loaded.')
+		return self.loader.speak_audio(gen_options)
+
 	def speak_to_file(
 		self, gen_options: SpeakToFileOptions
 	) -> SpeakToFileResponse:
@@ -49,3 +64,21 @@ class TTSManager(BaseAIManager):
 			if not self.loader:
 				raise Exception('Model not loaded.')
 		return self.loader.speak_to_file(gen_options)
+
+	def speak_stream(
+		self, gen_options: SpeakStreamOptions
+	) -> Iterator[bytes]:
+		if not self.loader:
+			self.load_model(None)
+			if not self.loader:
+				raise Exception('Model not loaded.')
+		return self.loader.speak_stream(gen_options)
+
+	def speak_batch(
+		self, options: list[SpeakToFileOptions]
+	) -> Iterator[tuple[int, Union[SpeakToFileResponse, Exception]]]:
+		if not self.loader:
+			self.load_model(None)
+			if not self.loader:
+				raise Exception('Model not loaded.')
+		return self.loader.speak_batch(options)
@@ -5,6 +5,7 @@ torch.cuda.empty_cache()
 import argparse, logging, os
 import uvicorn, fastapi
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 
 from app.args import Args
 from app.settings import HOST, PORT, LLM_MODELS_DIR, LLM_MODEL, TTS_MODELS_DIR, TTS_MODEL, TTS_OUTPUT_DIR, TTS_VOICES_DIR, STT_INPUT_DIR, IMG_MODELS_DIR, IMG_MODEL
@@ -165,6 +166,12 @@ if __name__ == '__main__':
 		allow_headers=["*"],
 	)
 
+	from app.utils.workers import WorkerBusy
+
+	@app.exception_handler(WorkerBusy)
+	async def worker_busy_handler(request, exc: WorkerBusy):
+		return JSONResponse(status_code=503, content={'detail': str(exc)})
+
 	if args.llm or args.openai:
 		if args.openai:
 			from llama_cpp.server.__main__ import main
@@ -28,6 +28,44 @@ class Txt2ImgOptions(BaseModel):
 	sampler_name: Optional[str] = Field(
 		None, description='Sampler name.'
 	)
+	batch_size: int = Field(
+		1, description='Number of images generated together per iteration.'
+	)
+	n_iter: int = Field(
+		1,
+		description=
+		'Number of iterations. batch_size * n_iter images are returned, image i using seed + i.'
+	)
+	freeu: bool = Field(
+		True, description='Apply FreeU (IMG_FREEU) to the UNet.'
+	)
+
+class Txt2ImgStreamRequest(Txt2ImgOptions):
+	"""Options to generate images from text, sending progress while they're generated."""
+	preview_steps: int = Field(
+		5,
+		description=
+		'Send low-resolution previews of the images every this many steps, 0 for none.'
+	)
+
+class Txt2ImgProgress(BaseModel):
+	"""Progress of a txt2img request, sent after each denoising step."""
+	step: int = Field(..., description='Step of the current batch.')
+	steps: int = Field(..., description='Steps per batch.')
+	progress: float = Field(
+		..., description='Fraction of the request done, 0 to 1.'
+	)
+	eta: float = Field(
+		..., description='Estimated seconds until the request is done.'
+	)
+	images: List[int] = Field(
+		[], description='Indexes of the images in `previews`.'
+	)
+	previews: List[str] = Field(
+		[],
+		description=
+		'Base64-encoded JPEG previews, at 1/8 of the image size, approximated from the latents.'
+	)
 
 class Txt2ImgResponse(BaseModel):
 	"""Response to generate image from text."""
@@ -43,3 +81,17 @@ class Txt2ImgResponse(BaseModel):
 	info: Txt2ImgOptions = Field(
 		..., description='Information about the image generation.'
 	)
+
+class EmbeddingCacheStats(BaseModel):
+	"""Prompt embedding cache use of the loaded models."""
+	hits: int = Field(
+		..., description='Prompts whose embeddings were reused.'
+	)
+	misses: int = Field(
+		..., description='Prompts run through the text encoder(s).'
+	)
+	hit_rate: float = Field(..., description='hits / (hits + misses).')
+	entries: int = Field(..., description='Cached prompts.')
+	bytes: int = Field(
+		..., description='Device memory used by the cached embeddings.'
+	)
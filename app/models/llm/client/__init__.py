@@ -1,5 +1,6 @@
 from ._common import *
 from .exllamav2 import *
+from .fake import *
 from .llamacpppython import *
 from .openai import *
 from .transformers import *
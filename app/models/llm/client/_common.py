@@ -41,6 +41,11 @@ class CompletionOptions(BaseModel):
 	mirostat_tau: float = Field(0.0, description='Mirostat tau.')
 	mirostat_eta: float = Field(0.0, description='Mirostat eta.')
 	stop: list[str] = Field([], description='Stop strings.')
+	stream: bool = Field(
+		False,
+		description=
+		'Whether to stream the completion token-by-token (server-sent events over HTTP, incremental frames over websocket).'
+	)
 
 	# LlamaCppPython options
 	frequency_penalty: Optional[float] = Field(
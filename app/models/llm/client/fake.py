@@ -0,0 +1,10 @@
+from pydantic import BaseModel, Field
+
+class CompletionOptions_Fake(BaseModel):
+	prompt: str = Field(
+		..., description='Prompt to feed to model.'
+	)
+	max_tokens: int = Field(
+		128, description='Maximum number of tokens to generate.'
+	)
+	stop: list[str] = Field([], description='Stop strings.')
@@ -36,10 +36,15 @@ class CompletionRequest(CompletionOptions):
 	prefix_response: str = Field(
 		'', description='Prefix to add to prompt.'
 	)
+	conversation_id: str = Field(
+		'',
+		description=
+		'Conversation the request continues. With `parts`, prior messages already rendered for the conversation are reused instead of being formatted again.'
+	)
 	model: str = Field(
 		'',
 		description=
-		'Model to use. If local, model will be loaded (current model will be unloaded). If blank, current (local) model will be used.',
+		'Model to use. If local, model will be loaded (least recently used models are unloaded if it does not fit). If blank, current (local) model will be used.',
 		examples=['mistral-7b.Q4.gguf', 'openai:gpt-3.5-turbo']
 	)
 
@@ -53,6 +58,29 @@ class CompletionUsage(BaseModel):
 	total_tokens: int = Field(
 		0, description='Total number of tokens.'
 	)
+	cached_tokens: int = Field(
+		0,
+		description=
+		'Number of prompt tokens reused from an earlier request instead of being evaluated.'
+	)
+	prefix_cache_hits: int = Field(
+		0, description='Prefix cache hits since the model was loaded.'
+	)
+	prefix_cache_misses: int = Field(
+		0, description='Prefix cache misses since the model was loaded.'
+	)
+	draft_tokens: int = Field(
+		0,
+		description='Tokens proposed by the draft model (speculative decoding).'
+	)
+	accepted_draft_tokens: int = Field(
+		0, description='Draft tokens the model accepted.'
+	)
+	dropped_tokens: int = Field(
+		0,
+		description=
+		'Tokens of the oldest prior messages left out so the prompt and max_tokens fit the context.'
+	)
 
 class CompletionChoice(BaseModel):
 	text: str = Field(..., description='Completion text.')
@@ -95,6 +123,55 @@ class CompletionReturn(BaseModel):
 	params: dict[
 		str, Any] = Field(..., description='Completion parameters.')
 
+class BatchCompletionRequest(BaseModel):
+	requests: list[CompletionRequest] = Field(
+		..., description='Completion requests to run.'
+	)
+	stream: bool = Field(
+		False,
+		description=
+		'Stream results as JSON lines as they finish, instead of returning them all in order.'
+	)
+
+class BatchCompletionItem(BaseModel):
+	index: int = Field(
+		..., description='Position of the request in the batch.'
+	)
+	result: Union[CompletionResult, None] = Field(
+		None, description='Completion result.'
+	)
+	params: dict[str, Any] = Field(
+		{}, description='Completion parameters.'
+	)
+	error: Union[
+		str, None] = Field(None, description='Error message.')
+
+class BatchCompletionStats(BaseModel):
+	size: int = Field(..., description='Number of requests.')
+	prompt_tokens: int = Field(
+		0, description='Number of tokens in prompts.'
+	)
+	completion_tokens: int = Field(
+		0, description='Number of tokens in completions.'
+	)
+	time: float = Field(..., description='Time to run requests.')
+	tokens_per_second: float = Field(
+		0, description='Completion tokens per second.'
+	)
+
+class BatchCompletionResponse(BaseModel):
+	results: list[BatchCompletionItem] = Field(
+		..., description='Results, in request order.'
+	)
+	batches: list[BatchCompletionStats] = Field(
+		[],
+		description=
+		'Stats of each batch the requests ran in, requests sharing a prompt prefix run together.'
+	)
+	stats: BatchCompletionStats = Field(
+		..., description='Stats of the whole run.'
+	)
+
 class DownloadModelRequest(BaseModel):
 	model: str = Field(
 		...,
@@ -128,6 +205,11 @@ class GetModelResponse(BaseModel):
 		description='Loader name.',
 		examples=['llamacpp', 'exllamav2', 'transformers']
 	)
+	loaded_models: list[str] = Field(
+		[],
+		description='Models currently resident, least recently used first.',
+		examples=[['model_a.gguf', 'model_b-exl2']]
+	)
 
 class LoadModelRequest(BaseModel):
 	model: str = Field(
@@ -135,6 +217,12 @@ class LoadModelRequest(BaseModel):
 		description='Model to load.',
 		examples=['username/model_name[:branch]']
 	)
+	draft_model: str = Field(
+		'',
+		description=
+		'Smaller model from llm_models_dir to draft tokens for `model` (speculative decoding). Must use the same loader and tokenizer.',
+		examples=['tinyllama-1.1b.Q4_K_M.gguf']
+	)
 
 class LoadModelResponse(BaseModel):
 	status: str = Field(
@@ -152,6 +240,9 @@ class LoadModelResponse(BaseModel):
 		description='Loader name.',
 		examples=['llamacpp', 'exllamav2', 'transformers']
 	)
+	draft_model: Union[str, None] = Field(
+		None, description='Draft model paired with the model.'
+	)
 	time: float = Field(..., description='Time to load model.')
 	error: Union[
 		str, None] = Field(None, description='Error message.')
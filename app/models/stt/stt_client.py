@@ -1,9 +1,16 @@
-from pydantic import BaseModel
-from typing import Union
+from pydantic import BaseModel, ConfigDict
+from typing import Any, Union
 
 class TranscribeOptions(BaseModel):
 	"""Options for transcribing audio."""
-	file_path: str
+	model_config = ConfigDict(arbitrary_types_allowed=True)
+
+	file_path: str = ''
+	# decoded float32 16 kHz mono samples, used instead of file_path if set
+	audio: Any = None
+	# binary file object (e.g. an upload) decoded a window at a time, used
+	#   instead of file_path if set
+	file: Any = None
 	diarize: bool = False
 	# json or text
 	result_format: str = 'json'
@@ -19,3 +26,33 @@ class TranscribeResponse(BaseModel):
 	"""Response for transcribing audio."""
 	# result: list[TranscribeChunk] = []
 	result: Union[list[TranscribeChunk], str] = []
+
+class RealtimeTranscript(BaseModel):
+	"""Partial or final transcription of an utterance in a realtime stream."""
+	final: bool
+	# seconds since the stream started
+	start: float
+	end: float
+	speech: str
+
+class TranscriptCacheStats(BaseModel):
+	"""Transcript cache use since the server started."""
+	hits: int
+	misses: int
+	entries: int
+	# bytes on disk
+	bytes: int
+
+class BatchTranscribeItem(BaseModel):
+	"""Transcription of one file of a batch."""
+	index: int
+	# upload filename or server-side path
+	file: str
+	result: Union[list[TranscribeChunk], str, None] = None
+	error: Union[str, None] = None
+
+class BatchTranscribeResponse(BaseModel):
+	"""Transcriptions of a batch, in request order."""
+	results: list[BatchTranscribeItem] = []
+	# seconds to transcribe the whole batch
+	time: float = 0
@@ -1,15 +1,90 @@
 from typing import Union
 from pydantic import BaseModel, Field
-from .tts_client import SpeakOptions, SpeakToFileOptions
+from .tts_client import SpeakOptions, SpeakStreamOptions, SpeakToFileOptions, SpeakToFileResponse
 
 class ListVoicesResponse(BaseModel):
 	"""List available TTS voices."""
 	voices: list[str] = Field(..., description='Available voices.')
+	cached: list[str] = Field(
+		[],
+		description=
+		'Voices whose conditioning is cached by the loaded model.'
+	)
 
 class SpeakRequest(SpeakOptions):
 	"""Options to generate TTS audio."""
+	binary: bool = Field(
+		False,
+		description=
+		'Respond with the audio itself (`audio/*` body, or a binary websocket frame) instead of base64 in JSON.'
+	)
+
+class SpeakStreamRequest(SpeakStreamOptions):
+	"""Options to stream TTS audio sentence by sentence."""
 	pass
 
 class SpeakToFileRequest(SpeakToFileOptions):
 	"""Options to generate and save TTS audio to file on server."""
 	pass
+
+class SpeakStreamStart(BaseModel):
+	"""Sent before the audio chunks of a TTS stream."""
+	format: str = Field(..., description='Format of the chunks.')
+	sample_rate: int = Field(..., description='Audio sample rate.')
+
+class SpeakStreamEnd(BaseModel):
+	"""Sent after the last audio chunk of a TTS stream."""
+	chunks: int = Field(..., description='Number of audio chunks sent.')
+	first_chunk_time: float = Field(
+		..., description='Seconds until the first chunk was ready.'
+	)
+	time: float = Field(
+		..., description='Time taken to generate audio in seconds.'
+	)
+
+class SpeakBinaryResponse(BaseModel):
+	"""Sent on the websocket ahead of the binary frame with the audio."""
+	format: str = Field(..., description='Format of the audio.')
+	time: float = Field(
+		..., description='Time taken to generate audio in seconds.'
+	)
+
+class BatchSpeakRequest(BaseModel):
+	requests: list[SpeakToFileRequest] = Field(
+		..., description='Utterances to generate and save to file.'
+	)
+	stream: bool = Field(
+		False,
+		description=
+		'Stream results as JSON lines as they finish, instead of returning them all in order.'
+	)
+
+class BatchSpeakItem(BaseModel):
+	index: int = Field(
+		..., description='Position of the request in the batch.'
+	)
+	result: Union[SpeakToFileResponse, None] = Field(
+		None, description='Saved audio.'
+	)
+	error: Union[
+		str, None] = Field(None, description='Error message.')
+
+class BatchSpeakStats(BaseModel):
+	size: int = Field(..., description='Number of requests.')
+	audio_duration: float = Field(
+		0, description='Seconds of audio generated.'
+	)
+	time: float = Field(..., description='Time to run requests.')
+	real_time_factor: float = Field(
+		0,
+		description=
+		'Time taken per second of audio generated, under 1 is faster than real time.'
+	)
+
+class BatchSpeakResponse(BaseModel):
+	results: list[BatchSpeakItem] = Field(
+		..., description='Results, in request order.'
+	)
+	stats: BatchSpeakStats = Field(
+		..., description='Stats of the whole run.'
+	)
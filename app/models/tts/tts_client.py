@@ -14,6 +14,9 @@ class SpeakOptions(BaseModel):
 
 	# TODO?
 	voice: str = Field('default', description='Voice to use.')
+	format: str = Field(
+		'wav', description='Audio format: `wav`, `pcm`, `opus` or `mp3`.'
+	)
 
 class SpeakResponse(BaseModel):
 	"""Generic response to generate TTS audio."""
@@ -24,6 +27,14 @@ class SpeakResponse(BaseModel):
 		..., description='Time taken to generate audio in seconds.'
 	)
 
+class SpeakStreamOptions(SpeakOptions):
+	"""Generic options to stream TTS audio as it's generated."""
+	format: str = Field(
+		'pcm',
+		description=
+		'Stream format: `pcm` (raw 16-bit mono little-endian), `wav` (one header of unknown length, then PCM), or one continuous `opus` (Ogg) or `mp3` stream.'
+	)
+
 class SpeakToFileOptions(SpeakOptions):
 	"""Generic options to generate and save TTS audio to file on server."""
 	file: str = Field('', description='File to save audio to.')
@@ -36,3 +47,6 @@ class SpeakToFileResponse(BaseModel):
 	time: float = Field(
 		..., description='Time taken to generate audio in seconds.'
 	)
+	duration: float = Field(
+		0, description='Length of the audio in seconds.'
+	)
@@ -1,5 +1,18 @@
-import subprocess
+from typing import Any, Iterator
+import io, logging, math, queue, subprocess, threading, wave
 import os
+import numpy as np
+from scipy import signal
+try:
+	import av
+except ImportError:
+	av = None
+try:
+	import soundfile
+except ImportError:
+	soundfile = None
+
+logger = logging.getLogger(__name__)
 
 def convert_to_wav(input_file_path: str) -> str:
 	"""
@@ -20,3 +33,308 @@ def convert_to_wav(input_file_path: str) -> str:
 		return output_file_path
 	except subprocess.CalledProcessError as e:
 		raise RuntimeError(f"Audio conversion failed: {e}")
+
+def resample(samples: Any, from_rate: int, to_rate: int) -> Any:
+	"""Resample mono float samples in memory."""
+	samples = np.asarray(samples, dtype=np.float32)
+	if from_rate == to_rate:
+		return samples
+	g = math.gcd(from_rate, to_rate)
+	samples = signal.resample_poly(samples, to_rate // g, from_rate // g)
+	return samples.astype(np.float32)
+
+def _decode_av(source: Any, sample_rate: int) -> Any:
+	assert av is not None
+	chunks = []
+	with av.open(source) as container:
+		resampler = av.AudioResampler(
+			format='flt', layout='mono', rate=sample_rate
+		)
+		for frame in container.decode(audio=0):
+			for out in resampler.resample(frame):
+				chunks.append(out.to_ndarray().reshape(-1))
+		for out in resampler.resample(None):
+			chunks.append(out.to_ndarray().reshape(-1))
+	if len(chunks) == 0:
+		return np.zeros(0, dtype=np.float32)
+	return np.concatenate(chunks).astype(np.float32)
+
+def _decode_soundfile(source: Any, sample_rate: int) -> Any:
+	assert soundfile is not None
+	data, rate = soundfile.read(source, dtype='float32', always_2d=True)
+	return resample(data.mean(axis=1), rate, sample_rate)
+
+def _decode_ffmpeg(source: Any, sample_rate: int) -> Any:
+	if isinstance(source, str):
+		command_input, data = source, None
+	else:
+		command_input, data = 'pipe:0', source.read()
+	try:
+		result = subprocess.run([
+			'ffmpeg', '-nostdin', '-i', command_input, '-f', 's16le', '-ac',
+			'1', '-ar',
+			str(sample_rate), 'pipe:1'
+		],
+													input=data,
+													check=True,
+													capture_output=True)
+	except subprocess.CalledProcessError as e:
+		raise RuntimeError(f"Audio decoding failed: {e}")
+	pcm = result.stdout[:len(result.stdout) // 2 * 2]
+	return np.frombuffer(pcm, '<i2').astype(np.float32) / 32768.0
+
+def decode_audio(source: Any, sample_rate=16000) -> Any:
+	"""
+	Decodes audio in memory with PyAV, or soundfile, falling back to an ffmpeg pipe.
+	:param source: Path, bytes, or a binary file object (e.g. an upload).
+	:param sample_rate: Rate to resample to.
+	:return: Float32 mono array at `sample_rate`.
+	"""
+	if isinstance(source, bytes):
+		source = io.BytesIO(source)
+	decoders = []
+	if av is not None:
+		decoders.append(_decode_av)
+	if soundfile is not None:
+		decoders.append(_decode_soundfile)
+	for decoder in decoders:
+		try:
+			return decoder(source, sample_rate)
+		except Exception as e:
+			logger.debug(f'{decoder.__name__} failed: {e}')
+		if not isinstance(source, str):
+			source.seek(0)
+	return _decode_ffmpeg(source, sample_rate)
+
+def _av_windows(
+	source: Any, window_samples: int, sample_rate: int
+) -> Iterator[Any]:
+	assert av is not None
+	with av.open(source) as container:
+		resampler = av.AudioResampler(
+			format='flt', layout='mono', rate=sample_rate
+		)
+
+		def frames():
+			for frame in container.decode(audio=0):
+				yield from resampler.resample(frame)
+			yield from resampler.resample(None)
+
+		pending = []
+		count = 0
+		for out in frames():
+			samples = out.to_ndarray().reshape(-1)
+			pending.append(samples)
+			count += len(samples)
+			while count >= window_samples:
+				buffer = np.concatenate(pending)
+				yield buffer[:window_samples].astype(np.float32)
+				pending = [buffer[window_samples:]]
+				count = len(pending[0])
+		if count > 0:
+			yield np.concatenate(pending).astype(np.float32)
+
+def read_audio_windows(
+	source: Any, window_samples: int, sample_rate=16000
+) -> Iterator[Any]:
+	"""
+	Decodes audio a window at a time, in memory with PyAV, falling back to an ffmpeg pipe if PyAV can't open it.
+	:param source: Path to the audio file, or a binary file object (e.g. an upload), read from the start.
+	:param window_samples: Samples per window (the last one may be shorter).
+	:return: Float32 mono arrays at `sample_rate`.
+	"""
+	if av is not None:
+		if not isinstance(source, str):
+			source.seek(0)
+		windows = _av_windows(source, window_samples, sample_rate)
+		try:
+			first = next(windows, None)
+		except Exception as e:
+			logger.debug(f'_av_windows failed: {e}')
+		else:
+			if first is not None:
+				yield first
+				yield from windows
+			return
+	from_file = not isinstance(source, str)
+	command = [
+		'ffmpeg', '-nostdin', '-i', 'pipe:0' if from_file else source, '-f',
+		's16le', '-ac', '1', '-ar',
+		str(sample_rate), '-'
+	]
+	process = subprocess.Popen(
+		command,
+		stdin=subprocess.PIPE if from_file else subprocess.DEVNULL,
+		stdout=subprocess.PIPE,
+		stderr=subprocess.DEVNULL
+	)
+	assert process.stdout is not None
+	feeder = None
+	if from_file:
+		stdin = process.stdin
+		assert stdin is not None
+
+		def feed():
+			try:
+				source.seek(0)
+				for block in iter(lambda: source.read(1 << 16), b''):
+					stdin.write(block)
+			except Exception as e:
+				# ffmpeg exited, or was killed once we stopped reading
+				logger.debug(f'Audio input stopped: {e}')
+			finally:
+				try:
+					stdin.close()
+				except Exception:
+					pass
+
+		feeder = threading.Thread(target=feed, daemon=True)
+		feeder.start()
+	try:
+		while True:
+			data = process.stdout.read(window_samples * 2)
+			if len(data) < 2:
+				break
+			data = data[:len(data) // 2 * 2]
+			yield np.frombuffer(data, '<i2').astype(np.float32) / 32768.0
+	finally:
+		process.kill()
+		process.wait()
+		if feeder is not None:
+			feeder.join()
+	if process.returncode not in (0, -9):
+		raise RuntimeError(f"Audio decoding failed: {process.returncode}")
+
+# media types of the formats `encode_audio` produces
+AUDIO_MEDIA_TYPES = {
+	'pcm': 'audio/L16',
+	'wav': 'audio/wav',
+	'opus': 'audio/ogg',
+	'mp3': 'audio/mpeg',
+}
+
+# ffmpeg output args of the compressed formats
+FFMPEG_ENCODERS = {
+	'opus': ['-c:a', 'libopus', '-f', 'ogg'],
+	'mp3': ['-c:a', 'libmp3lame', '-f', 'mp3'],
+}
+
+def to_pcm16(samples: Any) -> bytes:
+	"""Float samples in [-1, 1] to 16-bit little-endian mono PCM."""
+	samples = np.clip(np.asarray(samples, dtype=np.float32), -1.0, 1.0)
+	return (samples * 32767).astype('<i2').tobytes()
+
+def encode_audio(samples: Any, sample_rate: int, format: str) -> bytes:
+	"""Encode float mono samples in memory as raw PCM, WAV, or Opus (Ogg) and MP3 through an ffmpeg pipe."""
+	pcm = to_pcm16(samples)
+	if format == 'pcm':
+		return pcm
+	if format == 'wav':
+		buffer = io.BytesIO()
+		with wave.open(buffer, 'wb') as f:
+			f.setnchannels(1)
+			f.setsampwidth(2)
+			f.setframerate(sample_rate)
+			f.writeframes(pcm)
+		return buffer.getvalue()
+	if format not in FFMPEG_ENCODERS:
+		raise Exception(f'Unsupported audio format: {format}')
+	try:
+		result = subprocess.run([
+			'ffmpeg', '-f', 's16le', '-ar',
+			str(sample_rate), '-ac', '1', '-i', 'pipe:0',
+			*FFMPEG_ENCODERS[format], 'pipe:1'
+		],
+													input=pcm,
+													check=True,
+													capture_output=True)
+		return result.stdout
+	except subprocess.CalledProcessError as e:
+		raise RuntimeError(f"Audio encoding failed: {e}")
+
+def wav_stream_header(sample_rate: int) -> bytes:
+	"""Header of a 16-bit mono WAV stream of unknown length, to be followed by raw PCM. The RIFF and data sizes are the maximum, as players take them for streams."""
+	return b''.join([
+		b'RIFF',
+		(0xFFFFFFFF).to_bytes(4, 'little'),
+		b'WAVEfmt ',
+		(16).to_bytes(4, 'little'),
+		(1).to_bytes(2, 'little'),  # PCM
+		(1).to_bytes(2, 'little'),  # channels
+		sample_rate.to_bytes(4, 'little'),
+		(sample_rate * 2).to_bytes(4, 'little'),  # bytes per second
+		(2).to_bytes(2, 'little'),  # block align
+		(16).to_bytes(2, 'little'),  # bits per sample
+		b'data',
+		(0xFFFFFFFF).to_bytes(4, 'little'),
+	])
+
+def encode_stream(
+	pcm_chunks: Iterator[bytes], sample_rate: int, format: str
+) -> Iterator[bytes]:
+	"""
+	Encode a stream of 16-bit mono PCM chunks as a single stream in `format`.
+	`wav` is one header followed by the PCM, Opus (Ogg) and MP3 one
+	continuous ffmpeg encoder stream, yielding whatever it has output after
+	each chunk is written. The chunks are read in the calling thread.
+	"""
+	if format == 'pcm':
+		yield from pcm_chunks
+		return
+	if format == 'wav':
+		yield wav_stream_header(sample_rate)
+		yield from pcm_chunks
+		return
+	if format not in FFMPEG_ENCODERS:
+		raise Exception(f'Unsupported audio format: {format}')
+	process = subprocess.Popen([
+		'ffmpeg', '-nostdin', '-f', 's16le', '-ar',
+		str(sample_rate), '-ac', '1', '-i', 'pipe:0',
+		*FFMPEG_ENCODERS[format], '-flush_packets', '1', 'pipe:1'
+	],
+														stdin=subprocess.PIPE,
+														stdout=subprocess.PIPE,
+														stderr=subprocess.DEVNULL)
+	assert process.stdin is not None and process.stdout is not None
+	stdout = process.stdout
+	output: queue.Queue = queue.Queue()
+
+	def read_output():
+		# a thread, as the encoder's output pipe would fill up while we block
+		#   on writing or on the next chunk
+		while True:
+			data = stdout.read1(65536)
+			output.put(data)
+			if len(data) == 0:
+				break
+
+	reader = threading.Thread(target=read_output, daemon=True)
+	reader.start()
+
+	def ready() -> Iterator[bytes]:
+		while True:
+			try:
+				data = output.get_nowait()
+			except queue.Empty:
+				return
+			if len(data) > 0:
+				yield data
+
+	try:
+		for chunk in pcm_chunks:
+			process.stdin.write(chunk)
+			process.stdin.flush()
+			yield from ready()
+		process.stdin.close()
+		while True:
+			data = output.get()
+			if len(data) == 0:
+				break
+			yield data
+	finally:
+		if process.poll() is None:
+			process.kill()
+		process.wait()
+		reader.join()
+	if process.returncode not in (0, -9):
+		raise RuntimeError(f"Audio encoding failed: {process.returncode}")
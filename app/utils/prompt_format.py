@@ -12,9 +12,12 @@
 
 # further, different models support different elements of the prompt (e.g. some have a system/instruction section and some don't, in which case it's to be included in the user section)
 
-# make Formatter class with methods like `flexible`, `Alpaca` and `ChatML`
+# each format is a PromptTemplate in `templates`, e.g. `flexible`, `Alpaca` and `ChatML`
 
-import fnmatch, os
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable
+import fnmatch, os, threading
 from app.models.llm.llm_api import PromptPart, PromptParts
 
 model_formats = {
@@ -31,10 +34,34 @@ model_formats = {
 	'*openchat-3.5-1210*': 'OpenChatCorrect',
 }
 
-class Formatter:
-	# Prompt template: OpenChat-Correct
-	# GPT4 Correct User: {prompt}<|end_of_turn|>GPT4 Correct Assistant:
-	def OpenChatCorrect(
+class PromptTemplate:
+	"""A prompt format, split into a head (system prompt), a string per prior
+	message and a tail (the user's turn and start of the response), so a
+	conversation's rendered history can be kept and only new messages added.
+	Subclasses override the pieces that differ from the plain
+	"Role: content" lines.
+	"""
+	def head(self, system: str, has_prior: bool) -> str:
+		return system.strip() + '\n' if system != '' else ''
+
+	def message(self, msg: dict, user_role: str, assistant_role: str) -> str:
+		return f'{msg["role"].capitalize()}: {msg["content"]}\n'
+
+	def tail(
+		self, user: str, prefix_response: str, has_prior: bool,
+		user_role: str, assistant_role: str
+	) -> str:
+		raise NotImplementedError()
+
+	def render_messages(
+		self, prior_msgs: list[dict], user_role: str, assistant_role: str
+	) -> list[str]:
+		return [
+			self.message(msg, user_role, assistant_role)
+			for msg in prior_msgs
+		]
+
+	def render(
 		self,
 		user: str,
 		system: str = '',
@@ -42,247 +69,225 @@ class Formatter:
 		prior_msgs=[],
 		user_role='user',
 		assistant_role='assistant'
-	):
-		prompt = ''
-		if system != '':
-			prompt += system.strip() + '\n'
-		if len(prior_msgs) > 0:
-			for msg in prior_msgs:
-				prompt += msg['role'].capitalize(
-				) + ': ' + msg['content'] + '\n'
-		prompt += user_role.capitalize() + ': '
-		prompt += user.strip() + '\n'
+	) -> str:
+		has_prior = len(prior_msgs) > 0
+		return ''.join([
+			self.head(system, has_prior),
+			*self.render_messages(prior_msgs, user_role, assistant_role),
+			self.tail(
+				user, prefix_response, has_prior, user_role, assistant_role
+			)
+		])
+
+class OpenChatCorrect(PromptTemplate):
+	# GPT4 Correct User: {prompt}<|end_of_turn|>GPT4 Correct Assistant:
+	def tail(self, user, prefix_response, has_prior, user_role, assistant_role):
 		if prefix_response == '':
-			if len(prior_msgs) > 0:
-				prompt += assistant_role.capitalize() + ': '
-			prompt += '<|end_of_turn|>'
+			end = f'{assistant_role.capitalize()}: <|end_of_turn|>' if has_prior else '<|end_of_turn|>'
 		else:
-			prompt += prefix_response
-		return prompt
+			end = prefix_response
+		return f'{user_role.capitalize()}: {user.strip()}\n{end}'
 
-	# TODO use consistent casing of role names
-	# (e.g. user vs USER)
-	def flexible(
-		self,
-		user,
-		system: str = '',
-		prefix_response='',
-		prior_msgs=[],
-		user_role='user',
-		assistant_role='assistant',
-	):
-		prompt = ''
-		if system != '':
-			prompt += system.strip() + '\n'
-		if len(prior_msgs) > 0:
-			for msg in prior_msgs:
-				prompt += msg['role'].capitalize(
-				) + ': ' + msg['content'] + '\n'
-			prompt += user_role.capitalize() + ': '
-		prompt += user.strip() + '\n'
+# TODO use consistent casing of role names
+# (e.g. user vs USER)
+class Flexible(PromptTemplate):
+	def tail(self, user, prefix_response, has_prior, user_role, assistant_role):
 		if prefix_response == '':
-			if len(prior_msgs) > 0:
-				prompt += assistant_role.capitalize() + ': '
-			prompt += 'RESPONSE:\n'
+			end = f'{assistant_role.capitalize()}: RESPONSE:\n' if has_prior else 'RESPONSE:\n'
 		else:
-			prompt += prefix_response
-		return prompt
+			end = prefix_response
+		role = f'{user_role.capitalize()}: ' if has_prior else ''
+		return f'{role}{user.strip()}\n{end}'
 
-	def Alpaca(
-		self,
-		user: str,
-		system: str = '',
-		prefix_response='',
-		prior_msgs=[],
-		user_role='user',
-		assistant_role='assistant'
-	):
-		prompt = ''
-		if system != '':
-			if len(prior_msgs) > 0:
-				prompt += '### Instruction:\n'
-			prompt += system.strip() + '\n\n'
-		if len(prior_msgs) > 0:
-			for msg in prior_msgs:
-				prompt += msg['role'].capitalize(
-				) + ': ' + msg['content'] + '\n\n'
-			prompt += user_role.capitalize() + ': '
-		else:
-			prompt += '### Instruction:\n'
-		prompt += user.strip() + '\n'
-		r = '' if len(
-			prior_msgs
-		) == 0 else f' {assistant_role.capitalize()}'
-		prompt += f'### Response:\n'
-		if prefix_response != '':
-			prompt += prefix_response
-		return prompt
+class Alpaca(PromptTemplate):
+	def head(self, system, has_prior):
+		if system == '':
+			return ''
+		instruction = '### Instruction:\n' if has_prior else ''
+		return f'{instruction}{system.strip()}\n\n'
 
-	def Alpaca_Input(
-		self,
-		user: str,
-		system: str = '',
-		prefix_response='',
-		prior_msgs=[],
-		user_role='user',
-		assistant_role='assistant'
-	):
-		"""Alpaca variation with the system prompt as the instructions."""
-		prompt = ''
-		if system != '':
-			prompt += '### Instruction:\n' + system.strip() + '\n\n'
-		prompt += '### Input:\n'
-		if len(prior_msgs) > 0:
-			for msg in prior_msgs:
-				prompt += msg['role'].capitalize(
-				) + ': ' + msg['content'] + '\n\n'
-			prompt += user_role.capitalize() + ': '
-		prompt += user.strip() + '\n'
-		r = '' if len(
-			prior_msgs
-		) == 0 else f' {assistant_role.capitalize()}'
-		prompt += f'###{r} Response:\n'
-		if prefix_response != '':
-			prompt += prefix_response
-		return prompt
+	def message(self, msg, user_role, assistant_role):
+		return f'{msg["role"].capitalize()}: {msg["content"]}\n\n'
 
-	def ChatML(
-		self,
-		user: str,
-		system: str = '',
-		prefix_response='',
-		prior_msgs=[],
-		user_role='user',
-		assistant_role='assistant'
-	):
-		prompt = ''
-		u = user_role.lower()
-		a = assistant_role.lower()
-		if system != '':
-			prompt += '<|im_start|>system\n' + system.strip(
-			) + '<|im_end|>\n'
-		if len(prior_msgs) > 0:
-			for msg in prior_msgs:
-				prompt += f'<|im_start|>{msg["role"]}\n' + msg[
-					"content"] + '<|im_end|>\n'
-		prompt += f'<|im_start|>{u}\n' + user.strip(
-		) + '<|im_end|>\n'
-		prompt += f'<|im_start|>{a}\n'
-		if prefix_response != '':
-			prompt += prefix_response
-		return prompt
-
-	def MistralInstruct(
-		self,
-		user: str,
-		system: str = '',
-		prefix_response='',
-		prior_msgs=[],
-		user_role='user',
-		assistant_role='assistant'
-	):
-		# <s>[INST] {prompt} [/INST]
-		prompt = '<s>'
-		if system != '':
-			prompt += '[INST] ' + system.strip()
-		if len(prior_msgs) > 0:
-			prompt += '\n[/INST]\n'
-			for msg in prior_msgs:
-				wrap = msg['role'] == user_role
-				m = f'{msg["role"]}: {msg["content"]}'
-				prompt += f'[INST] {m} [/INST]\n' if wrap else m + '\n'
-			prompt += '[INST] '
-		prompt += user.strip() + ' [/INST]'
-		if prefix_response != '':
-			prompt += '\n' + prefix_response
-		return prompt
-
-	def UserAssistant(
-		self,
-		user: str,
-		system: str = '',
-		prefix_response='',
-		prior_msgs=[],
-		user_role='user',
-		assistant_role='assistant'
-	):
-		prompt = ''
-		if system != '':
-			prompt += system.strip() + '\n'
-		if len(prior_msgs) > 0:
-			# if roles are not standard, use them to map to standard User/Assistant roles
-			is_standard = True
-			if user_role != 'user' or assistant_role != 'assistant':
-				is_standard = False
-			for msg in prior_msgs:
-				role = msg['role']
-				if not is_standard:
-					if role == user_role:
-						role = 'USER'
-					elif role == assistant_role:
-						role = 'ASSISTANT'
-				prompt += role + ':\n' + msg['content'].strip() + '\n'
-		prompt += 'USER:\n' + user.strip() + '\n'
-		prompt += 'ASSISTANT:\n'
-		if prefix_response != '':
-			prompt += prefix_response
-		return prompt
-
-	def UserAssistantNewlines(
-		self,
-		user: str,
-		system: str = '',
-		prefix_response='',
-		prior_msgs=[],
-		user_role='user',
-		assistant_role='assistant'
-	):
-		# this one's not supposed to have system
-		prompt = ''
-		if system != '':
-			prompt += system.strip() + '\n\n'
-		u = user_role.capitalize()
-		a = assistant_role.capitalize()
-		if len(prior_msgs) > 0:
-			for msg in prior_msgs:
-				prompt += f'{msg["role"].capitalize()}:\n{msg["content"].strip()}\n\n'
-		prompt += f'### {u}:\n' + user.strip() + '\n\n'
-		prompt += f'### {a}:\n'
-		if prefix_response != '':
-			prompt += prefix_response
-		return prompt
-
-	# this one returns a list of messages instead
-	# not sure what to do with this exactly
-	def OpenAI(
-		self,
-		user: str,
-		system: str = '',
-		prefix_response='',
-		prior_msgs=[],
-		user_role='user',
-		assistant_role='assistant'
+	def tail(self, user, prefix_response, has_prior, user_role, assistant_role):
+		role = f'{user_role.capitalize()}: ' if has_prior else '### Instruction:\n'
+		return f'{role}{user.strip()}\n### Response:\n{prefix_response}'
+
+class AlpacaInput(Alpaca):
+	"""Alpaca variation with the system prompt as the instructions."""
+	def head(self, system, has_prior):
+		if system == '':
+			return '### Input:\n'
+		return f'### Instruction:\n{system.strip()}\n\n### Input:\n'
+
+	def tail(self, user, prefix_response, has_prior, user_role, assistant_role):
+		if has_prior:
+			return f'{user_role.capitalize()}: {user.strip()}\n### {assistant_role.capitalize()} Response:\n{prefix_response}'
+		return f'{user.strip()}\n### Response:\n{prefix_response}'
+
+class ChatML(PromptTemplate):
+	def head(self, system, has_prior):
+		if system == '':
+			return ''
+		return f'<|im_start|>system\n{system.strip()}<|im_end|>\n'
+
+	def message(self, msg, user_role, assistant_role):
+		return f'<|im_start|>{msg["role"]}\n{msg["content"]}<|im_end|>\n'
+
+	def tail(self, user, prefix_response, has_prior, user_role, assistant_role):
+		return f'<|im_start|>{user_role.lower()}\n{user.strip()}<|im_end|>\n<|im_start|>{assistant_role.lower()}\n{prefix_response}'
+
+class MistralInstruct(PromptTemplate):
+	# <s>[INST] {prompt} [/INST]
+	def head(self, system, has_prior):
+		inst = f'[INST] {system.strip()}' if system != '' else ''
+		close = '\n[/INST]\n' if has_prior else ''
+		return f'<s>{inst}{close}'
+
+	def message(self, msg, user_role, assistant_role):
+		m = f'{msg["role"]}: {msg["content"]}'
+		return f'[INST] {m} [/INST]\n' if msg['role'] == user_role else m + '\n'
+
+	def tail(self, user, prefix_response, has_prior, user_role, assistant_role):
+		inst = '[INST] ' if has_prior else ''
+		response = '\n' + prefix_response if prefix_response != '' else ''
+		return f'{inst}{user.strip()} [/INST]{response}'
+
+class UserAssistant(PromptTemplate):
+	def message(self, msg, user_role, assistant_role):
+		role = msg['role']
+		# if roles are not standard, use them to map to standard User/Assistant roles
+		if user_role != 'user' or assistant_role != 'assistant':
+			if role == user_role:
+				role = 'USER'
+			elif role == assistant_role:
+				role = 'ASSISTANT'
+		return f'{role}:\n{msg["content"].strip()}\n'
+
+	def tail(self, user, prefix_response, has_prior, user_role, assistant_role):
+		return f'USER:\n{user.strip()}\nASSISTANT:\n{prefix_response}'
+
+class UserAssistantNewlines(PromptTemplate):
+	# this one's not supposed to have system
+	def head(self, system, has_prior):
+		return system.strip() + '\n\n' if system != '' else ''
+
+	def message(self, msg, user_role, assistant_role):
+		return f'{msg["role"].capitalize()}:\n{msg["content"].strip()}\n\n'
+
+	def tail(self, user, prefix_response, has_prior, user_role, assistant_role):
+		return f'### {user_role.capitalize()}:\n{user.strip()}\n\n### {assistant_role.capitalize()}:\n{prefix_response}'
+
+templates: dict[str, PromptTemplate] = {
+	'OpenChatCorrect': OpenChatCorrect(),
+	'flexible': Flexible(),
+	'Alpaca': Alpaca(),
+	'Alpaca_Input': AlpacaInput(),
+	'ChatML': ChatML(),
+	'MistralInstruct': MistralInstruct(),
+	'UserAssistant': UserAssistant(),
+	'UserAssistantNewlines': UserAssistantNewlines(),
+}
+
+# this one returns a list of messages instead
+# not sure what to do with this exactly
+def openai_messages(
+	user: str,
+	system: str = '',
+	prefix_response='',
+	prior_msgs=[],
+	user_role='user',
+	assistant_role='assistant'
+) -> list[dict[str, str]]:
+	# not sure how to implement prefix_response
+	prompt = []
+	if system != '':
+		prompt.append({
+			'role': 'system',
+			'content': system.strip()
+		})
+	for msg in prior_msgs:
+		prompt.append({'role': msg['role'], 'content': msg['content']})
+	prompt.append({'role': user_role, 'content': user.strip()})
+	if prefix_response != '':
+		prompt.append({
+			'role': assistant_role,
+			'content': prefix_response
+		})
+	return prompt
+
+class RenderedHistory:
+	"""A conversation's rendered head and prior messages, see `render_conversation`."""
+	def __init__(
+		self, key: tuple, msgs: list[tuple[str, str]], text: str,
+		starts: list[int]
 	):
-		# not sure how to implement prefix_response
-		prompt = []
-		if system != '':
-			prompt.append({
-				'role': 'system',
-				'content': system.strip()
-			})
-		if len(prior_msgs) > 0:
-			for msg in prior_msgs:
-				prompt.append({
-					'role': msg['role'],
-					'content': msg['content']
-				})
-		prompt.append({'role': user_role, 'content': user.strip()})
-		if prefix_response != '':
-			prompt.append({
-				'role': assistant_role,
-				'content': prefix_response
-			})
-		return prompt
+		self.key = key  # (format, system, user_role, assistant_role)
+		self.msgs = msgs  # (role, content) of each rendered message
+		self.text = text
+		# offset in `text` of each message, then of the end
+		self.starts = starts
+
+	def gone(self, msgs: list[tuple[str, str]]) -> int:
+		"""How many of the oldest rendered messages `msgs` leaves out, when the rest of them start it. Leaving out all of them always fits."""
+		for gone in range(len(self.msgs)):
+			rest = self.msgs[gone:]
+			if self.msgs[gone] == msgs[0] and len(rest) <= len(
+				msgs
+			) and rest == msgs[:len(rest)]:
+				return gone
+		return len(self.msgs)
+
+# conversation id -> rendered history, least recently used first
+histories: OrderedDict[str, RenderedHistory] = OrderedDict()
+histories_lock = threading.Lock()
+MAX_HISTORIES = 256
+
+def render_conversation(
+	conversation_id: str,
+	fmt: str,
+	user: str,
+	system: str = '',
+	prefix_response='',
+	prior_msgs=[],
+	user_role='user',
+	assistant_role='assistant'
+) -> str:
+	"""Render like `templates[fmt].render`, reusing the history rendered for `conversation_id` last time when `prior_msgs` extends it, so only the new messages are rendered. Older messages left out since (to fit the context) are cut from the rendered history."""
+	template = templates[fmt]
+	if len(prior_msgs) == 0:
+		return template.render(
+			user, system, prefix_response, prior_msgs, user_role,
+			assistant_role
+		)
+	key = (fmt, system, user_role, assistant_role)
+	msgs = [(msg['role'], msg['content']) for msg in prior_msgs]
+	with histories_lock:
+		history = histories.get(conversation_id)
+	if history is not None and history.key == key:
+		gone = history.gone(msgs)
+		head = history.text[:history.starts[0]]
+		kept = history.text[history.starts[gone]:]
+		shift = history.starts[gone] - len(head)
+		starts = [len(head)] + [s - shift for s in history.starts[gone + 1:]]
+		new_msgs = prior_msgs[len(history.msgs) - gone:]
+	else:
+		head = template.head(system, True)
+		kept = ''
+		starts = [len(head)]
+		new_msgs = prior_msgs
+	pieces = template.render_messages(new_msgs, user_role, assistant_role)
+	for piece in pieces:
+		starts.append(starts[-1] + len(piece))
+	text = ''.join([head, kept, *pieces])
+	with histories_lock:
+		histories[conversation_id] = RenderedHistory(key, msgs, text, starts)
+		histories.move_to_end(conversation_id)
+		while len(histories) > MAX_HISTORIES:
+			histories.popitem(last=False)
+	return text + template.tail(
+		user, prefix_response, True, user_role, assistant_role
+	)
 
 def parts_to_str(parts: list[PromptPart]):
 	s = ''
@@ -298,6 +303,7 @@ def parts_to_str(parts: list[PromptPart]):
 			s += partStr
 	return s
 
+@lru_cache(maxsize=256)
 def get_model_format(model: str) -> str:
 	fmt = None
 	model = model.lower()
@@ -310,14 +316,16 @@ def get_model_format(model: str) -> str:
 	return fmt
 
 def parts_to_prompt(
-	parts: PromptParts, model: str, prefix_response=''
+	parts: PromptParts,
+	model: str,
+	prefix_response='',
+	conversation_id=''
 ) -> str:
-	formatter = None
+	"""Build the prompt for `model`'s format. With a `conversation_id`, the rendered prior messages are kept between calls and only new ones are rendered."""
 	# is model a path? get just the model name
 	if '/' in model:
 		model = os.path.basename(model)
 	fmt = get_model_format(model)
-	formatter = staticmethod(getattr(Formatter(), fmt))
 	user = parts_to_str(parts.user)
 	if hasattr(parts, 'system') and len(parts.system) > 0:
 		system = parts_to_str(parts.system)
@@ -326,11 +334,92 @@ def parts_to_prompt(
 	prior_msgs = []
 	if len(parts.prior_msgs
 					) > 0 and not isinstance(parts.prior_msgs[0], dict):
-		prior_msgs = [msg.model_dump() for msg in parts.prior_msgs]
-	return formatter(
+		prior_msgs = [
+			{
+				'role': msg.role,
+				'content': msg.content
+			} for msg in parts.prior_msgs
+		]
+	if conversation_id != '':
+		return render_conversation(
+			conversation_id, fmt, user, system, prefix_response,
+			prior_msgs
+		)
+	return templates[fmt].render(
 		user, system, prefix_response, prior_msgs=prior_msgs
 	)
 
+def pack_parts_to_prompt(
+	parts: PromptParts,
+	model: str,
+	max_prompt_tokens: int,
+	count_tokens: Callable[[str], int],
+	count_tokens_cached: Callable[[str], int],
+	prefix_response='',
+	conversation_id=''
+) -> tuple[str, int]:
+	"""Like `parts_to_prompt`, dropping the oldest prior messages until the prompt fits in `max_prompt_tokens`. Returns the prompt and how many tokens of messages were dropped.
+
+	The pieces of the prompt are counted separately (prior messages with
+	`count_tokens_cached`, they come back every turn) and the whole prompt is
+	only tokenized to check the result when that estimate gets close to the
+	limit.
+	"""
+	if '/' in model:
+		model = os.path.basename(model)
+	fmt = get_model_format(model)
+	template = templates[fmt]
+	user = parts_to_str(parts.user)
+	system = parts_to_str(parts.system) if len(parts.system) > 0 else ''
+	prior_msgs = []
+	if len(parts.prior_msgs
+					) > 0 and not isinstance(parts.prior_msgs[0], dict):
+		prior_msgs = [
+			{
+				'role': msg.role,
+				'content': msg.content
+			} for msg in parts.prior_msgs
+		]
+	counts = [
+		count_tokens_cached(m) for m in
+		template.render_messages(prior_msgs, 'user', 'assistant')
+	]
+	fixed = count_tokens(template.head(system, True)) + count_tokens(
+		template.tail(user, prefix_response, True, 'user', 'assistant')
+	)
+
+	def estimate(dropped: int) -> int:
+		# plus a token per piece for merges at the boundaries, and BOS
+		kept = counts[dropped:]
+		return fixed + sum(kept) + len(kept) + 2
+
+	dropped = 0
+	while dropped < len(counts) and estimate(dropped) > max_prompt_tokens:
+		dropped += 1
+
+	def render() -> str:
+		if conversation_id != '':
+			return render_conversation(
+				conversation_id, fmt, user, system, prefix_response,
+				prior_msgs[dropped:]
+			)
+		return template.render(
+			user, system, prefix_response, prior_msgs[dropped:]
+		)
+
+	prompt = render()
+	if estimate(dropped) > max_prompt_tokens * 0.9:
+		total = count_tokens(prompt) + 1
+		while total > max_prompt_tokens and dropped < len(counts):
+			dropped += 1
+			prompt = render()
+			total = count_tokens(prompt) + 1
+		if total > max_prompt_tokens:
+			raise Exception(
+				f'Prompt is {total} tokens, only {max_prompt_tokens} fit in the context with max_tokens.'
+			)
+	return prompt, sum(counts[:dropped])
+
 def parts_to_messages(
 	parts: PromptParts,
 	prefix_response=''
@@ -348,7 +437,7 @@ def parts_to_messages(
 		assert isinstance(msg, dict)
 		u = msg['role']
 
-	return Formatter().OpenAI(
+	return openai_messages(
 		parts_to_str(parts.user), parts_to_str(parts.system),
 		prefix_response, prior_msgs, u, a
 	)
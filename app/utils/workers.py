@@ -0,0 +1,98 @@
+import asyncio, logging, queue, threading
+from concurrent.futures import Future
+from typing import Any, Callable
+from app.settings import WORKER_MAX_QUEUE, WORKER_THREADS
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+class WorkerBusy(Exception):
+	"""Raised when a worker's queue is full."""
+	pass
+
+class ModalityWorker:
+	"""Runs blocking calls for one modality (llm, tts, stt, img) on its own threads.
+
+	Jobs wait in a bounded queue, so a slow modality can't starve the event
+	loop or the other modalities, and callers get an error instead of piling up
+	when it's overloaded.
+	"""
+	def __init__(
+		self, name: str, num_threads=1, max_queue=WORKER_MAX_QUEUE
+	):
+		self.name = name
+		self.jobs: queue.Queue = queue.Queue(maxsize=max_queue)
+		self.threads = []
+		for i in range(num_threads):
+			thread = threading.Thread(
+				target=self._loop, name=f'{name}-worker-{i}', daemon=True
+			)
+			thread.start()
+			self.threads.append(thread)
+
+	def _loop(self):
+		while True:
+			future, fn, args, kwargs = self.jobs.get()
+			if not future.set_running_or_notify_cancel():
+				continue
+			try:
+				future.set_result(fn(*args, **kwargs))
+			except BaseException as e:
+				future.set_exception(e)
+
+	def submit(self, fn: Callable, *args, **kwargs) -> Future:
+		future = Future()
+		try:
+			self.jobs.put_nowait((future, fn, args, kwargs))
+		except queue.Full:
+			raise WorkerBusy(f'Too many queued {self.name} requests.')
+		return future
+
+	async def run(self, fn: Callable, *args, **kwargs) -> Any:
+		"""Run `fn` on this worker and await its result."""
+		return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+	async def iterate(self, gen_fn: Callable, *args, **kwargs):
+		"""Run generator function `gen_fn` on this worker, yielding its items as they're produced.
+
+		Closing the async generator (e.g. the client went away) stops the worker
+		at the next item.
+		"""
+		loop = asyncio.get_running_loop()
+		items: asyncio.Queue = asyncio.Queue()
+		closed = threading.Event()
+
+		def produce():
+			try:
+				for item in gen_fn(*args, **kwargs):
+					if closed.is_set():
+						break
+					loop.call_soon_threadsafe(items.put_nowait, (item, None))
+			except Exception as e:
+				loop.call_soon_threadsafe(items.put_nowait, (_END, e))
+				return
+			loop.call_soon_threadsafe(items.put_nowait, (_END, None))
+
+		self.submit(produce)
+		try:
+			while True:
+				item, error = await items.get()
+				if item is _END:
+					if error is not None:
+						raise error
+					break
+				yield item
+		finally:
+			closed.set()
+
+workers: dict[str, ModalityWorker] = {}
+_workers_lock = threading.Lock()
+
+def get_worker(name: str) -> ModalityWorker:
+	with _workers_lock:
+		if name not in workers:
+			workers[name] = ModalityWorker(
+				name, num_threads=WORKER_THREADS.get(name, 1)
+			)
+		return workers[name]
@@ -0,0 +1,56 @@
+# benchmark of the diffusers loader's prompt embedding cache, runs the text
+#   encoder(s) on CPU for a thumbnail-like workload that repeats negative
+#   prompts and style prefixes:
+# python -m notebooks.img_embedding_bench /path/to/sd/models model.safetensors
+import sys, time
+import torch
+from app.args import Args
+from app.client.img import ImgClient_Diffusers
+from app.client.img.embedding_cache import EmbeddingCache
+
+REQUESTS = 64
+STYLES = [
+	'a photo of', 'an oil painting of', 'a watercolor of', 'concept art of'
+]
+SUBJECTS = [
+	'a red fox in the snow', 'a lighthouse at dusk', 'a bowl of ramen',
+	'an old sailing ship', 'a city street in the rain', 'a mountain lake',
+	'a vintage car', 'a cat on a windowsill'
+]
+NEGATIVES = ['', 'blurry, low quality, watermark, text']
+
+models_dir, model_name = sys.argv[1], sys.argv[2]
+Args['img_models_dir'] = models_dir
+loader = ImgClient_Diffusers()
+loader.device = 'cpu'
+start = time.time()
+loader.load_model(model_name)
+assert loader.pipeline is not None
+# half precision matmuls aren't supported on CPU
+loader.pipeline.to(torch.float32)
+print(f'loaded {model_name} in {time.time() - start:.2f}s')
+
+items = [(
+	f'{STYLES[i % len(STYLES)]} {SUBJECTS[i // len(STYLES) % len(SUBJECTS)]}',
+	NEGATIVES[i % len(NEGATIVES)], i
+) for i in range(REQUESTS)]
+
+def run() -> float:
+	start = time.time()
+	for item in items:
+		loader.batch_embeddings([item], 0)
+	return time.time() - start
+
+loader.embeddings = None
+uncached = run()
+loader.embeddings = EmbeddingCache()
+cached = run()
+stats = loader.embedding_cache_stats()
+print(f'{"":>10}{"time":>10}{"per req":>10}')
+print(f'{"uncached":>10}{uncached:>10.3f}{uncached / REQUESTS:>10.4f}')
+print(f'{"cached":>10}{cached:>10.3f}{cached / REQUESTS:>10.4f}')
+print(
+	f'hits {stats["hits"]}, misses {stats["misses"]}, hit rate {stats["hits"] / (stats["hits"] + stats["misses"]):.2f}, {stats["bytes"] >> 10}KiB cached'
+)
+print(f'encoder time saved: {uncached - cached:.3f}s ({1 - cached / uncached:.0%})')
+loader.unload_model()
@@ -0,0 +1,52 @@
+# checks that the llama.cpp loader's speculative decoding doesn't change
+#   greedy output: completes the same prompts without and with a draft model
+# python -m notebooks.llamacpp_draft_check /path/to/llm/models model.gguf draft.gguf
+import sys
+from app.args import Args
+from app.client.llm import LLMClient_LlamaCppPython
+from app.models.llm.client import CompletionOptions
+
+PROMPTS = [
+	'The capital of France is',
+	'def fibonacci(n):',
+	'Once upon a time, in a land far away,',
+	'1, 2, 3, 5, 8, 13,',
+]
+MAX_TOKENS = 64
+
+models_dir, model_name, draft_name = sys.argv[1], sys.argv[2], sys.argv[3]
+Args['llm_models_dir'] = models_dir
+loader = LLMClient_LlamaCppPython()
+loader.load_model(model_name)
+
+def complete_all() -> list[str]:
+	texts = []
+	for prompt in PROMPTS:
+		options = loader.convert_options(
+			CompletionOptions(
+				prompt=prompt, max_tokens=MAX_TOKENS, temp=0, top_k=1
+			)
+		)
+		r = loader.complete(options)['result']
+		texts.append(r['choices'][0]['text'])
+		usage = r['usage']
+		if 'draft_tokens' in usage:
+			print(
+				f'  drafted {usage["draft_tokens"]}, accepted {usage["accepted_draft_tokens"]}'
+			)
+	return texts
+
+print(f'greedy completions of {model_name}')
+plain = complete_all()
+print(f'with draft model {draft_name}')
+loader.load_draft_model(draft_name)
+drafted = complete_all()
+loader.unload_model()
+
+mismatches = 0
+for prompt, a, b in zip(PROMPTS, plain, drafted):
+	if a != b:
+		mismatches += 1
+		print(f'MISMATCH for {prompt!r}:\n  without: {a!r}\n  with:    {b!r}')
+print(f'{len(PROMPTS) - mismatches}/{len(PROMPTS)} prompts match')
+sys.exit(1 if mismatches else 0)
@@ -0,0 +1,69 @@
+# microbenchmark of prompt formatting: every template rendered in full
+#   against incremental rendering of a growing conversation, plus the
+#   memoized model format lookup. "trimmed" is the next turn after the two
+#   oldest messages were left out to fit the context
+# run from the repo root: python -m notebooks.prompt_format_bench
+# incremental rendering only pays off for long histories; with a few
+#   messages, checking the kept history costs more than rendering it again
+import timeit
+from app.utils import prompt_format
+from app.utils.prompt_format import get_model_format, openai_messages, render_conversation, templates
+
+HISTORY_LENGTHS = [0, 10, 100]
+NUMBER = 2000
+
+def make_history(n: int) -> list[dict]:
+	return [{
+		'role': 'user' if i % 2 == 0 else 'assistant',
+		'content': f'message {i} ' + 'lorem ipsum dolor sit amet ' * 8
+	} for i in range(n)]
+
+def bench(fn) -> float:
+	"""Microseconds per call."""
+	return timeit.timeit(fn, number=NUMBER) / NUMBER * 1e6
+
+system = 'You are a helpful assistant.'
+user = 'What is the capital of France?'
+
+print(
+	f'{"format":<24}{"history":>8}{"full":>10}{"incremental":>13}{"trimmed":>10}'
+)
+for name, template in templates.items():
+	for n in HISTORY_LENGTHS:
+		history = make_history(n)
+		args = (user, system, '', history)
+		t_full = bench(lambda: template.render(*args))
+		t_incremental = ''
+		t_trimmed = ''
+		if n > 2:
+			# the next turn of a conversation: the history was rendered up to
+			#   the last exchange, a user and assistant message were added since
+			render_conversation(name, name, user, system, '', history[:-2])
+			rendered = prompt_format.histories[name]
+
+			def next_turn():
+				prompt_format.histories[name] = rendered
+				return render_conversation(name, name, *args)
+
+			assert next_turn() == template.render(*args), name
+			t_incremental = f'{bench(next_turn):.1f}'
+			trimmed_args = (user, system, '', history[2:])
+
+			def trimmed_turn():
+				prompt_format.histories[name] = rendered
+				return render_conversation(name, name, *trimmed_args)
+
+			assert trimmed_turn() == template.render(*trimmed_args), name
+			t_trimmed = f'{bench(trimmed_turn):.1f}'
+		print(
+			f'{name:<24}{n:>8}{t_full:>10.1f}{t_incremental:>13}{t_trimmed:>10}'
+		)
+for n in HISTORY_LENGTHS:
+	args = (user, system, '', make_history(n))
+	print(f'{"OpenAI":<24}{n:>8}{bench(lambda: openai_messages(*args)):>10.1f}')
+
+model = 'openhermes-2.5-mistral-7b.Q5_K_M.gguf'
+get_model_format(model)
+print(f'\nget_model_format (uncached): {bench(lambda: get_model_format.__wrapped__(model)):.2f}us')
+print(f'get_model_format (cached): {bench(lambda: get_model_format(model)):.2f}us')
+prompt_format.histories.clear()
@@ -0,0 +1,51 @@
+# benchmark of the transformers loader's generation engine, runs on CPU
+#   with a tiny local model, e.g. a download of sshleifer/tiny-gpt2:
+# python -m notebooks.transformers_bench /path/to/llm/models tiny-gpt2
+import sys, time
+from app.args import Args
+from app.client.llm import LLMClient_Transformers
+from app.models.llm.client import CompletionOptions
+
+BATCH_SIZES = [1, 4, 8]
+MAX_TOKENS = 32
+ROUNDS = 3
+
+models_dir, model_name = sys.argv[1], sys.argv[2]
+Args['llm_models_dir'] = models_dir
+loader = LLMClient_Transformers()
+start = time.time()
+loader.load_model(model_name)
+print(f'loaded {model_name} on {loader.device} in {time.time() - start:.2f}s')
+
+def make_options(i: int):
+	return loader.convert_options(
+		CompletionOptions(
+			prompt=f'Once upon a time, in a land numbered {i},',
+			max_tokens=MAX_TOKENS,
+			temp=0.7
+		)
+	)
+
+r = loader.complete(make_options(0))
+usage = r['result']['usage']
+print(
+	f'usage: prompt {usage["prompt_tokens"]}, completion {usage["completion_tokens"]}'
+)
+
+print(f'{"batch":>6}{"time":>10}{"tokens":>8}{"tokens/s":>10}')
+for batch_size in BATCH_SIZES:
+	options = [make_options(i) for i in range(batch_size)]
+	elapsed = 0.0
+	tokens = 0
+	for _ in range(ROUNDS):
+		start = time.time()
+		results = loader.complete_batch(options)
+		elapsed += time.time() - start
+		tokens += sum(
+			r['result']['usage']['completion_tokens'] for r in results
+		)
+	print(
+		f'{batch_size:>6}{elapsed / ROUNDS:>10.3f}{tokens // ROUNDS:>8}{tokens / elapsed:>10.1f}'
+	)
+
+loader.unload_model()
@@ -0,0 +1,69 @@
+# stand-in for the whisper.cpp server binary, for running the whispercpp STT
+#   client without the model: takes the same -m/--host/--port arguments and
+#   answers /inference with a "segment" per 5 seconds of the uploaded wav
+# python -m notebooks.whispercpp_fake_server -m none --port 8910
+import argparse, io, json, wave
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+SEGMENT_SECONDS = 5.0
+
+def wav_part(body: bytes, content_type: str) -> bytes:
+	"""The `file` part of a multipart/form-data body."""
+	boundary = content_type.split('boundary=')[1].encode()
+	for part in body.split(b'--' + boundary):
+		head, _, data = part.partition(b'\r\n\r\n')
+		if b'name="file"' in head:
+			return data[:-2] if data.endswith(b'\r\n') else data
+	raise Exception('No file in request.')
+
+class Handler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		self.send_response(200)
+		self.end_headers()
+
+	def do_POST(self):
+		if self.path != '/inference':
+			self.send_error(404)
+			return
+		body = self.rfile.read(int(self.headers['Content-Length']))
+		try:
+			data = wav_part(body, self.headers['Content-Type'])
+			with wave.open(io.BytesIO(data)) as f:
+				duration = f.getnframes() / f.getframerate()
+		except Exception as e:
+			self.send_error(400, str(e))
+			return
+		segments = []
+		start = 0.0
+		while start < duration:
+			end = min(start + SEGMENT_SECONDS, duration)
+			segments.append({
+				'id': len(segments),
+				'start': start,
+				'end': end,
+				'text': f' segment {len(segments)}'
+			})
+			start = end
+		res = json.dumps({
+			'task': 'transcribe',
+			'language': 'english',
+			'duration': duration,
+			'text': ''.join(s['text'] for s in segments),
+			'segments': segments
+		}).encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(res)))
+		self.end_headers()
+		self.wfile.write(res)
+
+	def log_message(self, format, *args):
+		pass
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-m', '--model', default='')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8080)
+	args, _ = parser.parse_known_args()
+	HTTPServer((args.host, args.port), Handler).serve_forever()